@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+Replay de Carga - Fature CPA v2
+
+Mede o teto de throughput do caminho de comissões reproduzindo transações reais:
+
+1. export: lê uma janela de fature_v2.transactions do banco configurado
+   (db_connection.database_config) e grava um arquivo .npz compacto e anonimizado:
+   - afiliados renumerados por uma permutação aleatória não gravada (ordenados por
+     nível, de modo que o pai sempre tem número menor que o filho)
+   - datas substituídas por deslocamentos em ms desde o início da janela
+   - valores arredondados (amount_rounding_cents); nomes, IDs externos e metadados
+     não são exportados
+2. prepare: recria o schema do banco de benchmark (BENCH_DB_*, nome terminando em "bench")
+   com a árvore do arquivo, usando as fases de run_bench.py (carga + migração)
+3. replay: reproduz as transações em 1x, 10x, 100x... (open loop: cada transação é
+   liberada no seu instante, independentemente das anteriores), com N conexões.
+   Cada transação percorre o caminho de comissões: INSERT em transactions,
+   INSERT em commissions a partir de calculate_commissions_realtime e marcação
+   como processada, em uma transação.
+
+Para cada velocidade o relatório traz TPS oferecido e sustentado, percentis de
+latência (desde o instante agendado, incluindo fila) e de serviço, e a velocidade
+em que o sistema satura (TPS sustentado abaixo de saturation_ratio do oferecido ou
+p95 acima de latency_slo_ms).
+"""
+
+import psycopg2
+import numpy as np
+import logging
+import threading
+import queue
+import time
+import json
+import io
+import os
+from datetime import datetime
+from typing import Dict, List
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'scripts'))
+
+from run_bench import FatureBenchmark, bench_database_config, RESULTS_DIR, _git_commit
+from db_connection import FatureConnectionPool, database_config, get_pool, close_pools
+from monitor_fature import FatureMonitor
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+FILE_VERSION = 1
+TRANSACTION_TYPES = ['deposit', 'bet', 'withdrawal', 'bonus']
+
+INSERT_TRANSACTION_SQL = """
+    INSERT INTO fature_v2.transactions (affiliate_id, transaction_type, amount, commission_eligible, metadata)
+    VALUES (%s, %s, %s, %s, %s)
+    RETURNING transaction_id
+"""
+
+INSERT_COMMISSIONS_SQL = """
+    INSERT INTO fature_v2.commissions (
+        transaction_id, beneficiary_affiliate_id, source_affiliate_id, level_distance,
+        base_amount, commission_rate, commission_amount
+    )
+    SELECT %(transaction_id)s, c.beneficiary_id, %(affiliate_id)s, c.level_distance,
+           %(amount)s, ROUND(c.commission_amount / %(amount)s, 4), ROUND(c.commission_amount, 2)
+    FROM fature_v2.calculate_commissions_realtime(%(transaction_id)s, %(max_levels)s) c
+    WHERE ROUND(c.commission_amount, 2) > 0
+"""
+
+MARK_PROCESSED_SQL = """
+    UPDATE fature_v2.transactions
+    SET commission_processed = true, updated_at = NOW()
+    WHERE transaction_id = %s
+"""
+
+
+class FatureReplay:
+    """Exportação anonimizada e replay acelerado de transações"""
+
+    def __init__(self):
+        self.config = {
+            # Banco de produção só é necessário para export (None = database_config())
+            'source_database': None,
+            'database': bench_database_config(),
+            'amount_rounding_cents': 100,
+            'speeds': [1, 10, 100],
+            'concurrency': 8,
+            # Duração máxima de cada velocidade (a janela é truncada)
+            'max_duration_seconds': 300,
+            'max_levels': 5,
+            'latency_slo_ms': 1000,
+            'saturation_ratio': 0.9
+        }
+
+    # ------------------------------------------------------------------
+    # Exportação
+    # ------------------------------------------------------------------
+
+    def export(self, start: datetime, end: datetime, path: str) -> Dict:
+        """Gravar árvore e transações da janela [start, end) em arquivo .npz anonimizado"""
+        source = self.config['source_database'] or database_config()
+        with get_pool(source).connection('report') as conn:
+            with conn.cursor() as cursor:
+                tree = _copy_array(cursor, """
+                    COPY (
+                        SELECT affiliate_id, COALESCE(parent_affiliate_id, 0), hierarchy_level
+                        FROM fature_v2.affiliates_optimized
+                    ) TO STDOUT
+                """, 3)
+                transactions = _copy_array(cursor, cursor.mogrify("""
+                    COPY (
+                        SELECT
+                            affiliate_id,
+                            array_position(%s, transaction_type::text) - 1,
+                            COALESCE(commission_eligible, true)::int,
+                            (amount * 100)::BIGINT,
+                            (EXTRACT(EPOCH FROM transaction_date - %s) * 1000)::BIGINT
+                        FROM fature_v2.transactions
+                        WHERE transaction_date >= %s AND transaction_date < %s
+                        ORDER BY transaction_date
+                    ) TO STDOUT
+                """, (TRANSACTION_TYPES, start, start, end)).decode(), 5)
+
+        if not path.endswith('.npz'):
+            path += '.npz'
+        arrays = anonymize(tree, transactions, self.config['amount_rounding_cents'])
+        meta = {
+            'version': FILE_VERSION,
+            'window_seconds': (end - start).total_seconds(),
+            'affiliates': len(arrays['parent']),
+            'transactions': len(arrays['affiliate']),
+            'exported_at': datetime.now().isoformat()
+        }
+        np.savez_compressed(path, meta=np.array(json.dumps(meta)), **arrays)
+        logger.info(f"✅ {meta['transactions']} transações e {meta['affiliates']} afiliados exportados "
+                    f"para {path} ({os.path.getsize(path) / 1024 / 1024:.1f} MB)")
+        return meta
+
+    # ------------------------------------------------------------------
+    # Preparação do banco local
+    # ------------------------------------------------------------------
+
+    def prepare(self, path: str) -> bool:
+        """Recriar o banco de benchmark com a árvore exportada"""
+        data = load_replay_file(path)
+        benchmark = FatureBenchmark(len(data['parent']))
+        benchmark.config['database'] = dict(self.config['database'])
+
+        for name, func in [('reset', benchmark.reset_database),
+                           ('load_affiliates', lambda: benchmark.load_affiliates(data['parent'])),
+                           ('migration', benchmark.run_migration)]:
+            if not benchmark._step(name, func):
+                logger.error(f"❌ Preparação falhou na fase {name}")
+                return False
+        return True
+
+    # ------------------------------------------------------------------
+    # Replay
+    # ------------------------------------------------------------------
+
+    def _worker(self, pool: FatureConnectionPool, work: queue.Queue, results: List, speed: float):
+        conn = pool.getconn('default')
+        metadata = json.dumps({'replay_speed': speed})
+        try:
+            while True:
+                item = work.get()
+                if item is None:
+                    return
+                scheduled, affiliate_id, kind, eligible, amount = item
+                started = time.perf_counter()
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute(INSERT_TRANSACTION_SQL, (affiliate_id, kind, amount, eligible, metadata))
+                        transaction_id = cursor.fetchone()[0]
+                        if eligible:
+                            cursor.execute(INSERT_COMMISSIONS_SQL, {
+                                'transaction_id': transaction_id, 'affiliate_id': affiliate_id,
+                                'amount': amount, 'max_levels': self.config['max_levels']
+                            })
+                            cursor.execute(MARK_PROCESSED_SQL, (transaction_id,))
+                    conn.commit()
+                    ok = True
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    logger.warning(f"Erro no replay da transação: {e}")
+                    ok = False
+                results.append((scheduled, started, time.perf_counter(), ok))
+        finally:
+            pool.putconn(conn)
+
+    def replay_speed(self, data: Dict, speed: float) -> Dict:
+        """Reproduzir o arquivo na velocidade indicada (open loop)"""
+        offsets = (data['offset_ms'] - data['offset_ms'].min(initial=0)) / 1000.0 / speed
+        selected = np.nonzero(offsets <= self.config['max_duration_seconds'])[0]
+        concurrency = self.config['concurrency']
+
+        pool = FatureConnectionPool(self.config['database'],
+                                    {'min_connections': 1, 'max_connections': concurrency})
+        work = queue.Queue()
+        results = []
+        workers = [threading.Thread(target=self._worker, args=(pool, work, results, speed), daemon=True)
+                   for _ in range(concurrency)]
+        for worker in workers:
+            worker.start()
+
+        affiliates = (data['affiliate'][selected] + 1).tolist()
+        kinds = [TRANSACTION_TYPES[k] for k in data['transaction_type'][selected].tolist()]
+        eligible = data['eligible'][selected].tolist()
+        amounts = [f"{c // 100}.{c % 100:02d}" for c in data['amount_cents'][selected].tolist()]
+        schedule = offsets[selected].tolist()
+
+        max_backlog = 0
+        start = time.perf_counter()
+        for offset, affiliate_id, kind, is_eligible, amount in zip(schedule, affiliates, kinds, eligible, amounts):
+            scheduled = start + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            work.put((scheduled, affiliate_id, kind, is_eligible, amount))
+            max_backlog = max(max_backlog, work.qsize())
+
+        for _ in workers:
+            work.put(None)
+        for worker in workers:
+            worker.join()
+        pool.closeall()
+
+        return self._summarize(speed, results, schedule, max_backlog)
+
+    def _summarize(self, speed: float, results: List, schedule: List, max_backlog: int) -> Dict:
+        summary = {'speed': speed, 'transactions': len(results), 'max_backlog': max_backlog}
+        if not results:
+            return summary
+
+        scheduled, started, finished, ok = (np.array(column) for column in zip(*results))
+        latency_ms = (finished - scheduled) * 1000
+        service_ms = (finished - started) * 1000
+        span = max(schedule[-1] - schedule[0], 1e-3)
+        elapsed = max(finished.max() - scheduled.min(), 1e-3)
+
+        summary.update({
+            'errors': int((~ok).sum()),
+            'offered_tps': len(results) / span,
+            'sustained_tps': float(ok.sum() / elapsed),
+            'latency_ms': _percentiles(latency_ms),
+            'service_ms': _percentiles(service_ms)
+        })
+        summary['saturated'] = bool(
+            summary['sustained_tps'] < summary['offered_tps'] * self.config['saturation_ratio']
+            or summary['latency_ms']['p95'] > self.config['latency_slo_ms']
+        )
+        return summary
+
+    def run(self, path: str) -> Dict:
+        """Reproduzir o arquivo em todas as velocidades configuradas"""
+        data = load_replay_file(path)
+        started_at = datetime.now()
+        runs = []
+
+        for speed in self.config['speeds']:
+            logger.info(f"▶ Replay {speed}x com {self.config['concurrency']} conexões")
+            summary = self.replay_speed(data, speed)
+            runs.append(summary)
+            if summary['transactions']:
+                logger.info(f"  {speed}x: {summary['sustained_tps']:.1f} TPS sustentado "
+                            f"(oferecido {summary['offered_tps']:.1f}), p95 {summary['latency_ms']['p95']:.1f}ms")
+
+        saturation = next((run['speed'] for run in runs if run.get('saturated')), None)
+        return {
+            'meta': {
+                'started_at': started_at.isoformat(),
+                'file': os.path.basename(path),
+                'file_meta': data['meta'],
+                'concurrency': self.config['concurrency'],
+                'max_duration_seconds': self.config['max_duration_seconds'],
+                'git_commit': _git_commit()
+            },
+            'runs': runs,
+            'saturation_speed': saturation,
+            'max_sustained_tps': max((run.get('sustained_tps', 0) for run in runs), default=0)
+        }
+
+
+def anonymize(tree: np.ndarray, transactions: np.ndarray, rounding_cents: int) -> Dict[str, np.ndarray]:
+    """Renumerar afiliados e arredondar valores
+
+    tree: (affiliate_id, parent_id ou 0, hierarchy_level); transactions: (affiliate_id,
+    tipo, elegível, centavos, deslocamento_ms). Os novos números seguem o nível (pai
+    antes do filho, como tree_generator) com ordem aleatória dentro de cada nível.
+    """
+    rng = np.random.default_rng()
+    order = np.lexsort((rng.random(len(tree)), tree[:, 2]))
+    sorted_ids = np.sort(tree[:, 0])
+    dense = np.empty(len(tree), dtype=np.int64)
+    dense[np.searchsorted(sorted_ids, tree[order, 0])] = np.arange(len(tree))
+
+    def to_dense(ids):
+        if len(sorted_ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+        return np.where(sorted_ids[positions] == ids, dense[positions], -1)
+
+    parent = np.full(len(tree), -1, dtype=np.int32)
+    parent[to_dense(tree[:, 0])] = to_dense(tree[:, 1])
+
+    affiliate = to_dense(transactions[:, 0])
+    known = affiliate >= 0
+    amount = np.maximum(np.round(transactions[:, 3] / rounding_cents) * rounding_cents, rounding_cents)
+
+    return {
+        'parent': parent,
+        'offset_ms': transactions[known, 4].astype(np.int64),
+        'affiliate': affiliate[known].astype(np.int32),
+        'transaction_type': transactions[known, 1].astype(np.int8),
+        'eligible': transactions[known, 2].astype(bool),
+        'amount_cents': amount[known].astype(np.int64)
+    }
+
+
+def _copy_array(cursor, query: str, columns: int) -> np.ndarray:
+    buffer = io.StringIO()
+    cursor.copy_expert(query, buffer)
+    buffer.seek(0)
+    if not buffer.getvalue():
+        return np.empty((0, columns), dtype=np.int64)
+    return np.loadtxt(buffer, dtype=np.int64, delimiter='\t', ndmin=2)
+
+
+def _percentiles(values: np.ndarray) -> Dict[str, float]:
+    result = {f"p{p}": float(np.percentile(values, p)) for p in (50, 95, 99)}
+    result['max'] = float(values.max())
+    return result
+
+
+def load_replay_file(path: str) -> Dict:
+    """Abrir arquivo gerado por export"""
+    with np.load(path) as f:
+        data = {name: f[name] for name in f.files}
+    data['meta'] = json.loads(str(data['meta']))
+    if data['meta'].get('version') != FILE_VERSION:
+        raise ValueError(f"Versão de arquivo de replay não suportada: {data['meta'].get('version')}")
+    return data
+
+
+def format_report(result: Dict, min_throughput: float = None) -> str:
+    lines = [f"=== REPLAY {result['meta']['file']} ({result['meta']['concurrency']} conexões) ==="]
+    for run in result['runs']:
+        if not run['transactions']:
+            lines.append(f"   {run['speed']}x: nenhuma transação no intervalo")
+            continue
+        status = "❌" if run['saturated'] else "✅"
+        lines.append(f"{status} {run['speed']}x: {run['transactions']:,} transações, "
+                     f"oferecido {run['offered_tps']:.1f} TPS, sustentado {run['sustained_tps']:.1f} TPS, "
+                     f"latência p50/p95/p99 {run['latency_ms']['p50']:.1f}/{run['latency_ms']['p95']:.1f}/"
+                     f"{run['latency_ms']['p99']:.1f}ms, serviço p95 {run['service_ms']['p95']:.1f}ms, "
+                     f"fila máx {run['max_backlog']}, erros {run['errors']}")
+
+    lines.append("")
+    if result['saturation_speed'] is not None:
+        lines.append(f"Saturação a partir de {result['saturation_speed']}x")
+    else:
+        lines.append("Sem saturação nas velocidades testadas")
+    lines.append(f"Maior TPS sustentado: {result['max_sustained_tps']:.1f}")
+    if min_throughput is not None:
+        lines.append(f"Limite de alerta do monitor (min_throughput_per_second): {min_throughput}")
+    return "\n".join(lines)
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Uso: python replay.py [comando] [args]")
+        print("Comandos disponíveis:")
+        print("  export INICIO FIM ARQUIVO               - Exportar janela (YYYY-MM-DDTHH:MM) anonimizada")
+        print("  prepare ARQUIVO                         - Recriar o banco de benchmark com a árvore do arquivo")
+        print("  run ARQUIVO [VELOCIDADES] [CONEXOES]    - Reproduzir (ex.: 1,10,100 8)")
+        sys.exit(1)
+
+    command = sys.argv[1]
+    replay = FatureReplay()
+
+    if command in ("prepare", "run") and not replay.config['database']['database'].endswith('bench'):
+        print("❌ O banco de benchmark precisa terminar em 'bench'")
+        sys.exit(1)
+
+    try:
+        if command == "export" and len(sys.argv) > 4:
+            start = datetime.fromisoformat(sys.argv[2])
+            end = datetime.fromisoformat(sys.argv[3])
+            replay.export(start, end, sys.argv[4])
+            sys.exit(0)
+
+        elif command == "prepare":
+            sys.exit(0 if replay.prepare(sys.argv[2]) else 1)
+
+        elif command == "run":
+            if len(sys.argv) > 3:
+                replay.config['speeds'] = [float(s) for s in sys.argv[3].split(',')]
+            if len(sys.argv) > 4:
+                replay.config['concurrency'] = int(sys.argv[4])
+
+            result = replay.run(sys.argv[2])
+            os.makedirs(RESULTS_DIR, exist_ok=True)
+            stamp = datetime.fromisoformat(result['meta']['started_at']).strftime('%Y%m%d-%H%M%S')
+            path = os.path.join(RESULTS_DIR, f"replay-{stamp}.json")
+            with open(path, 'w') as f:
+                json.dump(result, f, indent=2, default=str)
+
+            print(format_report(result, FatureMonitor().config['thresholds']['min_throughput_per_second']))
+            print(f"Resultado gravado em {path}")
+            sys.exit(0)
+
+        else:
+            print(f"Comando não reconhecido: {command}")
+            sys.exit(1)
+
+    except psycopg2.Error as e:
+        logger.error(f"Erro no replay: {e}")
+        sys.exit(1)
+
+    finally:
+        close_pools()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+"""
+Suíte de Benchmark - Fature CPA v2
+
+Carrega uma árvore sintética (ver tree_generator.py) em um PostgreSQL local e
+mede, com as próprias classes dos scripts, cada fase do ciclo de vida:
+
+backup -> migração (schema, lotes, hierarchy_index, validação) -> hierarquia
+compacta -> carga de transações -> cálculo de comissões -> coleta do monitor
+-> rollback
+
+Os resultados são gravados em bench/results/*.json. O comando compare aponta
+as fases que ficaram mais lentas que o limiar entre duas execuções.
+
+O schema fature_v2 e as tabelas de public usadas pela migração e pelo rollback
+(affiliates, backups e rollback_log) são apagados e recriados a cada execução;
+por segurança, o nome do banco precisa terminar em "bench". Configuração por variáveis de ambiente:
+BENCH_DB_HOST, BENCH_DB_PORT, BENCH_DB_NAME, BENCH_DB_USER, BENCH_DB_PASSWORD.
+"""
+
+import psycopg2
+import logging
+import time
+import json
+import io
+import os
+import statistics
+import subprocess
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'scripts'))
+
+from tree_generator import generate_tree, tree_stats, affiliates_copy_chunks, transactions_copy_chunks
+from migrate_fature import FatureMigration
+from monitor_fature import FatureMonitor
+from rollback_fature import FatureRollback
+from commission_engine import FatureCommissionEngine
+from compact_hierarchy import CompactHierarchy
+from db_connection import get_pool, close_pools
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+SQL_DIR = os.path.join(ROOT_DIR, 'sql', 'fature_v2')
+
+# Colunas de public.affiliates lidas pela migração, mais os contadores por nível
+BENCH_AFFILIATES_DDL = """
+    CREATE TABLE public.affiliates (
+        affiliate_id BIGINT PRIMARY KEY,
+        parent_affiliate_id BIGINT,
+        external_id VARCHAR(50),
+        name VARCHAR(255),
+        status VARCHAR(50) DEFAULT 'active',
+        registration_date TIMESTAMP,
+        total_deposits DECIMAL(15,2) DEFAULT 0,
+        total_bets DECIMAL(15,2) DEFAULT 0,
+        total_withdrawals DECIMAL(15,2) DEFAULT 0,
+        total_cpa_earned DECIMAL(15,2) DEFAULT 0,
+        total_rev_earned DECIMAL(15,2) DEFAULT 0,
+        total_commissions_paid DECIMAL(15,2) DEFAULT 0,
+        level_1_referrals INTEGER DEFAULT 0,
+        level_2_referrals INTEGER DEFAULT 0,
+        level_3_referrals INTEGER DEFAULT 0,
+        level_4_referrals INTEGER DEFAULT 0,
+        level_5_referrals INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+BENCH_AFFILIATE_COLUMNS = ("affiliate_id, parent_affiliate_id, external_id, name, status, "
+                           "registration_date, created_at, updated_at")
+BENCH_TRANSACTION_COLUMNS = "affiliate_id, transaction_type, amount, transaction_date"
+
+# Tabelas criadas pela migração/backup/rollback em execuções anteriores
+RESET_SQL = """
+    DROP SCHEMA IF EXISTS fature_v2 CASCADE;
+    DROP TABLE IF EXISTS public.affiliates, public.affiliates_backup_pre_v2,
+        public.affiliates_v2_backup_rollback, public.rollback_log CASCADE;
+"""
+
+
+def bench_database_config() -> Dict:
+    """Conexão do banco de benchmark (variáveis BENCH_DB_*)"""
+    return {
+        'host': os.environ.get('BENCH_DB_HOST', 'localhost'),
+        'port': int(os.environ.get('BENCH_DB_PORT', 5432)),
+        'database': os.environ.get('BENCH_DB_NAME', 'fature_bench'),
+        'user': os.environ.get('BENCH_DB_USER', 'postgres'),
+        'password': os.environ.get('BENCH_DB_PASSWORD', '')
+    }
+
+
+def _instrument(obj, method_name: str, timings: Dict, key: str):
+    """Acumular em timings[key] o tempo gasto nas chamadas de obj.method_name"""
+    original = getattr(obj, method_name)
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            timings[key] = timings.get(key, 0.0) + time.perf_counter() - start
+
+    setattr(obj, method_name, timed)
+
+
+class _ChunkReader(io.TextIOBase):
+    """Arquivo somente leitura sobre um iterador de blocos de texto (para COPY FROM STDIN)"""
+
+    def __init__(self, chunks: Iterator[str]):
+        self.chunks = chunks
+        self.buffer = ''
+        self.offset = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        if size < 0:
+            data = self.buffer[self.offset:] + ''.join(self.chunks)
+            self.buffer, self.offset = '', 0
+            return data
+
+        # Posição de leitura no bloco atual: cada chamada copia só os `size` caracteres lidos
+        parts = []
+        while size > 0:
+            if self.offset >= len(self.buffer):
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.buffer, self.offset = chunk, 0
+                continue
+            part = self.buffer[self.offset:self.offset + size]
+            self.offset += len(part)
+            size -= len(part)
+            parts.append(part)
+        return ''.join(parts)
+
+    readline = read
+
+
+class FatureBenchmark:
+    """Execução de benchmark ponta a ponta em banco local"""
+
+    def __init__(self, size: int, transactions_per_affiliate: float = 2.0, seed: int = 42):
+        self.config = {
+            'database': bench_database_config(),
+            'size': size,
+            'transactions_per_affiliate': transactions_per_affiliate,
+            'seed': seed,
+            'transaction_days': 30,
+            'monitor_runs': 3
+        }
+
+        self.timings = {}
+        self.details = {}
+        self.errors = []
+
+    def connect_database(self):
+        """Conectar ao banco de benchmark"""
+        return psycopg2.connect(**self.config['database'])
+
+    def _configure(self, component):
+        """Apontar um componente dos scripts para o banco de benchmark"""
+        component.config['database'] = dict(self.config['database'])
+        return component
+
+    def _step(self, name: str, func: Callable):
+        """Executar e cronometrar uma fase; falhas são registradas em self.errors"""
+        logger.info(f"▶ {name}")
+        start = time.perf_counter()
+        try:
+            result = func()
+        except Exception as e:
+            logger.error(f"Erro na fase {name}: {e}")
+            self.errors.append(f"{name}: {e}")
+            result = False
+        self.timings[name] = time.perf_counter() - start
+        logger.info(f"  {name}: {self.timings[name]:.3f}s")
+        return result
+
+    # ------------------------------------------------------------------
+    # Fases
+    # ------------------------------------------------------------------
+
+    def reset_database(self) -> bool:
+        conn = self.connect_database()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(RESET_SQL)
+                cursor.execute(BENCH_AFFILIATES_DDL)
+            conn.commit()
+            return True
+        finally:
+            conn.close()
+
+    def load_affiliates(self, parent) -> bool:
+        with get_pool(self.config['database']).connection('bulk_load') as conn:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(f"COPY public.affiliates ({BENCH_AFFILIATE_COLUMNS}) FROM STDIN",
+                                   _ChunkReader(affiliates_copy_chunks(parent)))
+                cursor.execute("ANALYZE public.affiliates;")
+        return True
+
+    def run_migration(self) -> bool:
+        migration = self._configure(FatureMigration())
+
+        phases = {}
+        for method in ('create_new_schema', 'migrate_affiliates_batch', 'build_hierarchy_index',
+                       'build_secondary_indexes', 'validate_foreign_keys', 'validate_migration'):
+            _instrument(migration, method, phases, f"migration.{method}")
+
+        # create_new_schema lê create_tables.sql do diretório atual
+        cwd = os.getcwd()
+        os.chdir(SQL_DIR)
+        try:
+            success = migration.run_migration()
+        finally:
+            os.chdir(cwd)
+
+        self.timings.update(phases)
+        self.details['migration'] = {
+            'affiliates_migrated': migration.stats['affiliates_migrated'],
+            'relationships_created': migration.stats['relationships_created'],
+            'errors': migration.stats['errors'],
+            'index_builds': migration.stats['index_builds'],
+            'foreign_key_validations': migration.stats['foreign_key_validations']
+        }
+        return success
+
+    def build_compact_hierarchy(self) -> bool:
+        conn = self.connect_database()
+        try:
+            hierarchy = CompactHierarchy.from_database(conn)
+            self.details['compact_hierarchy'] = {'nodes': len(hierarchy), 'bytes': hierarchy.nbytes,
+                                                 'max_depth': hierarchy.max_depth}
+            return True
+        finally:
+            conn.close()
+
+    def load_transactions(self) -> bool:
+        chunks = transactions_copy_chunks(self.config['size'], self.config['transactions_per_affiliate'],
+                                          seed=self.config['seed'], days=self.config['transaction_days'])
+        with get_pool(self.config['database']).connection('bulk_load') as conn:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(f"COPY fature_v2.transactions ({BENCH_TRANSACTION_COLUMNS}) FROM STDIN",
+                                   _ChunkReader(chunks))
+                cursor.execute("ANALYZE fature_v2.transactions;")
+        return True
+
+    def calculate_commissions(self) -> bool:
+        engine = self._configure(FatureCommissionEngine())
+        end = datetime.now() + timedelta(minutes=1)
+        start = end - timedelta(days=self.config['transaction_days'] + 1)
+
+        stats = engine.process_window(start, end)
+        self.details['commissions'] = stats
+        for phase in ('load_ms', 'calc_ms', 'write_ms'):
+            self.timings[f"commissions.{phase[:-3]}"] = stats.get(phase, 0) / 1000
+        return 'error' not in stats
+
+    def collect_monitor_metrics(self) -> bool:
+        monitor = self._configure(FatureMonitor())
+        durations = []
+        for _ in range(self.config['monitor_runs']):
+            start = time.perf_counter()
+            metrics = monitor.collect_metrics()
+            durations.append(time.perf_counter() - start)
+
+        self.timings['monitor.collect_median'] = statistics.median(durations)
+        return bool(metrics.get('system'))
+
+    def run_rollback(self) -> bool:
+        return self._configure(FatureRollback()).rollback_to_original()
+
+    def run(self) -> Dict:
+        """Executar todas as fases e devolver o resultado"""
+        size = self.config['size']
+        started_at = datetime.now()
+
+        parent = self._step('generate', lambda: generate_tree(size, seed=self.config['seed']))
+        self.details['tree'] = tree_stats(parent)
+
+        pipeline = [
+            ('reset', self.reset_database),
+            ('load_affiliates', lambda: self.load_affiliates(parent)),
+            ('backup', lambda: self._configure(FatureRollback()).create_backup_tables()),
+            ('migration', self.run_migration),
+            ('compact_hierarchy', self.build_compact_hierarchy),
+            ('load_transactions', self.load_transactions),
+            ('commissions', self.calculate_commissions),
+            ('monitor', self.collect_monitor_metrics),
+            ('rollback', self.run_rollback)
+        ]
+
+        for name, func in pipeline:
+            if not self._step(name, func):
+                self.errors.append(f"{name}: fase falhou; fases seguintes canceladas")
+                break
+
+        return {
+            'meta': {
+                'started_at': started_at.isoformat(),
+                'size': size,
+                'transactions_per_affiliate': self.config['transactions_per_affiliate'],
+                'seed': self.config['seed'],
+                'git_commit': _git_commit(),
+                'postgres_version': self._server_version()
+            },
+            'timings': {name: round(seconds, 4) for name, seconds in self.timings.items()},
+            'details': self.details,
+            'errors': self.errors
+        }
+
+    def _server_version(self) -> str:
+        try:
+            conn = self.connect_database()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SHOW server_version;")
+                    return cursor.fetchone()[0]
+            finally:
+                conn.close()
+        except psycopg2.Error:
+            return None
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_result(result: Dict) -> str:
+    """Gravar resultado em bench/results/<data>-<tamanho>.json"""
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stamp = datetime.fromisoformat(result['meta']['started_at']).strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(RESULTS_DIR, f"{stamp}-{result['meta']['size']}.json")
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2, default=str)
+    return path
+
+
+def compare_results(baseline: Dict, current: Dict, threshold: float = 0.15,
+                    min_delta_seconds: float = 0.05) -> List[Dict]:
+    """Comparar fases de duas execuções; regressão = mais lenta que o limiar relativo e absoluto"""
+    comparison = []
+    for name in sorted(set(baseline['timings']) | set(current['timings'])):
+        before = baseline['timings'].get(name)
+        after = current['timings'].get(name)
+        entry = {'phase': name, 'baseline': before, 'current': after, 'ratio': None, 'regression': False}
+
+        if before is not None and after is not None:
+            entry['ratio'] = after / before if before > 0 else None
+            entry['regression'] = (after > before * (1 + threshold) and after - before > min_delta_seconds)
+
+        comparison.append(entry)
+    return comparison
+
+
+def format_comparison(baseline: Dict, current: Dict, comparison: List[Dict]) -> str:
+    lines = ["=== COMPARAÇÃO DE BENCHMARK ===",
+             f"Base:  {baseline['meta']['started_at']} ({baseline['meta'].get('git_commit')})",
+             f"Atual: {current['meta']['started_at']} ({current['meta'].get('git_commit')})"]
+
+    for key in ('size', 'transactions_per_affiliate', 'seed'):
+        if baseline['meta'].get(key) != current['meta'].get(key):
+            lines.append(f"⚠️  {key} diferente: {baseline['meta'].get(key)} x {current['meta'].get(key)}")
+
+    lines.append("")
+    for entry in comparison:
+        if entry['baseline'] is None or entry['current'] is None:
+            lines.append(f"   {entry['phase']}: presente em apenas uma execução")
+            continue
+        status = "❌" if entry['regression'] else "✅"
+        ratio = f"{entry['ratio']:.2f}x" if entry['ratio'] is not None else "-"
+        lines.append(f"{status} {entry['phase']}: {entry['baseline']:.3f}s -> {entry['current']:.3f}s ({ratio})")
+
+    regressions = sum(1 for entry in comparison if entry['regression'])
+    lines.append("")
+    lines.append(f"Regressões: {regressions}")
+    return "\n".join(lines)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Uso: python run_bench.py [comando]")
+        print("Comandos disponíveis:")
+        print("  run TAMANHO [TRANSACOES_POR_AFILIADO] [SEMENTE]  - Executar benchmark completo")
+        print("  compare BASE.json ATUAL.json [LIMIAR]            - Apontar regressões (limiar padrão 0.15)")
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    if command == "run" and len(sys.argv) > 2:
+        size = int(sys.argv[2])
+        per_affiliate = float(sys.argv[3]) if len(sys.argv) > 3 else 2.0
+        seed = int(sys.argv[4]) if len(sys.argv) > 4 else 42
+
+        benchmark = FatureBenchmark(size, per_affiliate, seed)
+        if not benchmark.config['database']['database'].endswith('bench'):
+            print("❌ O banco de benchmark precisa terminar em 'bench' (seus schemas e tabelas são apagados a cada execução)")
+            sys.exit(1)
+
+        result = benchmark.run()
+        close_pools()
+        path = save_result(result)
+
+        print(f"=== BENCHMARK {size:,} AFILIADOS ===")
+        for name, seconds in result['timings'].items():
+            print(f"{name}: {seconds:.3f}s")
+        print(f"Resultado gravado em {path}")
+        sys.exit(0 if not result['errors'] else 1)
+
+    elif command == "compare" and len(sys.argv) > 3:
+        with open(sys.argv[2]) as f:
+            baseline = json.load(f)
+        with open(sys.argv[3]) as f:
+            current = json.load(f)
+        threshold = float(sys.argv[4]) if len(sys.argv) > 4 else 0.15
+
+        comparison = compare_results(baseline, current, threshold)
+        print(format_comparison(baseline, current, comparison))
+        sys.exit(1 if any(entry['regression'] for entry in comparison) else 0)
+
+    else:
+        print(f"Comando não reconhecido: {command}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
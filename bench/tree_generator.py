@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Gerador de Dados Sintéticos - Benchmark Fature CPA v2
+
+Gera árvores de afiliados com distribuição de indicações em lei de potência
+(poucos afiliados com milhares de indicações diretas, a maioria com nenhuma) e
+transações associadas, no formato de texto do COPY.
+
+Modelo da árvore: cada novo afiliado escolhe, com probabilidade
+`uniform_fraction`, um pai uniforme entre os anteriores; caso contrário, o pai
+de um afiliado anterior sorteado (ligação preferencial: a chance é proporcional
+ao número de filhos). Com uniform_fraction=0.25 o expoente fica em torno de 2.3,
+o que reproduz o maior afiliado de produção (~14 mil indicações em ~530 mil).
+Uma cadeia inicial de `min_depth` afiliados garante profundidade mínima.
+
+Os afiliados recebem IDs 1..n em ordem de criação, então o pai sempre tem ID
+menor que o filho (a migração em lotes por ID insere pais antes dos filhos).
+"""
+
+import numpy as np
+from datetime import datetime, timedelta
+from typing import Dict, Iterator
+import sys
+
+TRANSACTION_TYPES = np.array(['deposit', 'bet', 'withdrawal', 'bonus'])
+TRANSACTION_TYPE_WEIGHTS = np.array([0.30, 0.60, 0.08, 0.02])
+
+
+def generate_tree(size: int, seed: int = 42, uniform_fraction: float = 0.25,
+                  root_fraction: float = 0.0005, min_depth: int = 12) -> np.ndarray:
+    """Gerar array de pais (índice do pai ou -1 para raiz) para `size` afiliados"""
+    rng = np.random.default_rng(seed)
+    parent = [-1] * size
+    uniform = (rng.random(size) < uniform_fraction).tolist()
+    roots = (rng.random(size) < root_fraction).tolist()
+    picks = rng.random(size).tolist()
+
+    chain = min(min_depth, size)
+    for i in range(1, chain):
+        parent[i] = i - 1
+
+    for i in range(chain, size):
+        if roots[i]:
+            continue
+        j = int(picks[i] * i)
+        if uniform[i] or parent[j] < 0:
+            parent[i] = j
+        else:
+            parent[i] = parent[j]
+
+    return np.array(parent, dtype=np.int64)
+
+
+def tree_stats(parent: np.ndarray) -> Dict:
+    """Tamanho, raízes, profundidade máxima e distribuição de indicações diretas"""
+    size = len(parent)
+    has_parent = parent >= 0
+    fanout = np.bincount(parent[has_parent], minlength=size) if size else np.zeros(0, dtype=np.int64)
+
+    # Pais sempre têm índice menor, então uma passada em ordem calcula a profundidade
+    depth = np.zeros(size, dtype=np.int64)
+    parent_list = parent.tolist()
+    depth_list = depth.tolist()
+    for i in range(size):
+        if parent_list[i] >= 0:
+            depth_list[i] = depth_list[parent_list[i]] + 1
+
+    return {
+        'affiliates': size,
+        'roots': int(size - has_parent.sum()),
+        'max_depth': max(depth_list) if size else 0,
+        'max_direct_referrals': int(fanout.max()) if size else 0,
+        'affiliates_with_referrals': int((fanout > 0).sum()),
+        'p99_direct_referrals': float(np.percentile(fanout, 99)) if size else 0.0
+    }
+
+
+def affiliates_copy_chunks(parent: np.ndarray, chunk_size: int = 200000,
+                           created_at: datetime = None) -> Iterator[str]:
+    """Linhas COPY de public.affiliates (colunas de BENCH_AFFILIATE_COLUMNS)"""
+    created_at = (created_at or datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+
+    for start in range(0, len(parent), chunk_size):
+        lines = []
+        for index in range(start, min(start + chunk_size, len(parent))):
+            affiliate_id = index + 1
+            parent_id = str(parent[index] + 1) if parent[index] >= 0 else '\\N'
+            lines.append(f"{affiliate_id}\t{parent_id}\tBENCH-{affiliate_id}\tAfiliado {affiliate_id}\t"
+                         f"active\t{created_at}\t{created_at}\t{created_at}\n")
+        yield ''.join(lines)
+
+
+def transactions_copy_chunks(size: int, per_affiliate: float, seed: int = 42, days: int = 30,
+                             chunk_size: int = 500000, now: datetime = None) -> Iterator[str]:
+    """Linhas COPY de fature_v2.transactions (colunas de BENCH_TRANSACTION_COLUMNS)
+
+    A atividade por afiliado segue uma lognormal (poucos afiliados concentram o
+    volume) e as datas se distribuem uniformemente nos últimos `days` dias.
+    """
+    rng = np.random.default_rng(seed + 1)
+    total = int(size * per_affiliate)
+    if size == 0 or total == 0:
+        return
+
+    activity = rng.lognormal(mean=0.0, sigma=1.5, size=size)
+    activity /= activity.sum()
+    now = now or datetime.now()
+    window = days * 86400
+
+    for start in range(0, total, chunk_size):
+        count = min(chunk_size, total - start)
+        affiliates = rng.choice(size, size=count, p=activity) + 1
+        types = rng.choice(TRANSACTION_TYPES, size=count, p=TRANSACTION_TYPE_WEIGHTS)
+        cents = np.maximum(np.round(rng.lognormal(mean=np.log(5000), sigma=1.0, size=count)), 1).astype(np.int64)
+        offsets = rng.integers(0, window, size=count)
+
+        lines = []
+        for affiliate_id, kind, amount, offset in zip(affiliates.tolist(), types.tolist(),
+                                                      cents.tolist(), offsets.tolist()):
+            when = (now - timedelta(seconds=offset)).strftime('%Y-%m-%d %H:%M:%S')
+            lines.append(f"{affiliate_id}\t{kind}\t{amount // 100}.{amount % 100:02d}\t{when}\n")
+        yield ''.join(lines)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Uso: python tree_generator.py TAMANHO [SEMENTE]")
+        print("Gera uma árvore e exibe suas estatísticas (sem acessar o banco)")
+        sys.exit(1)
+
+    size = int(sys.argv[1])
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 42
+
+    start_time = datetime.now()
+    parent = generate_tree(size, seed=seed)
+    stats = tree_stats(parent)
+    elapsed = (datetime.now() - start_time).total_seconds()
+
+    print(f"=== ÁRVORE SINTÉTICA ({elapsed:.1f}s) ===")
+    for key, value in stats.items():
+        print(f"{key}: {value:,}" if isinstance(value, int) else f"{key}: {value}")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
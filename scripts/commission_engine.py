@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Motor de Cálculo de Comissões em Lote - Fature CPA v2
+
+Calcula em memória as mesmas comissões de fature_v2.calculate_commissions_realtime,
+mas para um lote inteiro de transações de uma só vez: a hierarquia é carregada em
+arrays compactos (ponteiro para o pai + profundidade) e os ancestrais de todas as
+transações são obtidos nível a nível com NumPy. O resultado é gravado em
+fature_v2.commissions via COPY.
+"""
+
+import psycopg2
+import psycopg2.extras
+import numpy as np
+import logging
+import time
+import io
+from datetime import datetime, date, timedelta
+from typing import Dict, Optional
+import sys
+
+from db_connection import database_config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Escala de commission_rate (DECIMAL(5,4)): taxas são tratadas como inteiros em 1/10000
+RATE_SCALE = 10000
+
+
+class FatureCommissionEngine:
+    """Cálculo vetorizado de comissões multinível"""
+
+    def __init__(self):
+        self.config = {
+            'database': database_config(),
+            # Mesmas taxas da tabela commission_rules de calculate_commissions_realtime
+            'commission_rules': {
+                1: 0.05,   # 5% nível 1
+                2: 0.03,   # 3% nível 2
+                3: 0.02,   # 2% nível 3
+                4: 0.01,   # 1% nível 4
+                5: 0.005   # 0.5% nível 5
+            },
+            'max_levels': 5
+        }
+
+        self.affiliate_ids = None   # IDs ordenados (posição = índice denso)
+        self.parent_index = None    # índice denso do pai, -1 para raiz
+        self.depth = None           # hierarchy_level de cada afiliado
+        self.rates = self._build_rate_table()
+
+    def connect_database(self):
+        """Conectar ao banco de dados"""
+        return psycopg2.connect(**self.config['database'])
+
+    def _build_rate_table(self) -> np.ndarray:
+        """Converter regras de comissão em array de taxas inteiras indexado por nível"""
+        max_levels = self.config['max_levels']
+        rates = np.zeros(max_levels + 1, dtype=np.int64)
+
+        for level, rate in self.config['commission_rules'].items():
+            if level < 1 or level > max_levels:
+                continue
+            scaled = round(rate * RATE_SCALE)
+            if abs(scaled - rate * RATE_SCALE) > 1e-6:
+                raise ValueError(f"Taxa do nível {level} ({rate}) excede 4 casas decimais")
+            rates[level] = scaled
+
+        return rates
+
+    def _copy_to_array(self, cursor, query: str, columns: int) -> np.ndarray:
+        """Executar COPY (query) TO STDOUT e carregar o resultado inteiro como int64"""
+        buffer = io.StringIO()
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT", buffer)
+        buffer.seek(0)
+
+        if not buffer.getvalue():
+            return np.empty((0, columns), dtype=np.int64)
+
+        return np.loadtxt(buffer, dtype=np.int64, delimiter='\t', ndmin=2)
+
+    def load_hierarchy(self, conn) -> int:
+        """Carregar a hierarquia em arrays compactos de pai e profundidade"""
+        start_time = time.time()
+
+        with conn.cursor() as cursor:
+            rows = self._copy_to_array(cursor, """
+                SELECT affiliate_id, COALESCE(parent_affiliate_id, 0), hierarchy_level
+                FROM fature_v2.affiliates_optimized
+                ORDER BY affiliate_id
+            """, 3)
+
+        self.affiliate_ids = rows[:, 0]
+        self.depth = rows[:, 2].astype(np.int32)
+        self.parent_index = self.lookup(rows[:, 1])
+
+        logger.info(f"Hierarquia carregada: {len(self.affiliate_ids)} afiliados, "
+                    f"profundidade máxima {self.depth.max() if len(self.depth) else 0} "
+                    f"({(time.time() - start_time) * 1000:.0f}ms)")
+        return len(self.affiliate_ids)
+
+    def lookup(self, affiliate_ids: np.ndarray) -> np.ndarray:
+        """Converter IDs de afiliado em índices densos (-1 quando não encontrado)"""
+        if len(self.affiliate_ids) == 0:
+            return np.full(len(affiliate_ids), -1, dtype=np.int64)
+
+        positions = np.searchsorted(self.affiliate_ids, affiliate_ids)
+        positions = np.minimum(positions, len(self.affiliate_ids) - 1)
+        return np.where(self.affiliate_ids[positions] == affiliate_ids, positions, -1)
+
+    def calculate_batch(self, transaction_ids: np.ndarray, source_ids: np.ndarray,
+                        amount_cents: np.ndarray, max_levels: Optional[int] = None) -> Dict[str, np.ndarray]:
+        """Calcular comissões de um lote de transações em uma passada vetorizada
+
+        Equivale a calculate_commissions_realtime aplicado a cada transação, com o valor
+        arredondado para centavos como em commissions.commission_amount (DECIMAL(15,2)).
+        Comissões que arredondam para zero são descartadas, pois violariam
+        chk_positive_amounts na tabela commissions.
+        """
+        max_levels = min(max_levels or self.config['max_levels'], self.config['max_levels'])
+
+        current = self.lookup(source_ids)
+        unknown = int(np.count_nonzero(current < 0))
+        if unknown:
+            logger.warning(f"{unknown} transações com afiliado inexistente na hierarquia")
+
+        parts = {key: [] for key in ('transaction_id', 'beneficiary_id', 'source_id',
+                                     'level_distance', 'base_cents', 'rate', 'commission_cents')}
+
+        for level in range(1, max_levels + 1):
+            valid = current >= 0
+            current = np.where(valid, self.parent_index[np.maximum(current, 0)], -1)
+
+            rate = self.rates[level]
+            has_ancestor = current >= 0
+            if not has_ancestor.any():
+                break
+            if rate == 0:
+                continue
+
+            # Arredondamento half-up em inteiros (valores sempre positivos)
+            commission = (amount_cents[has_ancestor] * rate + RATE_SCALE // 2) // RATE_SCALE
+            positive = commission > 0
+
+            parts['transaction_id'].append(transaction_ids[has_ancestor][positive])
+            parts['beneficiary_id'].append(self.affiliate_ids[current[has_ancestor]][positive])
+            parts['source_id'].append(source_ids[has_ancestor][positive])
+            parts['level_distance'].append(np.full(int(positive.sum()), level, dtype=np.int64))
+            parts['base_cents'].append(amount_cents[has_ancestor][positive])
+            parts['rate'].append(np.full(int(positive.sum()), rate, dtype=np.int64))
+            parts['commission_cents'].append(commission[positive])
+
+        return {
+            key: np.concatenate(values) if values else np.empty(0, dtype=np.int64)
+            for key, values in parts.items()
+        }
+
+    def load_transactions(self, conn, start: datetime, end: datetime) -> np.ndarray:
+        """Carregar e bloquear transações elegíveis e ainda não processadas de uma janela de tempo
+
+        As linhas ficam bloqueadas (FOR UPDATE SKIP LOCKED) até o COMMIT: transações em
+        uso pelo commission_worker são puladas, e o worker espera por estas.
+        """
+        with conn.cursor() as cursor:
+            query = cursor.mogrify("""
+                SELECT transaction_id, affiliate_id, (amount * 100)::BIGINT
+                FROM fature_v2.transactions
+                WHERE commission_eligible = true
+                  AND commission_processed = false
+                  AND transaction_date >= %s AND transaction_date < %s
+                ORDER BY transaction_id
+                FOR UPDATE SKIP LOCKED
+            """, (start, end)).decode()
+            return self._copy_to_array(cursor, query, 3)
+
+    def _format_cents(self, cents: int) -> str:
+        """Formatar centavos como literal DECIMAL(15,2)"""
+        return f"{cents // 100}.{cents % 100:02d}"
+
+    def write_commissions(self, conn, commissions: Dict[str, np.ndarray]) -> int:
+        """Gravar comissões calculadas em fature_v2.commissions via COPY"""
+        total = len(commissions['transaction_id'])
+        if total == 0:
+            return 0
+
+        rate_literals = {int(rate): f"{rate / RATE_SCALE:.4f}" for rate in np.unique(commissions['rate'])}
+        buffer = io.StringIO()
+
+        for tx_id, beneficiary, source, level, base, rate, amount in zip(
+            commissions['transaction_id'].tolist(), commissions['beneficiary_id'].tolist(),
+            commissions['source_id'].tolist(), commissions['level_distance'].tolist(),
+            commissions['base_cents'].tolist(), commissions['rate'].tolist(),
+            commissions['commission_cents'].tolist()
+        ):
+            buffer.write(f"{tx_id}\t{beneficiary}\t{source}\t{level}\t{self._format_cents(base)}\t"
+                         f"{rate_literals[rate]}\t{self._format_cents(amount)}\n")
+
+        buffer.seek(0)
+        with conn.cursor() as cursor:
+            cursor.copy_expert("""
+                COPY fature_v2.commissions (
+                    transaction_id, beneficiary_affiliate_id, source_affiliate_id, level_distance,
+                    base_amount, commission_rate, commission_amount
+                ) FROM STDIN
+            """, buffer)
+
+        return total
+
+    def mark_transactions_processed(self, conn, transaction_ids: np.ndarray) -> np.ndarray:
+        """Marcar transações do lote como processadas com um único UPDATE
+
+        Só marca as que ainda não foram processadas; retorna os IDs efetivamente marcados.
+        """
+        if len(transaction_ids) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE fature_v2.transactions
+                SET commission_processed = true,
+                    commission_batch_id = (SELECT nextval('fature_v2.commission_batch_seq')),
+                    updated_at = NOW()
+                WHERE transaction_id = ANY(%s)
+                  AND commission_processed = false
+                RETURNING transaction_id
+            """, (transaction_ids.tolist(),))
+            return np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+
+    def process_window(self, start: datetime, end: datetime) -> Dict:
+        """Calcular e gravar as comissões de todas as transações de uma janela"""
+        stats = {
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'transactions': 0,
+            'skipped': 0,
+            'commissions': 0,
+            'load_ms': 0,
+            'calc_ms': 0,
+            'write_ms': 0
+        }
+
+        conn = self.connect_database()
+        try:
+            load_start = time.time()
+            self.load_hierarchy(conn)
+            transactions = self.load_transactions(conn, start, end)
+
+            # Comissões apenas das transações que este processo marcou
+            marked = self.mark_transactions_processed(conn, transactions[:, 0])
+            stats['skipped'] = len(transactions) - len(marked)
+            transactions = transactions[np.isin(transactions[:, 0], marked)]
+            stats['load_ms'] = (time.time() - load_start) * 1000
+            stats['transactions'] = len(transactions)
+
+            calc_start = time.time()
+            commissions = self.calculate_batch(transactions[:, 0], transactions[:, 1], transactions[:, 2])
+            stats['calc_ms'] = (time.time() - calc_start) * 1000
+
+            write_start = time.time()
+            stats['commissions'] = self.write_commissions(conn, commissions)
+            conn.commit()
+            stats['write_ms'] = (time.time() - write_start) * 1000
+
+            logger.info(f"✅ {stats['commissions']} comissões geradas para {stats['transactions']} transações "
+                        f"(carga {stats['load_ms']:.0f}ms, cálculo {stats['calc_ms']:.0f}ms, "
+                        f"gravação {stats['write_ms']:.0f}ms)")
+
+        except Exception as e:
+            logger.error(f"Erro ao processar comissões: {e}")
+            conn.rollback()
+            stats['error'] = str(e)
+        finally:
+            conn.close()
+
+        return stats
+
+    def verify_against_sql(self, sample_size: int = 100) -> Dict:
+        """Comparar o motor com calculate_commissions_realtime em uma amostra de transações"""
+        result = {'checked': 0, 'mismatches': []}
+
+        conn = self.connect_database()
+        try:
+            self.load_hierarchy(conn)
+
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT transaction_id, affiliate_id, (amount * 100)::BIGINT
+                    FROM fature_v2.transactions
+                    ORDER BY transaction_id DESC
+                    LIMIT %s
+                """, (sample_size,))
+                sample = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 3)
+
+                engine = self.calculate_batch(sample[:, 0], sample[:, 1], sample[:, 2])
+                expected = {}
+                for tx_id, beneficiary, level, amount in zip(
+                    engine['transaction_id'].tolist(), engine['beneficiary_id'].tolist(),
+                    engine['level_distance'].tolist(), engine['commission_cents'].tolist()
+                ):
+                    expected.setdefault(tx_id, set()).add((beneficiary, level, amount))
+
+                for tx_id in sample[:, 0].tolist():
+                    cursor.execute("""
+                        SELECT beneficiary_id, level_distance, (ROUND(commission_amount, 2) * 100)::BIGINT
+                        FROM fature_v2.calculate_commissions_realtime(%s, %s)
+                        WHERE ROUND(commission_amount, 2) > 0
+                    """, (tx_id, self.config['max_levels']))
+                    sql_rows = set(cursor.fetchall())
+                    engine_rows = expected.get(tx_id, set())
+
+                    if sql_rows != engine_rows:
+                        result['mismatches'].append({
+                            'transaction_id': tx_id,
+                            'only_sql': sorted(sql_rows - engine_rows),
+                            'only_engine': sorted(engine_rows - sql_rows)
+                        })
+                    result['checked'] += 1
+
+        except Exception as e:
+            logger.error(f"Erro na verificação: {e}")
+            result['error'] = str(e)
+        finally:
+            conn.close()
+
+        return result
+
+
+def main():
+    engine = FatureCommissionEngine()
+
+    if len(sys.argv) < 2:
+        print("Uso: python commission_engine.py [comando]")
+        print("Comandos disponíveis:")
+        print("  run [AAAA-MM-DD]  - Calcular comissões das transações do dia (padrão: ontem)")
+        print("  verify [amostra]  - Comparar resultados com calculate_commissions_realtime")
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    if command == "run":
+        if len(sys.argv) > 2:
+            day = datetime.strptime(sys.argv[2], '%Y-%m-%d')
+        else:
+            day = datetime.combine(date.today() - timedelta(days=1), datetime.min.time())
+        stats = engine.process_window(day, day + timedelta(days=1))
+        sys.exit(0 if 'error' not in stats else 1)
+
+    elif command == "verify":
+        sample_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+        result = engine.verify_against_sql(sample_size)
+        print(f"Transações verificadas: {result['checked']}")
+        print(f"Divergências: {len(result['mismatches'])}")
+        for mismatch in result['mismatches'][:10]:
+            print(f"  - {mismatch}")
+        sys.exit(0 if not result['mismatches'] and 'error' not in result else 1)
+
+    else:
+        print(f"Comando não reconhecido: {command}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Pagamento de Comissões em Lote - Fature CPA v2
+
+Fecha um ciclo de pagamento das comissões com status 'approved':
+
+1. lê as comissões por um cursor no servidor (idx_commissions_processing), em
+   blocos, bloqueando as linhas lidas (FOR UPDATE)
+2. acumula o total por beneficiário em um dicionário de tamanho limitado; ao
+   atingir o limite, os parciais são descarregados via COPY em tabela temporária
+3. copia os IDs lidos para tmp_payout_items, bloco a bloco
+4. agrupa os beneficiários em lotes com IDs de commission_batch_seq
+5. marca as comissões como 'paid' (com batch_id) e soma total_commissions_paid
+   dos afiliados, cada um em um único UPDATE
+6. grava o CSV do financeiro em arquivo temporário e o renomeia só após o COMMIT
+
+A memória usada é constante (bloco do cursor + dicionário limitado) e a quantidade
+de comandos não depende do número de comissões. Tudo ocorre em uma transação, no
+perfil de sessão 'payout' (synchronous_commit on, statement_timeout finito). A
+simulação (preview) não consome valores de commission_batch_seq: os lotes são
+numerados 1..N.
+"""
+
+import psycopg2
+import logging
+import time
+import json
+import io
+import os
+from datetime import datetime
+from typing import Dict, Optional
+import sys
+
+from db_connection import database_config, get_pool
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STREAM_SQL = """
+    SELECT commission_id, beneficiary_affiliate_id, (commission_amount * 100)::BIGINT
+    FROM fature_v2.commissions
+    WHERE status = 'approved' AND created_at < %s
+    ORDER BY created_at
+    FOR UPDATE
+"""
+
+
+class FatureCommissionPayout:
+    """Pagamento em lote de comissões aprovadas"""
+
+    def __init__(self):
+        self.config = {
+            'database': database_config(),
+            'fetch_size': 10000,
+            'max_beneficiaries_in_memory': 50000,
+            'beneficiaries_per_batch': 1000,
+            'export_dir': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payouts')
+        }
+
+    def _spill_totals(self, cursor, totals: Dict[int, list]):
+        """Descarregar parciais por beneficiário em tmp_payout_totals"""
+        if not totals:
+            return
+        buffer = io.StringIO()
+        for beneficiary_id, (amount_cents, count) in totals.items():
+            buffer.write(f"{beneficiary_id}\t{amount_cents}\t{count}\n")
+        buffer.seek(0)
+        cursor.copy_expert("COPY tmp_payout_totals (beneficiary_affiliate_id, amount_cents, commissions) "
+                           "FROM STDIN", buffer)
+        totals.clear()
+
+    def _stream_commissions(self, conn, until: datetime) -> Dict:
+        """Ler comissões aprovadas e preencher tmp_payout_items e tmp_payout_totals"""
+        stats = {'commissions': 0, 'spills': 0}
+        totals = {}
+        max_entries = self.config['max_beneficiaries_in_memory']
+
+        with conn.cursor() as cursor, conn.cursor(name='payout_stream') as stream:
+            stream.itersize = self.config['fetch_size']
+            stream.execute(STREAM_SQL, (until,))
+
+            while True:
+                rows = stream.fetchmany(self.config['fetch_size'])
+                if not rows:
+                    break
+
+                items = io.StringIO()
+                for commission_id, beneficiary_id, amount_cents in rows:
+                    items.write(f"{commission_id}\t{beneficiary_id}\n")
+                    entry = totals.get(beneficiary_id)
+                    if entry is None:
+                        if len(totals) >= max_entries:
+                            self._spill_totals(cursor, totals)
+                            stats['spills'] += 1
+                        totals[beneficiary_id] = [amount_cents, 1]
+                    else:
+                        entry[0] += amount_cents
+                        entry[1] += 1
+
+                items.seek(0)
+                cursor.copy_expert("COPY tmp_payout_items (commission_id, beneficiary_affiliate_id) FROM STDIN",
+                                   items)
+                stats['commissions'] += len(rows)
+
+            self._spill_totals(cursor, totals)
+
+        return stats
+
+    def run(self, until: Optional[datetime] = None, dry_run: bool = False) -> Dict:
+        """Pagar comissões aprovadas criadas antes de `until` (padrão: agora)"""
+        start_time = time.time()
+        until = until or datetime.now()
+        stats = {'until': until.isoformat(), 'dry_run': dry_run, 'commissions': 0,
+                 'beneficiaries': 0, 'batches': [], 'total_amount': 0.0}
+
+        export_tmp = None
+        committed = False
+        conn = get_pool(self.config['database']).getconn('payout')
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    CREATE TEMP TABLE tmp_payout_items (
+                        commission_id BIGINT PRIMARY KEY,
+                        beneficiary_affiliate_id BIGINT NOT NULL
+                    ) ON COMMIT DROP;
+
+                    CREATE TEMP TABLE tmp_payout_totals (
+                        beneficiary_affiliate_id BIGINT NOT NULL,
+                        amount_cents BIGINT NOT NULL,
+                        commissions INTEGER NOT NULL
+                    ) ON COMMIT DROP;
+                """)
+
+            stream_stats = self._stream_commissions(conn, until)
+            stats['commissions'] = stream_stats['commissions']
+            stats['spills'] = stream_stats['spills']
+
+            if stats['commissions'] == 0:
+                conn.rollback()
+                logger.info("Nenhuma comissão aprovada para pagamento")
+                return stats
+
+            with conn.cursor() as cursor:
+                cursor.execute("ANALYZE tmp_payout_items; ANALYZE tmp_payout_totals;")
+                cursor.execute("SELECT COUNT(DISTINCT beneficiary_affiliate_id) FROM tmp_payout_totals")
+                stats['beneficiaries'] = cursor.fetchone()[0]
+
+                per_batch = self.config['beneficiaries_per_batch']
+                batch_count = -(-stats['beneficiaries'] // per_batch)
+                if dry_run:
+                    batch_ids = list(range(1, batch_count + 1))
+                else:
+                    cursor.execute("SELECT nextval('fature_v2.commission_batch_seq') FROM generate_series(1, %s)",
+                                   (batch_count,))
+                    batch_ids = [row[0] for row in cursor.fetchall()]
+
+                # Totais finais por beneficiário, distribuídos em lotes contíguos
+                cursor.execute("""
+                    CREATE TEMP TABLE tmp_payout_batches ON COMMIT DROP AS
+                    SELECT
+                        beneficiary_affiliate_id,
+                        SUM(amount_cents) AS amount_cents,
+                        SUM(commissions) AS commissions,
+                        (%(batch_ids)s::BIGINT[])[
+                            (ROW_NUMBER() OVER (ORDER BY beneficiary_affiliate_id) - 1) / %(per_batch)s + 1
+                        ] AS batch_id
+                    FROM tmp_payout_totals
+                    GROUP BY beneficiary_affiliate_id;
+
+                    CREATE UNIQUE INDEX ON tmp_payout_batches (beneficiary_affiliate_id);
+                    ANALYZE tmp_payout_batches;
+                """, {'batch_ids': batch_ids, 'per_batch': per_batch})
+
+                cursor.execute("""
+                    UPDATE fature_v2.commissions c
+                    SET status = 'paid',
+                        paid_at = NOW(),
+                        batch_id = b.batch_id
+                    FROM tmp_payout_items i
+                    JOIN tmp_payout_batches b ON b.beneficiary_affiliate_id = i.beneficiary_affiliate_id
+                    WHERE c.commission_id = i.commission_id
+                """)
+                paid = cursor.rowcount
+                if paid != stats['commissions']:
+                    raise RuntimeError(f"{paid} comissões marcadas de {stats['commissions']} lidas")
+
+                cursor.execute("""
+                    UPDATE fature_v2.affiliates_optimized a
+                    SET total_commissions_paid = a.total_commissions_paid + b.amount_cents / 100.0,
+                        updated_at = NOW()
+                    FROM tmp_payout_batches b
+                    WHERE a.affiliate_id = b.beneficiary_affiliate_id
+                """)
+
+                cursor.execute("""
+                    SELECT batch_id, COUNT(*), SUM(commissions), SUM(amount_cents)
+                    FROM tmp_payout_batches
+                    GROUP BY batch_id
+                    ORDER BY batch_id
+                """)
+                for batch_id, beneficiaries, commissions, amount_cents in cursor.fetchall():
+                    stats['batches'].append({
+                        'batch_id': batch_id,
+                        'beneficiaries': beneficiaries,
+                        'commissions': int(commissions),
+                        'amount': int(amount_cents) / 100
+                    })
+                stats['total_amount'] = sum(batch['amount'] for batch in stats['batches'])
+
+                # Arquivo definitivo só aparece se o COMMIT der certo
+                if not dry_run:
+                    stats['export_file'] = self._export_path(batch_ids[0])
+                    export_tmp = stats['export_file'] + '.tmp'
+                    self._export(cursor, export_tmp)
+
+                stats['duration_ms'] = int((time.time() - start_time) * 1000)
+                cursor.execute("""
+                    INSERT INTO fature_v2.system_log (operation, details)
+                    VALUES ('commission_payout', %s)
+                """, (json.dumps(stats, default=str),))
+
+            if dry_run:
+                conn.rollback()
+                logger.info("Simulação concluída (nenhuma alteração gravada)")
+            else:
+                conn.commit()
+                committed = True
+                os.replace(export_tmp, stats['export_file'])
+                logger.info(f"✅ {stats['commissions']} comissões pagas para {stats['beneficiaries']} "
+                            f"beneficiários em {len(stats['batches'])} lotes "
+                            f"(R$ {stats['total_amount']:,.2f}, {stats['duration_ms']}ms)")
+
+        except Exception as e:
+            logger.error(f"Erro no pagamento de comissões: {e}")
+            if committed:
+                logger.error(f"Pagamento gravado, mas o CSV ficou em {export_tmp}")
+            else:
+                conn.rollback()
+                if export_tmp and os.path.exists(export_tmp):
+                    os.remove(export_tmp)
+                stats.pop('export_file', None)
+            stats['error'] = str(e)
+        finally:
+            get_pool(self.config['database']).putconn(conn)
+
+        return stats
+
+    def _export_path(self, first_batch_id: int) -> str:
+        return os.path.join(self.config['export_dir'], f"payout_{first_batch_id}.csv")
+
+    def _export(self, cursor, path: str):
+        """Exportar totais por beneficiário e lote para CSV (arquivo do financeiro)"""
+        os.makedirs(self.config['export_dir'], exist_ok=True)
+        with open(path, 'w') as f:
+            cursor.copy_expert("""
+                COPY (
+                    SELECT batch_id, beneficiary_affiliate_id, commissions,
+                           (amount_cents / 100.0)::DECIMAL(15,2) AS amount
+                    FROM tmp_payout_batches
+                    ORDER BY batch_id, beneficiary_affiliate_id
+                ) TO STDOUT WITH (FORMAT csv, HEADER)
+            """, f)
+
+
+def main():
+    payout = FatureCommissionPayout()
+
+    if len(sys.argv) < 2:
+        print("Uso: python commission_payout.py [comando] [YYYY-MM-DD]")
+        print("Comandos disponíveis:")
+        print("  run [ATE]      - Pagar comissões aprovadas criadas antes da data (padrão: agora)")
+        print("  preview [ATE]  - Simular o pagamento sem gravar")
+        sys.exit(1)
+
+    command = sys.argv[1]
+    until = datetime.strptime(sys.argv[2], '%Y-%m-%d') if len(sys.argv) > 2 else None
+
+    if command in ("run", "preview"):
+        stats = payout.run(until, dry_run=(command == "preview"))
+        print(f"=== PAGAMENTO {'(SIMULAÇÃO) ' if stats['dry_run'] else ''}===")
+        print(f"Comissões: {stats['commissions']:,}")
+        print(f"Beneficiários: {stats['beneficiaries']:,}")
+        for batch in stats['batches']:
+            print(f"  Lote {batch['batch_id']}: {batch['beneficiaries']} beneficiários, "
+                  f"{batch['commissions']} comissões, R$ {batch['amount']:,.2f}")
+        print(f"Total: R$ {stats['total_amount']:,.2f}")
+        sys.exit(0 if 'error' not in stats else 1)
+
+    else:
+        print(f"Comando não reconhecido: {command}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
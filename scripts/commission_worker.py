@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+Worker da Fila de Comissões - Fature CPA v2
+
+Consome fature_v2.commission_queue em lotes. Cada lote é reivindicado com
+FOR UPDATE SKIP LOCKED (ordem de prioridade), calculado e marcado como processado
+em um único comando, de forma que vários processos podem rodar em paralelo sem
+processar a mesma transação duas vezes: além do item da fila, a linha da transação é
+bloqueada (FOR UPDATE), pois a fila pode ter mais de um item por transação e o
+commission_engine também as reivindica. Falhas são isoladas por item e
+reagendadas com backoff exponencial até max_attempts.
+"""
+
+import psycopg2
+import logging
+import time
+import multiprocessing
+from typing import Dict, List
+import sys
+
+from db_connection import database_config
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Reivindicação do lote: menor prioridade primeiro, itens com retry só após o backoff
+CLAIM_BATCH_SQL = """
+    SELECT queue_id, transaction_id
+    FROM fature_v2.commission_queue
+    WHERE status = 'pending'
+      AND next_attempt_at <= NOW()
+    ORDER BY priority, created_at
+    LIMIT %(batch_size)s
+    FOR UPDATE SKIP LOCKED
+"""
+
+CLAIM_IDS_SQL = """
+    SELECT queue_id, transaction_id
+    FROM fature_v2.commission_queue
+    WHERE queue_id = ANY(%(queue_ids)s)
+      AND status = 'pending'
+    FOR UPDATE SKIP LOCKED
+"""
+
+# Cálculo + gravação + baixa da fila em uma ida ao banco
+PROCESS_SQL = """
+    WITH claimed AS (
+        {claim}
+    ),
+    rules AS (
+        SELECT * FROM (VALUES {rules}) AS r(level_distance, commission_rate)
+    ),
+    pending_tx AS (
+        -- Transação bloqueada: itens repetidos da fila (no mesmo lote ou em workers
+        -- diferentes) esperam o primeiro e a encontram já processada
+        SELECT t.transaction_id, t.affiliate_id, t.amount
+        FROM fature_v2.transactions t
+        WHERE t.transaction_id IN (SELECT transaction_id FROM claimed)
+          AND t.commission_eligible = true
+          AND t.commission_processed = false
+        FOR UPDATE OF t
+    ),
+    inserted AS (
+        INSERT INTO fature_v2.commissions (
+            transaction_id, beneficiary_affiliate_id, source_affiliate_id, level_distance,
+            base_amount, commission_rate, commission_amount
+        )
+        SELECT
+            tx.transaction_id, hi.ancestor_id, tx.affiliate_id, hi.level_distance,
+            tx.amount, r.commission_rate, ROUND(tx.amount * r.commission_rate, 2)
+        FROM pending_tx tx
+        JOIN fature_v2.hierarchy_index hi ON hi.descendant_id = tx.affiliate_id
+        JOIN rules r ON r.level_distance = hi.level_distance
+        WHERE ROUND(tx.amount * r.commission_rate, 2) > 0
+        RETURNING commission_id
+    ),
+    marked_tx AS (
+        UPDATE fature_v2.transactions t
+        SET commission_processed = true,
+            updated_at = NOW()
+        FROM pending_tx tx
+        WHERE t.transaction_id = tx.transaction_id
+        RETURNING t.transaction_id
+    ),
+    done AS (
+        UPDATE fature_v2.commission_queue q
+        SET status = 'processed',
+            attempts = q.attempts + 1,
+            processed_at = NOW(),
+            error_message = NULL
+        FROM claimed c
+        WHERE q.queue_id = c.queue_id
+        RETURNING q.queue_id
+    )
+    SELECT
+        (SELECT COUNT(*) FROM done) AS processed,
+        (SELECT COUNT(*) FROM marked_tx) AS transactions,
+        (SELECT COUNT(*) FROM inserted) AS commissions
+"""
+
+# Falha: reagendar com backoff exponencial ou desistir após max_attempts
+FAIL_SQL = """
+    UPDATE fature_v2.commission_queue
+    SET attempts = attempts + 1,
+        status = CASE WHEN attempts + 1 >= max_attempts THEN 'failed' ELSE 'pending' END,
+        next_attempt_at = NOW() + LEAST(
+            %(backoff_base)s * POWER(2, attempts), %(backoff_max)s
+        ) * INTERVAL '1 second',
+        processed_at = NOW(),
+        error_message = %(error)s
+    WHERE queue_id = %(queue_id)s
+"""
+
+
+class FatureCommissionWorker:
+    """Worker horizontal da fila de comissões"""
+
+    def __init__(self):
+        self.config = {
+            'database': dict(database_config(), application_name='fature_commission_worker'),
+            # Mesmas taxas de calculate_commissions_realtime
+            'commission_rules': {
+                1: 0.05,
+                2: 0.03,
+                3: 0.02,
+                4: 0.01,
+                5: 0.005
+            },
+            'batch_size': 500,
+            'idle_sleep_seconds': 1.0,
+            'backoff_base_seconds': 30,
+            'backoff_max_seconds': 3600
+        }
+
+        self.stats = {
+            'batches': 0,
+            'processed': 0,
+            'commissions': 0,
+            'failed': 0
+        }
+
+    def connect_database(self):
+        """Conectar ao banco de dados"""
+        conn = psycopg2.connect(**self.config['database'])
+        conn.autocommit = False
+        return conn
+
+    def _rules_values(self) -> str:
+        """Montar a lista VALUES de regras a partir da configuração"""
+        return ', '.join(
+            f"({int(level)}, {float(rate)}::DECIMAL(5,4))"
+            for level, rate in sorted(self.config['commission_rules'].items())
+        )
+
+    def _process_sql(self, claim: str) -> str:
+        return PROCESS_SQL.format(claim=claim, rules=self._rules_values())
+
+    def check_schema(self, conn):
+        """Verificar a coluna de backoff sem DDL (ALTER TABLE bloquearia a fila a cada início)"""
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = 'fature_v2'
+                  AND table_name = 'commission_queue'
+                  AND column_name = 'next_attempt_at'
+            """)
+            present = cursor.fetchone() is not None
+        conn.commit()
+
+        if not present:
+            raise RuntimeError("fature_v2.commission_queue sem a coluna next_attempt_at; "
+                               "execute: python migrate_fature.py upgrade")
+
+    def process_batch(self, conn) -> int:
+        """Reivindicar e processar um lote; retorna quantos itens da fila foram consumidos"""
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(self._process_sql(CLAIM_BATCH_SQL),
+                               {'batch_size': self.config['batch_size']})
+                processed, transactions, commissions = cursor.fetchone()
+            conn.commit()
+
+            self.stats['batches'] += 1
+            self.stats['processed'] += processed
+            self.stats['commissions'] += commissions
+            return processed
+
+        except psycopg2.Error as e:
+            conn.rollback()
+            logger.warning(f"Falha no lote, reprocessando item a item: {e}")
+            return self.process_individually(conn)
+
+    def process_individually(self, conn) -> int:
+        """Reivindicar um lote e processar cada item em savepoint próprio para isolar falhas"""
+        consumed = 0
+
+        with conn.cursor() as cursor:
+            cursor.execute(CLAIM_BATCH_SQL, {'batch_size': self.config['batch_size']})
+            claimed = cursor.fetchall()
+
+            for queue_id, transaction_id in claimed:
+                cursor.execute("SAVEPOINT queue_item;")
+                try:
+                    cursor.execute(self._process_sql(CLAIM_IDS_SQL), {'queue_ids': [queue_id]})
+                    processed, transactions, commissions = cursor.fetchone()
+                    cursor.execute("RELEASE SAVEPOINT queue_item;")
+                    self.stats['processed'] += processed
+                    self.stats['commissions'] += commissions
+
+                except psycopg2.Error as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT queue_item;")
+                    cursor.execute(FAIL_SQL, {
+                        'queue_id': queue_id,
+                        'error': str(e)[:1000],
+                        'backoff_base': self.config['backoff_base_seconds'],
+                        'backoff_max': self.config['backoff_max_seconds']
+                    })
+                    self.stats['failed'] += 1
+                    logger.error(f"Item {queue_id} (transação {transaction_id}) falhou: {e}")
+
+                consumed += 1
+
+        conn.commit()
+        self.stats['batches'] += 1
+        return consumed
+
+    def run(self, drain: bool = False, max_idle_cycles: int = 3) -> Dict:
+        """Consumir a fila continuamente (ou até esvaziá-la quando drain=True)"""
+        conn = self.connect_database()
+        idle_cycles = 0
+        start_time = time.time()
+
+        try:
+            self.check_schema(conn)
+            while True:
+                consumed = self.process_batch(conn)
+
+                if consumed == 0:
+                    idle_cycles += 1
+                    if drain and idle_cycles >= max_idle_cycles:
+                        break
+                    time.sleep(self.config['idle_sleep_seconds'])
+                else:
+                    idle_cycles = 0
+
+        except KeyboardInterrupt:
+            logger.info("Worker interrompido pelo usuário")
+        finally:
+            conn.close()
+
+        self.stats['elapsed_seconds'] = time.time() - start_time
+        logger.info(f"Worker finalizado: {self.stats['processed']} itens, "
+                    f"{self.stats['commissions']} comissões, {self.stats['failed']} falhas")
+        return self.stats
+
+
+def _worker_process(drain: bool, results):
+    """Ponto de entrada de cada processo worker"""
+    worker = FatureCommissionWorker()
+    worker.config['idle_sleep_seconds'] = 0.2 if drain else worker.config['idle_sleep_seconds']
+    results.put(worker.run(drain=drain))
+
+
+def run_pool(workers: int, drain: bool = False) -> List[Dict]:
+    """Executar N processos worker em paralelo"""
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_worker_process, args=(drain, results), name=f"worker-{i + 1}")
+        for i in range(workers)
+    ]
+
+    for process in processes:
+        process.start()
+
+    stats = [results.get() for _ in processes]
+
+    for process in processes:
+        process.join()
+
+    return stats
+
+
+def run_benchmark(worker_counts: List[int], items: int) -> List[Dict]:
+    """Medir throughput com N workers e verificar ausência de processamento duplicado
+
+    Reaproveita as últimas `items` transações: apaga suas comissões, marca-as como
+    não processadas e as reenfileira antes de cada rodada.
+    """
+    setup = FatureCommissionWorker()
+    results = []
+
+    conn = setup.connect_database()
+    try:
+        setup.check_schema(conn)
+
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT transaction_id FROM fature_v2.transactions
+                WHERE commission_eligible = true
+                ORDER BY transaction_id DESC
+                LIMIT %s
+            """, (items,))
+            transaction_ids = [row[0] for row in cursor.fetchall()]
+
+        for workers in worker_counts:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    DELETE FROM fature_v2.commission_queue WHERE transaction_id = ANY(%(ids)s);
+                    DELETE FROM fature_v2.commissions WHERE transaction_id = ANY(%(ids)s);
+                    UPDATE fature_v2.transactions SET commission_processed = false
+                    WHERE transaction_id = ANY(%(ids)s);
+                    INSERT INTO fature_v2.commission_queue (transaction_id, priority)
+                    SELECT id, 5 FROM UNNEST(%(ids)s::BIGINT[]) AS id;
+                """, {'ids': transaction_ids})
+            conn.commit()
+
+            start_time = time.time()
+            stats = run_pool(workers, drain=True)
+            elapsed = time.time() - start_time
+
+            with conn.cursor() as cursor:
+                # Cada item deve ter sido processado exatamente uma vez
+                cursor.execute("""
+                    SELECT
+                        COUNT(*) FILTER (WHERE status = 'processed' AND attempts = 1),
+                        COUNT(*) FILTER (WHERE status <> 'processed' OR attempts <> 1)
+                    FROM fature_v2.commission_queue
+                    WHERE transaction_id = ANY(%s)
+                """, (transaction_ids,))
+                processed_once, anomalies = cursor.fetchone()
+
+                cursor.execute("""
+                    SELECT COUNT(*) FROM (
+                        SELECT transaction_id, beneficiary_affiliate_id, level_distance
+                        FROM fature_v2.commissions
+                        WHERE transaction_id = ANY(%s)
+                        GROUP BY 1, 2, 3
+                        HAVING COUNT(*) > 1
+                    ) dup
+                """, (transaction_ids,))
+                duplicates = cursor.fetchone()[0]
+
+            processed = sum(s['processed'] for s in stats)
+            results.append({
+                'workers': workers,
+                'items': len(transaction_ids),
+                'processed': processed,
+                'elapsed_seconds': elapsed,
+                'throughput_per_second': processed / elapsed if elapsed > 0 else 0,
+                'processed_once': processed_once,
+                'anomalies': anomalies,
+                'duplicate_commissions': duplicates
+            })
+
+    finally:
+        conn.close()
+
+    baseline = results[0]['throughput_per_second'] if results else 0
+    for result in results:
+        result['speedup'] = result['throughput_per_second'] / baseline if baseline else 0
+
+    return results
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Uso: python commission_worker.py [comando]")
+        print("Comandos disponíveis:")
+        print("  run [N]                    - Executar N workers continuamente (padrão: 1)")
+        print("  drain [N]                  - Executar N workers até esvaziar a fila")
+        print("  bench [N1,N2,...] [itens]  - Benchmark de escalabilidade (reprocessa transações!)")
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    if command in ("run", "drain"):
+        workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+        if workers == 1:
+            worker = FatureCommissionWorker()
+            stats = worker.run(drain=(command == "drain"))
+            sys.exit(0 if stats['failed'] == 0 else 1)
+
+        stats = run_pool(workers, drain=(command == "drain"))
+        sys.exit(0 if all(s['failed'] == 0 for s in stats) else 1)
+
+    elif command == "bench":
+        worker_counts = [int(n) for n in sys.argv[2].split(',')] if len(sys.argv) > 2 else [1, 2, 4, 8]
+        items = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+
+        print("⚠️  O benchmark apaga e recalcula as comissões das transações mais recentes.")
+        print("Use apenas em bancos de teste.")
+        confirm = input("Digite 'CONFIRMAR BENCHMARK' para continuar: ")
+        if confirm != "CONFIRMAR BENCHMARK":
+            print("Benchmark cancelado.")
+            sys.exit(0)
+
+        results = run_benchmark(worker_counts, items)
+
+        print("=== BENCHMARK COMMISSION WORKER ===")
+        print(f"{'workers':>8} {'itens':>8} {'tempo(s)':>10} {'itens/s':>10} {'speedup':>8} {'duplicados':>11}")
+        for r in results:
+            print(f"{r['workers']:>8} {r['processed']:>8} {r['elapsed_seconds']:>10.2f} "
+                  f"{r['throughput_per_second']:>10.1f} {r['speedup']:>7.2f}x "
+                  f"{r['duplicate_commissions'] + r['anomalies']:>11}")
+
+        sys.exit(0 if all(r['duplicate_commissions'] == 0 and r['anomalies'] == 0 for r in results) else 1)
+
+    else:
+        print(f"Comando não reconhecido: {command}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Hierarquia Compacta em Memória - Fature CPA v2
+
+Representa a árvore de afiliados em arrays densos em vez das linhas de
+fature_v2.hierarchy_index:
+
+- affiliate_ids: IDs ordenados (a posição é o índice denso do afiliado)
+- parent / depth: índice denso do pai (-1 para raiz) e profundidade (0 para raiz)
+- tin / tout: intervalo do afiliado no percurso em pré-ordem (Euler tour);
+  os descendentes de Y são exatamente os nós com tin em [tin[Y], tout[Y])
+- level_order / level_tin / level_start: nós ordenados por (profundidade, tin),
+  para contar descendentes de um nível com duas buscas binárias
+
+Consultas:
+- ancestrais até o nível k: O(k)
+- X está na rede de Y: O(1)
+- tamanho da rede por nível: O(log n) por nível
+
+A estrutura pode ser salva em um único arquivo e reaberta via memory-map,
+sem reconstrução (inicialização instantânea em outros processos).
+"""
+
+import psycopg2
+import numpy as np
+import logging
+import time
+import io
+import json
+from typing import Dict, List, Optional
+import sys
+
+from db_connection import database_config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+FILE_MAGIC = b'FATHIER1'
+FILE_ALIGNMENT = 64
+
+# Arrays persistidos e seus tipos
+ARRAY_DTYPES = {
+    'affiliate_ids': np.int64,
+    'parent': np.int32,
+    'depth': np.int32,
+    'tin': np.int32,
+    'tout': np.int32,
+    'level_order': np.int32,
+    'level_tin': np.int32,
+    'level_start': np.int64
+}
+
+
+class CompactHierarchy:
+    """Árvore de afiliados em arrays com consultas de ancestrais e subárvore"""
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        for name in ARRAY_DTYPES:
+            setattr(self, name, arrays[name])
+        self.max_depth = len(self.level_start) - 2
+
+    def __len__(self) -> int:
+        return len(self.affiliate_ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Memória ocupada pelos arrays"""
+        return sum(getattr(self, name).nbytes for name in ARRAY_DTYPES)
+
+    # ------------------------------------------------------------------
+    # Construção
+    # ------------------------------------------------------------------
+
+    @classmethod
+    def build(cls, affiliate_ids: np.ndarray, parent_ids: np.ndarray) -> 'CompactHierarchy':
+        """Construir a estrutura a partir de pares (affiliate_id, parent_affiliate_id)
+
+        parent_ids usa 0 (ou um ID inexistente) para afiliados raiz.
+        """
+        order = np.argsort(affiliate_ids, kind='stable')
+        ids = np.asarray(affiliate_ids, dtype=np.int64)[order]
+        parents = np.asarray(parent_ids, dtype=np.int64)[order]
+        n = len(ids)
+
+        if n and np.any(ids[1:] == ids[:-1]):
+            raise ValueError("affiliate_id duplicado na hierarquia")
+
+        parent = _lookup(ids, parents).astype(np.int32)
+        depth = _compute_depth(parent)
+        tin, tout = _euler_tour(parent, depth)
+
+        max_depth = int(depth.max()) if n else -1
+        level_order = np.lexsort((tin, depth)).astype(np.int32)
+        level_start = np.searchsorted(depth[level_order], np.arange(max_depth + 2)).astype(np.int64)
+
+        return cls({
+            'affiliate_ids': ids,
+            'parent': parent,
+            'depth': depth,
+            'tin': tin,
+            'tout': tout,
+            'level_order': level_order,
+            'level_tin': tin[level_order],
+            'level_start': level_start
+        })
+
+    @classmethod
+    def from_database(cls, conn) -> 'CompactHierarchy':
+        """Carregar affiliates_optimized(affiliate_id, parent_affiliate_id) via COPY"""
+        start_time = time.time()
+        buffer = io.StringIO()
+
+        with conn.cursor() as cursor:
+            cursor.copy_expert("""
+                COPY (
+                    SELECT affiliate_id, COALESCE(parent_affiliate_id, 0)
+                    FROM fature_v2.affiliates_optimized
+                ) TO STDOUT
+            """, buffer)
+
+        buffer.seek(0)
+        if buffer.getvalue():
+            rows = np.loadtxt(buffer, dtype=np.int64, delimiter='\t', ndmin=2)
+        else:
+            rows = np.empty((0, 2), dtype=np.int64)
+
+        hierarchy = cls.build(rows[:, 0], rows[:, 1])
+        logger.info(f"Hierarquia compacta construída: {len(hierarchy)} afiliados, "
+                    f"profundidade máxima {hierarchy.max_depth}, "
+                    f"{hierarchy.nbytes / 1024 / 1024:.1f} MB "
+                    f"({(time.time() - start_time) * 1000:.0f}ms)")
+        return hierarchy
+
+    # ------------------------------------------------------------------
+    # Persistência
+    # ------------------------------------------------------------------
+
+    def save(self, path: str):
+        """Salvar arrays em arquivo único (cabeçalho JSON + arrays alinhados)"""
+        header = {'count': len(self), 'max_depth': self.max_depth, 'arrays': {}}
+
+        # Duas passadas: o tamanho do cabeçalho influencia os offsets
+        header_size = 0
+        for _ in range(2):
+            offset = _align(len(FILE_MAGIC) + 8 + header_size)
+            for name, dtype in ARRAY_DTYPES.items():
+                array = getattr(self, name)
+                header['arrays'][name] = {
+                    'dtype': np.dtype(dtype).str,
+                    'offset': offset,
+                    'length': len(array)
+                }
+                offset = _align(offset + array.nbytes)
+            encoded = json.dumps(header).encode()
+            header_size = len(encoded)
+
+        with open(path, 'wb') as f:
+            f.write(FILE_MAGIC)
+            f.write(np.uint64(len(encoded)).tobytes())
+            f.write(encoded)
+            for name, dtype in ARRAY_DTYPES.items():
+                info = header['arrays'][name]
+                f.write(b'\0' * (info['offset'] - f.tell()))
+                f.write(np.ascontiguousarray(getattr(self, name), dtype=dtype).tobytes())
+
+    @classmethod
+    def load(cls, path: str) -> 'CompactHierarchy':
+        """Abrir arquivo salvo por save() via memory-map (somente leitura)"""
+        with open(path, 'rb') as f:
+            if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+                raise ValueError(f"Arquivo {path} não é uma hierarquia compacta")
+            header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_size))
+
+        arrays = {}
+        for name, info in header['arrays'].items():
+            if info['length'] == 0:
+                arrays[name] = np.empty(0, dtype=np.dtype(info['dtype']))
+                continue
+            arrays[name] = np.memmap(path, dtype=np.dtype(info['dtype']), mode='r',
+                                     offset=info['offset'], shape=(info['length'],))
+        return cls(arrays)
+
+    # ------------------------------------------------------------------
+    # Consultas
+    # ------------------------------------------------------------------
+
+    def index_of(self, affiliate_id: int) -> int:
+        """Índice denso de um afiliado (KeyError se não existir)"""
+        position = int(np.searchsorted(self.affiliate_ids, affiliate_id))
+        if position >= len(self.affiliate_ids) or self.affiliate_ids[position] != affiliate_id:
+            raise KeyError(affiliate_id)
+        return position
+
+    def indices_of(self, affiliate_ids: np.ndarray) -> np.ndarray:
+        """Índices densos de vários afiliados (-1 para inexistentes)"""
+        return _lookup(self.affiliate_ids, np.asarray(affiliate_ids, dtype=np.int64))
+
+    def ancestors(self, affiliate_id: int, max_levels: int = 5) -> List[int]:
+        """Ancestrais do afiliado do nível 1 (pai) até max_levels"""
+        node = self.index_of(affiliate_id)
+        result = []
+
+        for _ in range(max_levels):
+            node = int(self.parent[node])
+            if node < 0:
+                break
+            result.append(int(self.affiliate_ids[node]))
+
+        return result
+
+    def is_in_network(self, affiliate_id: int, root_id: int) -> bool:
+        """Verificar se affiliate_id é descendente (direto ou indireto) de root_id"""
+        node = self.index_of(affiliate_id)
+        root = self.index_of(root_id)
+        return node != root and self.tin[root] < self.tin[node] < self.tout[root]
+
+    def network_size(self, affiliate_id: int) -> int:
+        """Tamanho total da rede (todos os descendentes)"""
+        node = self.index_of(affiliate_id)
+        return int(self.tout[node] - self.tin[node] - 1)
+
+    def network_by_level(self, affiliate_id: int, max_levels: int = 5) -> List[int]:
+        """Quantidade de descendentes em cada nível 1..max_levels"""
+        node = self.index_of(affiliate_id)
+        return self._level_counts(node, max_levels)
+
+    def level_range(self, node: int, level: int):
+        """Fatia de level_order com os descendentes de node exatamente `level` níveis abaixo"""
+        target_depth = int(self.depth[node]) + level
+        if target_depth > self.max_depth:
+            return 0, 0
+
+        start, end = int(self.level_start[target_depth]), int(self.level_start[target_depth + 1])
+        tins = self.level_tin[start:end]
+        return (start + int(np.searchsorted(tins, self.tin[node], side='right')),
+                start + int(np.searchsorted(tins, self.tout[node], side='left')))
+
+    def _level_counts(self, node: int, max_levels: int) -> List[int]:
+        counts = []
+        for level in range(1, max_levels + 1):
+            start, end = self.level_range(node, level)
+            counts.append(end - start)
+        return counts
+
+
+# ----------------------------------------------------------------------
+# Funções auxiliares de construção
+# ----------------------------------------------------------------------
+
+def _align(offset: int) -> int:
+    return (offset + FILE_ALIGNMENT - 1) // FILE_ALIGNMENT * FILE_ALIGNMENT
+
+
+def _lookup(sorted_ids: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """Posição de cada ID em sorted_ids (-1 quando ausente)"""
+    if len(sorted_ids) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return np.where(sorted_ids[positions] == ids, positions, -1)
+
+
+def _compute_depth(parent: np.ndarray) -> np.ndarray:
+    """Profundidade de cada nó por pointer jumping (O(n log profundidade))"""
+    n = len(parent)
+    depth = (parent >= 0).astype(np.int32)
+    jump = parent.astype(np.int64)
+
+    for _ in range(64):
+        active = jump >= 0
+        if not active.any():
+            return depth
+        targets = jump[active]
+        depth[active] += depth[targets]
+        jump[active] = jump[targets]
+
+    raise ValueError(f"Ciclo detectado na hierarquia ({n} afiliados)")
+
+
+def _euler_tour(parent: np.ndarray, depth: np.ndarray):
+    """Calcular intervalos [tin, tout) da pré-ordem sem recursão
+
+    Os tamanhos de subárvore são acumulados de baixo para cima por nível; em
+    seguida cada filho recebe tin = tin[pai] + 1 + soma dos tamanhos dos irmãos
+    anteriores (irmãos ordenados por affiliate_id).
+    """
+    n = len(parent)
+    size = np.ones(n, dtype=np.int64)
+    if n == 0:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+    by_depth = np.argsort(depth, kind='stable')
+    level_bounds = np.searchsorted(depth[by_depth], np.arange(int(depth.max()) + 2))
+    levels = [by_depth[level_bounds[d]:level_bounds[d + 1]] for d in range(len(level_bounds) - 1)]
+
+    for nodes in reversed(levels[1:]):
+        np.add.at(size, parent[nodes], size[nodes])
+
+    # Deslocamento de cada nó entre seus irmãos (raízes formam um único grupo)
+    group = np.where(parent >= 0, parent, -1)
+    sibling_order = np.lexsort((np.arange(n), group))
+    sorted_sizes = size[sibling_order]
+    cumulative = np.cumsum(sorted_sizes) - sorted_sizes
+    sorted_groups = group[sibling_order]
+    group_first = np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]
+    group_base = np.maximum.accumulate(np.where(group_first, cumulative, 0))
+    offset = np.empty(n, dtype=np.int64)
+    offset[sibling_order] = cumulative - group_base
+
+    tin = np.empty(n, dtype=np.int64)
+    tin[levels[0]] = offset[levels[0]]
+    for nodes in levels[1:]:
+        tin[nodes] = tin[parent[nodes]] + 1 + offset[nodes]
+
+    return tin.astype(np.int32), (tin + size).astype(np.int32)
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Uso: python compact_hierarchy.py [comando] [arquivo] [args]")
+        print("Comandos disponíveis:")
+        print("  build ARQUIVO                  - Construir a partir do banco e salvar")
+        print("  info ARQUIVO                   - Exibir estatísticas do arquivo")
+        print("  ancestors ARQUIVO ID [NIVEIS]  - Listar ancestrais de um afiliado")
+        print("  network ARQUIVO ID [NIVEIS]    - Tamanho da rede por nível")
+        print("  contains ARQUIVO RAIZ ID       - Verificar se ID está na rede de RAIZ")
+        sys.exit(1)
+
+    command, path = sys.argv[1], sys.argv[2]
+
+    if command == "build":
+        conn = psycopg2.connect(**database_config())
+        try:
+            hierarchy = CompactHierarchy.from_database(conn)
+        finally:
+            conn.close()
+        hierarchy.save(path)
+        logger.info(f"✅ Hierarquia salva em {path}")
+        sys.exit(0)
+
+    start_time = time.time()
+    hierarchy = CompactHierarchy.load(path)
+    load_ms = (time.time() - start_time) * 1000
+
+    try:
+        if command == "info":
+            print(f"Afiliados: {len(hierarchy):,}")
+            print(f"Profundidade máxima: {hierarchy.max_depth}")
+            print(f"Memória: {hierarchy.nbytes / 1024 / 1024:.1f} MB")
+            print(f"Abertura (mmap): {load_ms:.1f}ms")
+
+        elif command == "ancestors":
+            levels = int(sys.argv[4]) if len(sys.argv) > 4 else 5
+            print(hierarchy.ancestors(int(sys.argv[3]), levels))
+
+        elif command == "network":
+            levels = int(sys.argv[4]) if len(sys.argv) > 4 else 5
+            affiliate_id = int(sys.argv[3])
+            for level, count in enumerate(hierarchy.network_by_level(affiliate_id, levels), start=1):
+                print(f"Nível {level}: {count:,}")
+            print(f"Rede total: {hierarchy.network_size(affiliate_id):,}")
+
+        elif command == "contains":
+            print(hierarchy.is_in_network(int(sys.argv[4]), int(sys.argv[3])))
+
+        else:
+            print(f"Comando não reconhecido: {command}")
+            sys.exit(1)
+
+    except KeyError as e:
+        print(f"Afiliado não encontrado: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
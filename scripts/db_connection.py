@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Camada de Conexão Compartilhada - Fature CPA v2
+
+Centraliza a configuração do banco e mantém um pool de conexões thread-safe
+reutilizado pelos scripts operacionais, em vez de um psycopg2.connect por operação.
+
+Configuração (da maior para a menor prioridade):
+1. FATURE_DATABASE_URL ou DATABASE_URL (DSN/URI libpq, mesmo padrão do serviço Node)
+2. FATURE_DB_HOST, FATURE_DB_PORT, FATURE_DB_NAME, FATURE_DB_USER, FATURE_DB_PASSWORD
+3. arquivo JSON em FATURE_DB_CONFIG (padrão: scripts/db_config.json, fora do git)
+4. valores padrão de DEFAULT_DATABASE (sem senha: sem DSN, a senha precisa vir de
+   FATURE_DB_PASSWORD ou do arquivo de configuração)
+
+Cada uso aplica um perfil de sessão (SESSION_PROFILES): statement_timeout,
+work_mem, synchronous_commit etc., além de application_name = fature-<perfil>
+para identificar a origem em pg_stat_activity e nos logs do servidor, e
+fature.slow_query_ms (limite de consulta lenta lido pela view real_time_metrics).
+
+O RESET ALL só roda quando o perfil da conexão muda. Parâmetros alterados por quem
+usa a conexão (search_path, session_replication_role...) devem usar SET LOCAL, que
+termina com a transação; um SET de sessão seguido de COMMIT passaria para o próximo
+usuário da mesma conexão.
+
+As conexões do pool usam InstrumentedConnection (query_instrumentation): os
+comandos feitos nos perfis habilitados são registrados em query_performance_log.
+"""
+
+import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+import logging
+import threading
+import time
+import json
+import os
+from contextlib import contextmanager
+from typing import Dict, Optional
+import sys
+
+from query_instrumentation import InstrumentedConnection, configure_recorder, SLOW_QUERY_MS
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = os.environ.get(
+    'FATURE_DB_CONFIG',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db_config.json')
+)
+
+DEFAULT_DATABASE = {
+    'host': 'hopper.proxy.rlwy.net',
+    'port': 48603,
+    'database': 'railway',
+    'user': 'postgres'
+}
+
+ENV_FIELDS = {
+    'host': 'FATURE_DB_HOST',
+    'port': 'FATURE_DB_PORT',
+    'database': 'FATURE_DB_NAME',
+    'user': 'FATURE_DB_USER',
+    'password': 'FATURE_DB_PASSWORD'
+}
+
+# Parâmetros de sessão por caso de uso
+SESSION_PROFILES = {
+    'default': {
+        'statement_timeout': '60s'
+    },
+    'migration': {
+        'statement_timeout': '300s',
+        'work_mem': '64MB',
+        'maintenance_work_mem': '512MB',
+        # A migração é reexecutável e validada ao final
+        'synchronous_commit': 'off'
+    },
+    'bulk_load': {
+        'statement_timeout': '0',
+        'work_mem': '64MB',
+        'synchronous_commit': 'off'
+    },
+    'monitor': {
+        'statement_timeout': '15s',
+        'work_mem': '16MB',
+        'lock_timeout': '2s'
+    },
+    'rollback': {
+        'statement_timeout': '0',
+        'lock_timeout': '30s',
+        'work_mem': '64MB'
+    },
+    'report': {
+        'statement_timeout': '120s',
+        'work_mem': '128MB'
+    },
+    # Transações financeiras: COMMIT durável e tempo limitado
+    'payout': {
+        'statement_timeout': '600s',
+        'lock_timeout': '30s',
+        'work_mem': '64MB',
+        'synchronous_commit': 'on'
+    }
+}
+
+POOL_SETTINGS = {
+    'min_connections': 1,
+    'max_connections': 10,
+    'checkout_timeout_seconds': 30,
+    # Conexões ociosas por mais tempo que isso recebem um SELECT 1 antes de serem entregues
+    'health_check_idle_seconds': 30
+}
+
+
+def database_config() -> Dict:
+    """Parâmetros de conexão a partir do ambiente, do arquivo de configuração ou dos padrões"""
+    url = os.environ.get('FATURE_DATABASE_URL') or os.environ.get('DATABASE_URL')
+    if url:
+        return {'dsn': url}
+
+    config = dict(DEFAULT_DATABASE)
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE) as f:
+            config.update(json.load(f))
+
+    for field, variable in ENV_FIELDS.items():
+        if os.environ.get(variable):
+            config[field] = os.environ[variable]
+
+    if not config.get('password'):
+        raise ValueError("Senha do banco não configurada: defina FATURE_DATABASE_URL, "
+                         f"FATURE_DB_PASSWORD ou 'password' em {CONFIG_FILE}")
+
+    config['port'] = int(config['port'])
+    return config
+
+
+class FatureConnectionPool:
+    """Pool thread-safe com verificação de saúde e perfis de sessão"""
+
+    def __init__(self, params: Dict, settings: Optional[Dict] = None):
+        self.params = dict(params)
+        self.settings = dict(POOL_SETTINGS, **(settings or {}))
+
+        configure_recorder(self.params)
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            self.settings['min_connections'], self.settings['max_connections'],
+            connection_factory=InstrumentedConnection, **self.params
+        )
+        self._slots = threading.BoundedSemaphore(self.settings['max_connections'])
+        self._lock = threading.Lock()
+        self._profiles = {}      # id(conn) -> perfil aplicado
+        self._last_used = {}     # id(conn) -> time.monotonic() da devolução
+
+        self.stats = {'checkouts': 0, 'health_checks': 0, 'replaced': 0, 'profile_changes': 0}
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+
+        last_used = self._last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < self.settings['health_check_idle_seconds']:
+            return True
+
+        self.stats['health_checks'] += 1
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _apply_profile(self, conn, profile: str):
+        """Aplicar parâmetros do perfil (apenas quando mudam em relação ao último uso)"""
+        if self._profiles.get(id(conn)) == profile:
+            return
+
+        # Comandos de configuração da sessão não entram na instrumentação
+        conn.fature_profile = None
+        settings = dict(SESSION_PROFILES[profile], application_name=f"fature-{profile}")
+        settings['fature.slow_query_ms'] = SLOW_QUERY_MS
+        with conn.cursor() as cursor:
+            cursor.execute("RESET ALL;")
+            for name, value in settings.items():
+                cursor.execute("SELECT set_config(%s, %s, false)", (name, str(value)))
+        conn.commit()
+
+        conn.fature_profile = profile
+        self._profiles[id(conn)] = profile
+        self.stats['profile_changes'] += 1
+
+    def getconn(self, profile: str = 'default'):
+        """Retirar uma conexão do pool (bloqueia até checkout_timeout_seconds)"""
+        if profile not in SESSION_PROFILES:
+            raise ValueError(f"Perfil de sessão desconhecido: {profile}")
+
+        if not self._slots.acquire(timeout=self.settings['checkout_timeout_seconds']):
+            raise psycopg2.pool.PoolError("Tempo esgotado aguardando conexão livre no pool")
+
+        try:
+            with self._lock:
+                conn = self._pool.getconn()
+                if not self._is_healthy(conn):
+                    logger.warning("Conexão inválida descartada do pool")
+                    self._forget(conn)
+                    self._pool.putconn(conn, close=True)
+                    self.stats['replaced'] += 1
+                    conn = self._pool.getconn()
+                self.stats['checkouts'] += 1
+
+        except Exception:
+            self._slots.release()
+            raise
+
+        try:
+            conn.autocommit = False
+            self._apply_profile(conn, profile)
+        except Exception:
+            # Sessão em estado desconhecido: descartar a conexão e liberar a vaga
+            with self._lock:
+                self._forget(conn)
+                self._pool.putconn(conn, close=True)
+            self._slots.release()
+            raise
+
+        return conn
+
+    def putconn(self, conn, close: bool = False):
+        """Devolver conexão ao pool, descartando-a se estiver fechada ou com erro"""
+        try:
+            if not conn.closed:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                conn.autocommit = False
+        except psycopg2.Error:
+            close = True
+
+        with self._lock:
+            if close or conn.closed:
+                self._forget(conn)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn, close=close or bool(conn.closed))
+        self._slots.release()
+
+    def _forget(self, conn):
+        self._profiles.pop(id(conn), None)
+        self._last_used.pop(id(conn), None)
+
+    @contextmanager
+    def connection(self, profile: str = 'default'):
+        """Conexão do pool com COMMIT ao final do bloco e ROLLBACK em caso de exceção
+        
+        Alterações de parâmetros dentro do bloco devem usar SET LOCAL (ver docstring do módulo).
+        """
+        conn = self.getconn(profile)
+        try:
+            yield conn
+            if not conn.closed:
+                conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._lock:
+            self._pool.closeall()
+            self._profiles.clear()
+            self._last_used.clear()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(params: Optional[Dict] = None) -> FatureConnectionPool:
+    """Pool compartilhado do processo para os parâmetros de conexão informados"""
+    params = params or database_config()
+    key = tuple(sorted((name, str(value)) for name, value in params.items()))
+
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = FatureConnectionPool(params)
+            _pools[key] = pool
+        return pool
+
+
+def close_pools():
+    """Fechar todas as conexões de todos os pools do processo"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Uso: python db_connection.py [comando]")
+        print("Comandos disponíveis:")
+        print("  check [PERFIL]  - Testar conexão e exibir os parâmetros de sessão aplicados")
+        print("  profiles        - Listar perfis de sessão")
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    if command == "check":
+        profile = sys.argv[2] if len(sys.argv) > 2 else 'default'
+        params = database_config()
+        if 'dsn' in params:
+            target = psycopg2.extensions.parse_dsn(params['dsn']).get('host', 'dsn')
+        else:
+            target = f"{params['host']}:{params['port']}/{params['database']}"
+
+        try:
+            start_time = time.time()
+            with get_pool(params).connection(profile) as conn:
+                with conn.cursor() as cursor:
+                    settings = list(SESSION_PROFILES[profile]) + ['application_name']
+                    values = {}
+                    for name in settings:
+                        cursor.execute("SELECT current_setting(%s)", (name,))
+                        values[name] = cursor.fetchone()[0]
+            elapsed = (time.time() - start_time) * 1000
+
+            print(f"✅ Conectado a {target} ({elapsed:.0f}ms)")
+            for name, value in values.items():
+                print(f"   {name} = {value}")
+            sys.exit(0)
+
+        except Exception as e:
+            print(f"❌ Falha ao conectar a {target}: {e}")
+            sys.exit(1)
+
+        finally:
+            close_pools()
+
+    elif command == "profiles":
+        print(json.dumps(SESSION_PROFILES, indent=2))
+        sys.exit(0)
+
+    else:
+        print(f"Comando não reconhecido: {command}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Totais da Rede (Downline) - Fature CPA v2
+
+Soma total_deposits, total_bets e total_ggr de toda a rede de um afiliado, no
+total e por nível, sem passar pela tabela de closure (hierarchy_index).
+
+Dois caminhos:
+
+- memória: sobre a CompactHierarchy, os valores são dispostos na ordem do Euler
+  tour (tin) e na ordem (profundidade, tin); somas prefixadas nessas ordens dão o
+  total da rede com uma subtração e o total de cada nível com duas buscas binárias.
+  Consultas em lote são vetorizadas (numpy), na casa de milissegundos mesmo para
+  milhares de afiliados. Os valores são um snapshot do momento da carga.
+- SQL: uma varredura de intervalo no índice btree de hierarchy_path. Como os rótulos
+  são numéricos, a rede de X é exatamente o intervalo (X.path, X.path || 'z') na
+  ordenação do ltree; útil para consultas pontuais com dados atuais.
+
+Valores são tratados em centavos (inteiros) para que as somas sejam exatas.
+"""
+
+import psycopg2
+import numpy as np
+import logging
+import time
+import io
+from typing import Dict, List
+import sys
+
+from db_connection import database_config, get_pool
+from compact_hierarchy import CompactHierarchy
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+METRICS = ['total_deposits', 'total_bets', 'total_ggr']
+
+
+class DownlineTotals:
+    """Somas prefixadas dos valores dos afiliados sobre a hierarquia compacta"""
+
+    def __init__(self, hierarchy: CompactHierarchy, values: np.ndarray):
+        """values: matriz (afiliados x METRICS) em centavos, na ordem de hierarchy.affiliate_ids"""
+        self.hierarchy = hierarchy
+        n = len(hierarchy)
+        zeros = np.zeros((1, values.shape[1]), dtype=np.int64)
+
+        by_tin = np.empty_like(values)
+        by_tin[hierarchy.tin] = values
+        self.values = values
+        self.tin_prefix = np.vstack([zeros, np.cumsum(by_tin, axis=0)])
+        self.level_prefix = np.vstack([zeros, np.cumsum(values[hierarchy.level_order], axis=0)])
+
+        # Chave (profundidade, tin) crescente em level_order: permite buscar o intervalo
+        # de um nível para vários afiliados de uma vez
+        self.stride = n + 1
+        self.level_key = hierarchy.depth[hierarchy.level_order].astype(np.int64) * self.stride \
+            + hierarchy.level_tin
+
+    def query(self, affiliate_ids: List[int], max_levels: int = 5) -> Dict[str, np.ndarray]:
+        """Totais em lote
+
+        Retorna arrays alinhados com affiliate_ids (centavos; zeros para inexistentes):
+        - found: afiliado existe na hierarquia
+        - own: (k, métricas) valores do próprio afiliado
+        - network: (k, métricas) soma de todos os descendentes
+        - network_size: (k,) quantidade de descendentes
+        - levels: (k, max_levels, métricas) soma por nível 1..max_levels
+        - level_sizes: (k, max_levels) quantidade de afiliados por nível
+        """
+        h = self.hierarchy
+        nodes = h.indices_of(np.asarray(affiliate_ids, dtype=np.int64))
+        found = nodes >= 0
+        nodes = np.where(found, nodes, 0)
+        metrics = self.values.shape[1]
+
+        tin = h.tin[nodes].astype(np.int64)
+        tout = h.tout[nodes].astype(np.int64)
+        depth = h.depth[nodes].astype(np.int64)
+
+        levels = np.zeros((len(nodes), max_levels, metrics), dtype=np.int64)
+        level_sizes = np.zeros((len(nodes), max_levels), dtype=np.int64)
+        for level in range(1, max_levels + 1):
+            base = (depth + level) * self.stride
+            start = np.searchsorted(self.level_key, base + tin, side='right')
+            end = np.searchsorted(self.level_key, base + tout, side='left')
+            levels[:, level - 1] = self.level_prefix[end] - self.level_prefix[start]
+            level_sizes[:, level - 1] = end - start
+
+        mask = found[:, None]
+        return {
+            'found': found,
+            'own': np.where(mask, self.values[nodes], 0),
+            'network': np.where(mask, self.tin_prefix[tout] - self.tin_prefix[tin + 1], 0),
+            'network_size': np.where(found, tout - tin - 1, 0),
+            'levels': np.where(mask[:, :, None], levels, 0),
+            'level_sizes': np.where(mask, level_sizes, 0)
+        }
+
+
+class FatureDownlineTotals:
+    """Consultas de totais da rede (memória ou SQL)"""
+
+    def __init__(self):
+        self.config = {
+            'database': database_config(),
+            # Arquivo salvo por compact_hierarchy.py build (None = construir do banco)
+            'hierarchy_file': None,
+            'max_levels': 5
+        }
+        self.totals = None
+
+    def connection(self, profile: str = 'report'):
+        """Conexão do pool compartilhado (devolvida ao final do bloco with)"""
+        return get_pool(self.config['database']).connection(profile)
+
+    def load(self) -> DownlineTotals:
+        """Carregar hierarquia e valores (snapshot) para consultas em memória"""
+        start_time = time.time()
+
+        with self.connection() as conn:
+            if self.config['hierarchy_file']:
+                hierarchy = CompactHierarchy.load(self.config['hierarchy_file'])
+            else:
+                hierarchy = CompactHierarchy.from_database(conn)
+
+            buffer = io.StringIO()
+            with conn.cursor() as cursor:
+                cursor.copy_expert(f"""
+                    COPY (
+                        SELECT affiliate_id, {', '.join(f'(COALESCE({m}, 0) * 100)::BIGINT' for m in METRICS)}
+                        FROM fature_v2.affiliates_optimized
+                    ) TO STDOUT
+                """, buffer)
+
+        values = np.zeros((len(hierarchy), len(METRICS)), dtype=np.int64)
+        buffer.seek(0)
+        if buffer.getvalue():
+            rows = np.loadtxt(buffer, dtype=np.int64, delimiter='\t', ndmin=2)
+            positions = hierarchy.indices_of(rows[:, 0])
+            present = positions >= 0
+            values[positions[present]] = rows[present, 1:]
+
+        self.totals = DownlineTotals(hierarchy, values)
+        logger.info(f"Totais da rede carregados: {len(hierarchy)} afiliados "
+                    f"({(time.time() - start_time) * 1000:.0f}ms)")
+        return self.totals
+
+    def network_totals(self, affiliate_ids: List[int], max_levels: int = None) -> Dict[int, Dict]:
+        """Totais da rede por afiliado (memória), em reais"""
+        if self.totals is None:
+            self.load()
+        max_levels = max_levels or self.config['max_levels']
+        result = self.totals.query(affiliate_ids, max_levels)
+
+        report = {}
+        for i, affiliate_id in enumerate(affiliate_ids):
+            if not result['found'][i]:
+                continue
+            report[affiliate_id] = {
+                'network_size': int(result['network_size'][i]),
+                'network': _metrics_dict(result['network'][i]),
+                'levels': [
+                    dict(level=level + 1, affiliates=int(result['level_sizes'][i, level]),
+                         **_metrics_dict(result['levels'][i, level]))
+                    for level in range(max_levels)
+                ]
+            }
+        return report
+
+    def network_totals_sql(self, affiliate_ids: List[int], max_levels: int = None) -> Dict[int, Dict]:
+        """Totais da rede por afiliado direto no banco (intervalo btree em hierarchy_path)"""
+        max_levels = max_levels or self.config['max_levels']
+        report = {}
+
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f"""
+                    SELECT
+                        x.affiliate_id,
+                        a.hierarchy_level - x.hierarchy_level AS level,
+                        COUNT(*),
+                        {', '.join(f'SUM((COALESCE(a.{m}, 0) * 100)::BIGINT)' for m in METRICS)}
+                    FROM fature_v2.affiliates_optimized x
+                    JOIN fature_v2.affiliates_optimized a
+                      ON a.hierarchy_path > x.hierarchy_path
+                     AND a.hierarchy_path < x.hierarchy_path || 'z'
+                    WHERE x.affiliate_id = ANY(%s)
+                    GROUP BY x.affiliate_id, a.hierarchy_level - x.hierarchy_level
+                """, (list(affiliate_ids),))
+                rows = cursor.fetchall()
+
+                # Afiliados sem rede também entram no resultado
+                cursor.execute("""
+                    SELECT affiliate_id FROM fature_v2.affiliates_optimized WHERE affiliate_id = ANY(%s)
+                """, (list(affiliate_ids),))
+                for (affiliate_id,) in cursor.fetchall():
+                    report[affiliate_id] = {
+                        'network_size': 0,
+                        'network': np.zeros(len(METRICS), dtype=np.int64),
+                        'levels': [[0, np.zeros(len(METRICS), dtype=np.int64)] for _ in range(max_levels)]
+                    }
+
+        for affiliate_id, level, count, *sums in rows:
+            entry = report[affiliate_id]
+            values = np.array([int(s) for s in sums], dtype=np.int64)
+            entry['network_size'] += count
+            entry['network'] += values
+            if level <= max_levels:
+                entry['levels'][level - 1] = [count, values]
+
+        for entry in report.values():
+            entry['network'] = _metrics_dict(entry['network'])
+            entry['levels'] = [
+                dict(level=level + 1, affiliates=count, **_metrics_dict(values))
+                for level, (count, values) in enumerate(entry['levels'])
+            ]
+        return report
+
+
+def _metrics_dict(cents: np.ndarray) -> Dict[str, float]:
+    return {metric: int(value) / 100 for metric, value in zip(METRICS, cents)}
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Uso: python downline_totals.py [comando] ID... [--niveis N] [--arquivo HIERARQUIA]")
+        print("Comandos disponíveis:")
+        print("  network ID...  - Totais da rede em memória (Euler tour + somas prefixadas)")
+        print("  sql ID...      - Totais da rede direto no banco (intervalo btree em hierarchy_path)")
+        sys.exit(1)
+
+    command = sys.argv[1]
+    args = sys.argv[2:]
+    job = FatureDownlineTotals()
+
+    if '--niveis' in args:
+        position = args.index('--niveis')
+        job.config['max_levels'] = int(args[position + 1])
+        del args[position:position + 2]
+    if '--arquivo' in args:
+        position = args.index('--arquivo')
+        job.config['hierarchy_file'] = args[position + 1]
+        del args[position:position + 2]
+    affiliate_ids = [int(a) for a in args]
+
+    try:
+        if command == "network":
+            job.load()
+            start_time = time.time()
+            report = job.network_totals(affiliate_ids)
+        elif command == "sql":
+            start_time = time.time()
+            report = job.network_totals_sql(affiliate_ids)
+        else:
+            print(f"Comando não reconhecido: {command}")
+            sys.exit(1)
+        elapsed_ms = (time.time() - start_time) * 1000
+
+    except psycopg2.Error as e:
+        logger.error(f"Erro ao consultar totais da rede: {e}")
+        sys.exit(1)
+
+    for affiliate_id in affiliate_ids:
+        entry = report.get(affiliate_id)
+        if entry is None:
+            print(f"❌ Afiliado {affiliate_id} não encontrado")
+            continue
+        network = entry['network']
+        print(f"=== AFILIADO {affiliate_id} (rede: {entry['network_size']:,}) ===")
+        print(f"Depósitos: R$ {network['total_deposits']:,.2f} | Apostas: R$ {network['total_bets']:,.2f} "
+              f"| GGR: R$ {network['total_ggr']:,.2f}")
+        for level in entry['levels']:
+            print(f"  Nível {level['level']}: {level['affiliates']:,} afiliados, "
+                  f"GGR R$ {level['total_ggr']:,.2f}")
+    print(f"Consulta: {elapsed_ms:.1f}ms")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Manutenção da Hierarquia - Fature CPA v2
+
+Movimentação de afiliados (troca de parent_affiliate_id) com manutenção
+incremental da closure table, sem reconstruir o índice completo com
+build_complete_hierarchy_index.
+
+Para mover a subárvore de X (tamanho s, X incluso) para baixo de um novo pai:
+
+1. hierarchy_path de toda a subárvore reescrito em um único UPDATE
+   (novo prefixo || subpath do caminho antigo a partir de X)
+2. hierarchy_index: removidos apenas os pares (ancestral antigo de X, nó da
+   subárvore) e inseridos os pares (novo ancestral, nó da subárvore); os pares
+   internos da subárvore não mudam
+3. contadores: direct_referrals_count do pai antigo/novo e total_network_size
+   das duas cadeias de ancestrais (-s / +s; ancestrais comuns não mudam)
+
+Custo proporcional a s x profundidade, independente do tamanho da árvore.
+
+Concorrência: movimentações são serializadas por advisory lock (MOVE_LOCK_KEY) e
+todas as linhas da subárvore ficam bloqueadas (FOR UPDATE) antes de serem lidas.
+Inserções de afiliados precisam ler o caminho do pai com FOR SHARE (como faz o
+gatilho update_hierarchy_on_insert) ou tomar o mesmo advisory lock; caso contrário,
+um novo filho de um nó da subárvore pode ser gravado com o caminho anterior à
+movimentação e ficar fora dela em hierarchy_path e hierarchy_index.
+"""
+
+import psycopg2
+import logging
+import time
+import json
+from typing import Dict, List, Optional
+import sys
+
+from db_connection import database_config, get_pool
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Chave do advisory lock que serializa movimentações concorrentes
+MOVE_LOCK_KEY = 770370
+
+
+class FatureHierarchyMaintenance:
+    """Operações de manutenção da hierarquia de afiliados"""
+
+    def __init__(self):
+        self.config = {
+            'database': database_config()
+        }
+
+    def connection(self, profile: str = 'default'):
+        """Conexão do pool compartilhado (devolvida ao final do bloco with)"""
+        return get_pool(self.config['database']).connection(profile)
+
+    def _load_node(self, cursor, affiliate_id: int) -> Optional[Dict]:
+        cursor.execute("""
+            SELECT affiliate_id, parent_affiliate_id, hierarchy_path::text, hierarchy_level
+            FROM fature_v2.affiliates_optimized
+            WHERE affiliate_id = %s
+            FOR UPDATE
+        """, (affiliate_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return {
+            'affiliate_id': row[0],
+            'parent_id': row[1],
+            'path': row[2],
+            'level': row[3],
+            'ancestors': [int(label) for label in row[2].split('.')[:-1]]
+        }
+
+    def move_subtree(self, affiliate_id: int, new_parent_id: Optional[int]) -> Dict:
+        """Mover o afiliado e toda a sua rede para baixo de new_parent_id (None = raiz)"""
+        start_time = time.time()
+        result = {'affiliate_id': affiliate_id, 'new_parent_id': new_parent_id, 'moved': False}
+
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MOVE_LOCK_KEY,))
+
+                node = self._load_node(cursor, affiliate_id)
+                if node is None:
+                    raise ValueError(f"Afiliado {affiliate_id} não encontrado")
+
+                if new_parent_id is not None:
+                    if new_parent_id == affiliate_id:
+                        raise ValueError("Um afiliado não pode ser pai de si mesmo")
+                    parent = self._load_node(cursor, new_parent_id)
+                    if parent is None:
+                        raise ValueError(f"Novo pai {new_parent_id} não encontrado")
+                    if affiliate_id in parent['ancestors']:
+                        raise ValueError(f"Novo pai {new_parent_id} pertence à rede de {affiliate_id} (ciclo)")
+                    new_ancestors = parent['ancestors'] + [new_parent_id]
+                    new_prefix = parent['path']
+                else:
+                    new_ancestors = []
+                    new_prefix = None
+
+                result['old_parent_id'] = node['parent_id']
+                if node['parent_id'] == new_parent_id:
+                    result['duration_ms'] = int((time.time() - start_time) * 1000)
+                    return result
+
+                old_ancestors = node['ancestors']
+                level_delta = len(new_ancestors) - len(old_ancestors)
+
+                # Bloquear a subárvore antes de lê-la: inserções sob qualquer nó dela esperam
+                # o COMMIT e então leem o caminho novo; inserções já em andamento terminam
+                # antes e entram na leitura abaixo (comando seguinte, snapshot novo)
+                cursor.execute("""
+                    SELECT COUNT(*) FROM (
+                        SELECT affiliate_id
+                        FROM fature_v2.affiliates_optimized
+                        WHERE hierarchy_path <@ %s::ltree
+                        ORDER BY affiliate_id
+                        FOR UPDATE
+                    ) locked
+                """, (node['path'],))
+
+                # Subárvore com a profundidade relativa a X (0 = o próprio X)
+                cursor.execute("""
+                    CREATE TEMP TABLE tmp_moved_subtree (
+                        affiliate_id BIGINT PRIMARY KEY,
+                        relative_depth INTEGER NOT NULL
+                    ) ON COMMIT DROP;
+
+                    INSERT INTO tmp_moved_subtree (affiliate_id, relative_depth)
+                    SELECT affiliate_id, hierarchy_level - %(level)s
+                    FROM fature_v2.affiliates_optimized
+                    WHERE hierarchy_path <@ %(path)s::ltree;
+
+                    ANALYZE tmp_moved_subtree;
+                """, {'level': node['level'], 'path': node['path']})
+                cursor.execute("SELECT COUNT(*) FROM tmp_moved_subtree")
+                subtree_size = cursor.fetchone()[0]
+
+                # 1. Caminhos e níveis da subárvore
+                offset = len(old_ancestors)
+                if new_prefix is None:
+                    new_path_sql = "subpath(a.hierarchy_path, %(offset)s)"
+                else:
+                    new_path_sql = "%(prefix)s::ltree || subpath(a.hierarchy_path, %(offset)s)"
+
+                cursor.execute(f"""
+                    UPDATE fature_v2.affiliates_optimized a
+                    SET hierarchy_path = {new_path_sql},
+                        hierarchy_level = a.hierarchy_level + %(level_delta)s,
+                        parent_affiliate_id = CASE WHEN a.affiliate_id = %(affiliate_id)s
+                                                   THEN %(new_parent_id)s
+                                                   ELSE a.parent_affiliate_id END,
+                        updated_at = NOW()
+                    FROM tmp_moved_subtree s
+                    WHERE a.affiliate_id = s.affiliate_id
+                """, {'offset': offset, 'prefix': new_prefix, 'level_delta': level_delta,
+                      'affiliate_id': affiliate_id, 'new_parent_id': new_parent_id})
+
+                # 2. Pares da closure table que cruzam a fronteira da subárvore
+                removed = inserted = 0
+                if old_ancestors:
+                    cursor.execute("""
+                        DELETE FROM fature_v2.hierarchy_index hi
+                        USING tmp_moved_subtree s
+                        WHERE hi.descendant_id = s.affiliate_id
+                          AND hi.ancestor_id = ANY(%s)
+                    """, (old_ancestors,))
+                    removed = cursor.rowcount
+
+                if new_ancestors:
+                    # Distância de cada novo ancestral até X (pai = 1)
+                    distances = list(range(len(new_ancestors), 0, -1))
+                    cursor.execute("""
+                        INSERT INTO fature_v2.hierarchy_index (ancestor_id, descendant_id, level_distance)
+                        SELECT n.ancestor_id, s.affiliate_id, s.relative_depth + n.distance
+                        FROM tmp_moved_subtree s
+                        CROSS JOIN unnest(%s::BIGINT[], %s::INTEGER[]) AS n(ancestor_id, distance)
+                    """, (new_ancestors, distances))
+                    inserted = cursor.rowcount
+
+                # 3. Contadores das duas cadeias de ancestrais
+                deltas = {}
+                for ancestor in old_ancestors:
+                    deltas[ancestor] = deltas.get(ancestor, 0) - subtree_size
+                for ancestor in new_ancestors:
+                    deltas[ancestor] = deltas.get(ancestor, 0) + subtree_size
+
+                direct = {}
+                if node['parent_id'] is not None:
+                    direct[node['parent_id']] = -1
+                if new_parent_id is not None:
+                    direct[new_parent_id] = 1
+
+                changes = sorted(
+                    (ancestor, deltas.get(ancestor, 0), direct.get(ancestor, 0))
+                    for ancestor in set(deltas) | set(direct)
+                    if deltas.get(ancestor, 0) or direct.get(ancestor, 0)
+                )
+                if changes:
+                    # Bloqueio em ordem de affiliate_id evita deadlock com outras atualizações de contadores
+                    cursor.execute("""
+                        SELECT affiliate_id FROM fature_v2.affiliates_optimized
+                        WHERE affiliate_id = ANY(%s)
+                        ORDER BY affiliate_id
+                        FOR UPDATE
+                    """, ([change[0] for change in changes],))
+
+                    cursor.execute("""
+                        UPDATE fature_v2.affiliates_optimized a
+                        SET total_network_size = a.total_network_size + c.network_delta,
+                            direct_referrals_count = a.direct_referrals_count + c.direct_delta,
+                            updated_at = NOW()
+                        FROM unnest(%s::BIGINT[], %s::INTEGER[], %s::INTEGER[])
+                             AS c(affiliate_id, network_delta, direct_delta)
+                        WHERE a.affiliate_id = c.affiliate_id
+                    """, ([c[0] for c in changes], [c[1] for c in changes], [c[2] for c in changes]))
+
+                result.update({
+                    'moved': True,
+                    'subtree_size': subtree_size,
+                    'level_delta': level_delta,
+                    'pairs_removed': removed,
+                    'pairs_inserted': inserted,
+                    'counters_updated': len(changes),
+                    'duration_ms': int((time.time() - start_time) * 1000)
+                })
+
+                cursor.execute("""
+                    INSERT INTO fature_v2.system_log (operation, details)
+                    VALUES ('move_subtree', %s)
+                """, (json.dumps(result),))
+
+        logger.info(f"✅ Afiliado {affiliate_id} movido de {result['old_parent_id']} para {new_parent_id}: "
+                    f"{subtree_size} afiliados, -{removed}/+{inserted} pares em {result['duration_ms']}ms")
+        return result
+
+    def verify_subtree(self, affiliate_id: int) -> Dict:
+        """Conferir closure table e contadores da subárvore e da cadeia de ancestrais"""
+        checks = {}
+
+        with self.connection('report') as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT hierarchy_path::text FROM fature_v2.affiliates_optimized WHERE affiliate_id = %s
+                """, (affiliate_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    raise ValueError(f"Afiliado {affiliate_id} não encontrado")
+                path = row[0]
+
+                # Pares esperados: cada nó tem um par por ancestral do seu caminho
+                cursor.execute("""
+                    SELECT
+                        (SELECT COALESCE(SUM(nlevel(hierarchy_path) - 1), 0)
+                         FROM fature_v2.affiliates_optimized WHERE hierarchy_path <@ %(path)s::ltree),
+                        (SELECT COUNT(*)
+                         FROM fature_v2.hierarchy_index hi
+                         JOIN fature_v2.affiliates_optimized d ON d.affiliate_id = hi.descendant_id
+                         WHERE d.hierarchy_path <@ %(path)s::ltree),
+                        (SELECT COUNT(*)
+                         FROM fature_v2.hierarchy_index hi
+                         JOIN fature_v2.affiliates_optimized d ON d.affiliate_id = hi.descendant_id
+                         JOIN fature_v2.affiliates_optimized a ON a.affiliate_id = hi.ancestor_id
+                         WHERE d.hierarchy_path <@ %(path)s::ltree
+                           AND NOT (a.hierarchy_path @> d.hierarchy_path
+                                    AND nlevel(d.hierarchy_path) - nlevel(a.hierarchy_path) = hi.level_distance))
+                """, {'path': path})
+                expected_pairs, actual_pairs, wrong_pairs = cursor.fetchone()
+                checks['closure_pairs'] = expected_pairs == actual_pairs and wrong_pairs == 0
+
+                cursor.execute("""
+                    SELECT COUNT(*) FROM fature_v2.affiliates_optimized a
+                    WHERE a.hierarchy_path <@ %(path)s::ltree
+                      AND a.parent_affiliate_id IS DISTINCT FROM
+                          (CASE WHEN nlevel(a.hierarchy_path) > 1
+                                THEN subpath(a.hierarchy_path, -2, 1)::text::BIGINT END)
+                """, {'path': path})
+                checks['parent_matches_path'] = cursor.fetchone()[0] == 0
+
+                ancestors = [int(label) for label in path.split('.')]
+                cursor.execute("""
+                    SELECT a.affiliate_id, a.total_network_size, a.direct_referrals_count,
+                           (SELECT COUNT(*) FROM fature_v2.affiliates_optimized d
+                            WHERE d.hierarchy_path <@ a.hierarchy_path) - 1,
+                           (SELECT COUNT(*) FROM fature_v2.affiliates_optimized c
+                            WHERE c.parent_affiliate_id = a.affiliate_id)
+                    FROM fature_v2.affiliates_optimized a
+                    WHERE a.affiliate_id = ANY(%s)
+                """, (ancestors,))
+                mismatches = [
+                    {'affiliate_id': r[0], 'network_size': r[1], 'expected_network_size': r[3],
+                     'direct_referrals': r[2], 'expected_direct_referrals': r[4]}
+                    for r in cursor.fetchall() if r[1] != r[3] or r[2] != r[4]
+                ]
+                checks['ancestor_counters'] = not mismatches
+
+        return {
+            'affiliate_id': affiliate_id,
+            'valid': all(checks.values()),
+            'checks': checks,
+            'expected_pairs': expected_pairs,
+            'actual_pairs': actual_pairs,
+            'counter_mismatches': mismatches
+        }
+
+
+def main():
+    maintenance = FatureHierarchyMaintenance()
+
+    if len(sys.argv) < 2:
+        print("Uso: python hierarchy_maintenance.py [comando]")
+        print("Comandos disponíveis:")
+        print("  move AFILIADO NOVO_PAI   - Mover afiliado e sua rede (NOVO_PAI = 'root' para tornar raiz)")
+        print("  verify AFILIADO          - Conferir closure table e contadores da rede do afiliado")
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    try:
+        if command == "move" and len(sys.argv) > 3:
+            affiliate_id = int(sys.argv[2])
+            new_parent_id = None if sys.argv[3] == 'root' else int(sys.argv[3])
+            result = maintenance.move_subtree(affiliate_id, new_parent_id)
+            print(json.dumps(result, indent=2))
+            sys.exit(0)
+
+        elif command == "verify" and len(sys.argv) > 2:
+            result = maintenance.verify_subtree(int(sys.argv[2]))
+            for check, ok in result['checks'].items():
+                print(f"{'✅' if ok else '❌'} {check}")
+            for mismatch in result['counter_mismatches']:
+                print(f"   {mismatch}")
+            sys.exit(0 if result['valid'] else 1)
+
+        else:
+            print(f"Comando não reconhecido: {command}")
+            sys.exit(1)
+
+    except (ValueError, psycopg2.Error) as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Cálculo de Indicações por Nível (level_1..level_5) - Fature CPA v2
+
+Substitui os self-joins por nível (ver docs/v2/rankings_top5_afiliados_fature.md)
+por uma única passada de baixo para cima sobre o array de pais: cada nível da
+árvore, do mais profundo para a raiz, soma os contadores dos filhos nos pais,
+deslocados um nível. Os contadores são gravados em public.affiliates via COPY
+para tabela temporária + UPDATE único, apenas nas linhas que mudaram.
+"""
+
+import psycopg2
+import numpy as np
+import logging
+import time
+import io
+from typing import Dict
+import sys
+
+from db_connection import database_config
+from compact_hierarchy import CompactHierarchy
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class FatureLevelReferrals:
+    """Contadores de indicações por nível calculados em memória"""
+
+    def __init__(self):
+        self.config = {
+            'database': database_config(),
+            'max_levels': 5
+        }
+
+        self.hierarchy = None
+        self.counts = None
+
+    def connect_database(self):
+        """Conectar ao banco de dados"""
+        return psycopg2.connect(**self.config['database'])
+
+    def load_hierarchy(self, conn) -> CompactHierarchy:
+        """Carregar (affiliate_id, parent_affiliate_id) de public.affiliates"""
+        buffer = io.StringIO()
+        with conn.cursor() as cursor:
+            cursor.copy_expert("""
+                COPY (
+                    SELECT affiliate_id, COALESCE(parent_affiliate_id, 0)
+                    FROM public.affiliates
+                ) TO STDOUT
+            """, buffer)
+
+        buffer.seek(0)
+        if buffer.getvalue():
+            rows = np.loadtxt(buffer, dtype=np.int64, delimiter='\t', ndmin=2)
+        else:
+            rows = np.empty((0, 2), dtype=np.int64)
+
+        self.hierarchy = CompactHierarchy.build(rows[:, 0], rows[:, 1])
+        return self.hierarchy
+
+    def compute_counts(self, hierarchy: CompactHierarchy) -> np.ndarray:
+        """Calcular indicações por nível para todos os afiliados em uma passada
+
+        Retorna matriz (afiliados x max_levels + 1) em que a coluna k é a quantidade
+        de descendentes exatamente k níveis abaixo; a coluna 0 (o próprio afiliado)
+        serve de semente para o deslocamento.
+        """
+        max_levels = self.config['max_levels']
+        n = len(hierarchy)
+        counts = np.zeros((n, max_levels + 1), dtype=np.int64)
+        counts[:, 0] = 1
+
+        level_start = hierarchy.level_start
+        for depth in range(hierarchy.max_depth, 0, -1):
+            nodes = hierarchy.level_order[level_start[depth]:level_start[depth + 1]]
+            # Filhos somados nos pais, deslocados um nível
+            np.add.at(counts, (hierarchy.parent[nodes], slice(1, None)), counts[nodes, :-1])
+
+        self.hierarchy = hierarchy
+        self.counts = counts
+        return counts
+
+    def write_counts(self, conn, hierarchy: CompactHierarchy, counts: np.ndarray) -> int:
+        """Gravar level_N_referrals apenas nas linhas alteradas"""
+        max_levels = self.config['max_levels']
+        columns = [f"level_{level}_referrals" for level in range(1, max_levels + 1)]
+
+        buffer = io.StringIO()
+        for affiliate_id, row in zip(hierarchy.affiliate_ids.tolist(), counts[:, 1:].tolist()):
+            buffer.write(f"{affiliate_id}\t" + "\t".join(map(str, row)) + "\n")
+        buffer.seek(0)
+
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                CREATE TEMP TABLE tmp_level_referrals (
+                    affiliate_id BIGINT PRIMARY KEY,
+                    {', '.join(f'{column} INTEGER' for column in columns)}
+                ) ON COMMIT DROP;
+            """)
+            cursor.copy_expert(f"COPY tmp_level_referrals (affiliate_id, {', '.join(columns)}) FROM STDIN",
+                               buffer)
+
+            cursor.execute(f"""
+                UPDATE public.affiliates a
+                SET {', '.join(f'{column} = t.{column}' for column in columns)},
+                    updated_at = NOW()
+                FROM tmp_level_referrals t
+                WHERE a.affiliate_id = t.affiliate_id
+                  AND ({' OR '.join(f'a.{column} IS DISTINCT FROM t.{column}' for column in columns)});
+            """)
+            updated = cursor.rowcount
+
+        conn.commit()
+        return updated
+
+    def top_by_level(self, level: int, limit: int = 5):
+        """Ranking dos afiliados com mais indicações em um nível"""
+        column = self.counts[:, level]
+        limit = min(limit, len(column))
+        if limit == 0:
+            return []
+
+        top = np.argpartition(-column, limit - 1)[:limit]
+        top = top[np.argsort(-column[top], kind='stable')]
+        return [(int(self.hierarchy.affiliate_ids[i]), int(column[i])) for i in top if column[i] > 0]
+
+    def refresh(self) -> Dict:
+        """Recalcular e gravar todos os níveis"""
+        stats = {'affiliates': 0, 'updated': 0, 'load_ms': 0, 'calc_ms': 0, 'write_ms': 0}
+
+        conn = self.connect_database()
+        try:
+            load_start = time.time()
+            hierarchy = self.load_hierarchy(conn)
+            stats['affiliates'] = len(hierarchy)
+            stats['load_ms'] = (time.time() - load_start) * 1000
+
+            calc_start = time.time()
+            counts = self.compute_counts(hierarchy)
+            stats['calc_ms'] = (time.time() - calc_start) * 1000
+
+            write_start = time.time()
+            stats['updated'] = self.write_counts(conn, hierarchy, counts)
+            stats['write_ms'] = (time.time() - write_start) * 1000
+
+            stats['totals'] = {
+                f"level_{level}": int(counts[:, level].sum())
+                for level in range(1, self.config['max_levels'] + 1)
+            }
+
+            logger.info(f"✅ Indicações por nível atualizadas: {stats['updated']} de {stats['affiliates']} "
+                        f"afiliados alterados (carga {stats['load_ms']:.0f}ms, cálculo {stats['calc_ms']:.0f}ms, "
+                        f"gravação {stats['write_ms']:.0f}ms)")
+
+        except Exception as e:
+            logger.error(f"Erro ao atualizar indicações por nível: {e}")
+            conn.rollback()
+            stats['error'] = str(e)
+        finally:
+            conn.close()
+
+        return stats
+
+
+def main():
+    job = FatureLevelReferrals()
+
+    if len(sys.argv) < 2:
+        print("Uso: python level_referrals.py [comando]")
+        print("Comandos disponíveis:")
+        print("  refresh     - Recalcular level_1..level_5_referrals de todos os afiliados")
+        print("  top [N]     - Recalcular e exibir o top N de cada nível (sem gravar)")
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    if command == "refresh":
+        stats = job.refresh()
+        if 'totals' in stats:
+            for level, total in stats['totals'].items():
+                print(f"{level}: {total:,} indicações")
+        sys.exit(0 if 'error' not in stats else 1)
+
+    elif command == "top":
+        limit = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+        conn = job.connect_database()
+        try:
+            job.compute_counts(job.load_hierarchy(conn))
+        finally:
+            conn.close()
+
+        for level in range(1, job.config['max_levels'] + 1):
+            print(f"=== TOP {limit} NÍVEL {level} ===")
+            for position, (affiliate_id, count) in enumerate(job.top_by_level(level, limit), start=1):
+                print(f"{position}º {affiliate_id}: {count:,}")
+        sys.exit(0)
+
+    else:
+        print(f"Comando não reconhecido: {command}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
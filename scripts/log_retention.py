@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Retenção de Logs - Fature CPA v2
+
+Mantém query_performance_log e system_log com tamanho limitado:
+
+1. resumo: linhas brutas de query_performance_log mais antigas que raw_retention_hours
+   viram linhas horárias por query_type em query_performance_hourly (contagem, soma,
+   máximo, lentas e percentis p50/p95/p99, ponderados por 1/sample_rate)
+2. expurgo: as linhas brutas já resumidas e as de system_log mais antigas que
+   system_log_retention_days são removidas em lotes por faixa de log_id, cada lote em
+   transação própria, para não segurar locks nem gerar transações longas
+3. cache: chama cleanup_expired_cache()
+
+O limite do que já foi resumido fica em refresh_state (job 'log_retention'). O
+monitor (FatureMonitor.get_query_history) lê o resumo para as horas anteriores a
+esse limite e as linhas brutas apenas para as horas recentes.
+"""
+
+import psycopg2
+import logging
+import time
+import json
+from datetime import timedelta
+from typing import Dict
+import sys
+
+from db_connection import database_config, get_pool
+from query_instrumentation import SLOW_QUERY_MS
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+JOB_NAME = 'log_retention'
+
+ROLLUP_SQL = """
+    INSERT INTO fature_v2.query_performance_hourly (
+        hour, query_type, query_count, sampled_count, total_duration_ms, max_duration_ms,
+        slow_count, p50_ms, p95_ms, p99_ms, total_affected_rows
+    )
+    WITH raw AS (
+        SELECT
+            date_trunc('hour', created_at) AS hour,
+            query_type,
+            query_duration_ms AS duration,
+            affected_rows,
+            1 / COALESCE((parameters->>'sample_rate')::float, 1) AS weight
+        FROM fature_v2.query_performance_log
+        WHERE created_at >= %(start)s AND created_at < %(end)s
+    ),
+    ranked AS (
+        SELECT
+            *,
+            SUM(weight) OVER (PARTITION BY hour, query_type ORDER BY duration
+                              ROWS UNBOUNDED PRECEDING) AS cumulative,
+            SUM(weight) OVER (PARTITION BY hour, query_type) AS total
+        FROM raw
+    )
+    SELECT
+        hour,
+        query_type,
+        ROUND(SUM(weight))::BIGINT,
+        COUNT(*),
+        ROUND(SUM(duration * weight))::BIGINT,
+        MAX(duration),
+        COUNT(*) FILTER (WHERE duration > %(slow_ms)s),
+        MIN(duration) FILTER (WHERE cumulative >= 0.50 * total),
+        MIN(duration) FILTER (WHERE cumulative >= 0.95 * total),
+        MIN(duration) FILTER (WHERE cumulative >= 0.99 * total),
+        ROUND(SUM(affected_rows * weight))::BIGINT
+    FROM ranked
+    GROUP BY hour, query_type
+    ON CONFLICT (hour, query_type) DO NOTHING
+"""
+
+
+class FatureLogRetention:
+    """Resumo horário e expurgo em lotes dos logs de monitoramento"""
+
+    def __init__(self):
+        self.config = {
+            'database': database_config(),
+            'raw_retention_hours': 24,
+            'system_log_retention_days': 90,
+            # Mesmo limite de consulta lenta do monitor e da instrumentação
+            'slow_query_ms': SLOW_QUERY_MS,
+            'rollup_chunk_hours': 24,
+            'delete_batch_size': 5000,
+            'delete_pause_seconds': 0.05
+        }
+
+    def connection(self, profile: str = 'default'):
+        """Conexão do pool compartilhado (devolvida ao final do bloco with)"""
+        return get_pool(self.config['database']).connection(profile)
+
+    def _rolled_until(self, cursor):
+        cursor.execute("""
+            SELECT (details->>'rolled_until')::timestamp
+            FROM fature_v2.refresh_state
+            WHERE job_name = %s
+        """, (JOB_NAME,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def rollup(self) -> Dict:
+        """Resumir horas completas mais antigas que raw_retention_hours"""
+        stats = {'hours': 0, 'summary_rows': 0}
+
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                # created_at e rolled_until são TIMESTAMP sem fuso: o limite também precisa ser
+                cursor.execute("""
+                    SELECT date_trunc('hour', LOCALTIMESTAMP - %s * INTERVAL '1 hour')
+                """, (self.config['raw_retention_hours'],))
+                cutoff = cursor.fetchone()[0]
+                start = self._rolled_until(cursor)
+                if start is None:
+                    cursor.execute("""
+                        SELECT date_trunc('hour', MIN(created_at)) FROM fature_v2.query_performance_log
+                    """)
+                    start = cursor.fetchone()[0] or cutoff
+
+        # Um bloco de horas por transação; o limite avança junto com o resumo
+        while start < cutoff:
+            end = min(start + timedelta(hours=self.config['rollup_chunk_hours']), cutoff)
+            with self.connection('report') as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(ROLLUP_SQL, {'start': start, 'end': end,
+                                                'slow_ms': self.config['slow_query_ms']})
+                    stats['summary_rows'] += cursor.rowcount
+                    cursor.execute("""
+                        INSERT INTO fature_v2.refresh_state (job_name, last_run_at, details, updated_at)
+                        VALUES (%(job)s, NOW(), jsonb_build_object('rolled_until', %(end)s::text), NOW())
+                        ON CONFLICT (job_name) DO UPDATE
+                        SET last_run_at = NOW(),
+                            details = COALESCE(refresh_state.details, '{}'::jsonb) || EXCLUDED.details,
+                            updated_at = NOW()
+                    """, {'job': JOB_NAME, 'end': end})
+            stats['hours'] += int((end - start).total_seconds() // 3600)
+            start = end
+
+        stats['rolled_until'] = start.isoformat() if start else None
+        return stats
+
+    def purge(self, table: str, cutoff) -> int:
+        """Remover linhas com created_at anterior ao limite, em lotes por faixa de log_id"""
+        if cutoff is None:
+            return 0
+
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f"""
+                    SELECT MIN(log_id), MAX(log_id) FROM fature_v2.{table} WHERE created_at < %s
+                """, (cutoff,))
+                low, high = cursor.fetchone()
+
+        if low is None:
+            return 0
+
+        deleted = 0
+        batch_size = self.config['delete_batch_size']
+        for batch_start in range(low, high + 1, batch_size):
+            with self.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(f"""
+                        DELETE FROM fature_v2.{table}
+                        WHERE log_id >= %s AND log_id < %s AND created_at < %s
+                    """, (batch_start, batch_start + batch_size, cutoff))
+                    deleted += cursor.rowcount
+            time.sleep(self.config['delete_pause_seconds'])
+
+        logger.info(f"{table}: {deleted} linhas removidas (anteriores a {cutoff})")
+        return deleted
+
+    def run(self) -> Dict:
+        """Executar resumo, expurgo e limpeza de cache"""
+        start_time = time.time()
+        stats = {'rollup': self.rollup()}
+
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                # Linhas brutas só saem depois de resumidas
+                rolled_until = self._rolled_until(cursor)
+                cursor.execute("SELECT LOCALTIMESTAMP - %s * INTERVAL '1 day'",
+                               (self.config['system_log_retention_days'],))
+                system_log_cutoff = cursor.fetchone()[0]
+
+        stats['query_performance_log_deleted'] = self.purge('query_performance_log', rolled_until)
+        stats['system_log_deleted'] = self.purge('system_log', system_log_cutoff)
+
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT fature_v2.cleanup_expired_cache()")
+                stats['cache_deleted'] = cursor.fetchone()[0]
+
+                stats['duration_ms'] = int((time.time() - start_time) * 1000)
+                cursor.execute("""
+                    INSERT INTO fature_v2.system_log (operation, details)
+                    VALUES ('log_retention', %s)
+                """, (json.dumps(stats),))
+
+        logger.info(f"✅ Retenção concluída: {stats['rollup']['summary_rows']} linhas de resumo, "
+                    f"{stats['query_performance_log_deleted']} consultas e "
+                    f"{stats['system_log_deleted']} eventos removidos ({stats['duration_ms']}ms)")
+        return stats
+
+    def status(self) -> Dict:
+        """Tamanho dos logs e limite do resumo"""
+        with self.connection('monitor') as conn:
+            with conn.cursor() as cursor:
+                result = {'rolled_until': self._rolled_until(cursor)}
+                for table in ('query_performance_log', 'query_performance_hourly', 'system_log'):
+                    cursor.execute("""
+                        SELECT c.reltuples::BIGINT, pg_total_relation_size(c.oid)
+                        FROM pg_class c
+                        JOIN pg_namespace n ON n.oid = c.relnamespace
+                        WHERE n.nspname = 'fature_v2' AND c.relname = %s
+                    """, (table,))
+                    row = cursor.fetchone()
+                    result[table] = {'rows': row[0], 'bytes': row[1]} if row else None
+        return result
+
+
+def main():
+    job = FatureLogRetention()
+
+    if len(sys.argv) < 2:
+        print("Uso: python log_retention.py [comando]")
+        print("Comandos disponíveis:")
+        print("  run     - Resumir, expurgar logs antigos e limpar cache expirado")
+        print("  rollup  - Apenas gerar os resumos horários")
+        print("  status  - Tamanho dos logs e limite do resumo")
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    try:
+        if command == "run":
+            job.run()
+            sys.exit(0)
+
+        elif command == "rollup":
+            stats = job.rollup()
+            print(f"✅ {stats['hours']} horas resumidas ({stats['summary_rows']} linhas) "
+                  f"até {stats['rolled_until']}")
+            sys.exit(0)
+
+        elif command == "status":
+            status = job.status()
+            print(f"Resumido até: {status['rolled_until'] or '-'}")
+            for table in ('query_performance_log', 'query_performance_hourly', 'system_log'):
+                info = status[table]
+                if info:
+                    print(f"{table}: ~{max(info['rows'], 0):,} linhas, {info['bytes'] / 1024 / 1024:.1f} MB")
+            sys.exit(0)
+
+        else:
+            print(f"Comando não reconhecido: {command}")
+            sys.exit(1)
+
+    except psycopg2.Error as e:
+        logger.error(f"Erro na retenção de logs: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,54 +13,82 @@ import logging
 import time
 import json
 import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from typing import Dict, List, Tuple, Optional
 import sys
 import os
 
-# Configuração de logging
+from db_connection import database_config, get_pool
+
+# Configuração de logging (migration.log só é criado na execução direta, em __main__)
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('migration.log'),
-        logging.StreamHandler(sys.stdout)
-    ]
+    format=LOG_FORMAT,
+    handlers=[logging.StreamHandler(sys.stdout)]
 )
 logger = logging.getLogger(__name__)
 
+# Colunas criadas depois da primeira versão do schema; bancos já migrados as recebem
+# pelo comando upgrade (create_tables.sql já as contém)
+SCHEMA_UPGRADES = [
+    ('commission_queue', 'next_attempt_at', 'TIMESTAMP DEFAULT NOW()'),
+    ('commissions', 'updated_at', 'TIMESTAMP DEFAULT NOW()')
+]
+
+# Triggers criados depois da primeira versão do schema: (tabela, nome, momento e evento, função)
+SCHEMA_UPGRADE_TRIGGERS = [
+    ('commissions', 'trg_commissions_updated_at', 'BEFORE UPDATE', 'set_updated_at')
+]
+
+UPGRADE_FUNCTIONS = {
+    'set_updated_at': """
+        CREATE OR REPLACE FUNCTION fature_v2.set_updated_at()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            NEW.updated_at = NOW();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+    """
+}
+
 class FatureMigration:
     """Classe principal para migração do sistema Fature"""
     
     def __init__(self):
         """Inicializar configurações de conexão"""
         self.config = {
-            'fature_db': {
-                'host': 'hopper.proxy.rlwy.net',
-                'port': 48603,
-                'database': 'railway',
-                'user': 'postgres',
-                'password': 'xWyLIRXlRfgqYMVJRKYLlEAIngEgakTl',
-                'options': '-c statement_timeout=300000'
-            }
+            'database': database_config()
         }
         
         self.batch_size = 5000
         self.max_retries = 3
+        
+        # Índices secundários e chaves estrangeiras são criados só depois da carga
+        self.post_load = {
+            'index_workers': 4,
+            'maintenance_work_mem': '1GB',
+            'max_parallel_maintenance_workers': 2
+        }
+        self.deferred = {'indexes': [], 'foreign_keys': []}
+        
         self.stats = {
             'start_time': None,
             'end_time': None,
             'affiliates_migrated': 0,
             'relationships_created': 0,
             'errors': 0,
-            'warnings': 0
+            'warnings': 0,
+            'index_builds': [],
+            'foreign_key_validations': []
         }
         
     def connect_database(self) -> psycopg2.extensions.connection:
-        """Estabelecer conexão com o banco de dados"""
+        """Obter conexão do pool compartilhado (perfil de sessão 'migration')"""
         try:
-            conn = psycopg2.connect(**self.config['fature_db'])
-            conn.autocommit = False
+            conn = get_pool(self.config['database']).getconn('migration')
             logger.info("Conexão com banco estabelecida com sucesso")
             return conn
         except Exception as e:
@@ -75,7 +103,8 @@ class FatureMigration:
                 
                 # Criar schema
                 cursor.execute("CREATE SCHEMA IF NOT EXISTS fature_v2;")
-                cursor.execute("SET search_path TO fature_v2;")
+                # SET LOCAL: a conexão volta ao pool compartilhado ao final
+                cursor.execute("SET LOCAL search_path TO fature_v2;")
                 
                 # Habilitar extensões
                 cursor.execute("CREATE EXTENSION IF NOT EXISTS ltree;")
@@ -85,6 +114,9 @@ class FatureMigration:
                 with open('create_tables.sql', 'r') as f:
                     cursor.execute(f.read())
                 
+                # Tabelas ainda vazias: remover agora e recriar após a carga
+                self.defer_secondary_objects(cursor)
+                
                 conn.commit()
                 logger.info("Schema e tabelas criados com sucesso")
                 return True
@@ -94,6 +126,297 @@ class FatureMigration:
             conn.rollback()
             return False
     
+    def defer_secondary_objects(self, cursor) -> Dict:
+        """Guardar e remover índices secundários e chaves estrangeiras do schema recém-criado
+        
+        Permanecem apenas chaves primárias e restrições UNIQUE (usadas por ON CONFLICT
+        durante a carga). As definições são gravadas em fature_v2.deferred_objects na
+        mesma transação dos DROPs, para que a fase pós-carga possa ser retomada mesmo
+        que o processo termine antes dela (comando post_load).
+        """
+        cursor.execute("""
+            SELECT
+                c.relname,
+                t.relname,
+                pg_get_indexdef(i.indexrelid),
+                am.amname
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_class t ON t.oid = i.indrelid
+            JOIN pg_namespace n ON n.oid = t.relnamespace
+            JOIN pg_am am ON am.oid = c.relam
+            WHERE n.nspname = 'fature_v2'
+              AND t.relkind = 'r'
+              AND NOT t.relispartition
+              AND NOT EXISTS (SELECT 1 FROM pg_constraint k WHERE k.conindid = i.indexrelid)
+            ORDER BY t.relname, c.relname
+        """)
+        self.deferred['indexes'] = [
+            {'name': name, 'table': table, 'definition': definition, 'method': method}
+            for name, table, definition, method in cursor.fetchall()
+        ]
+        
+        cursor.execute("""
+            SELECT k.conname, t.relname, pg_get_constraintdef(k.oid)
+            FROM pg_constraint k
+            JOIN pg_class t ON t.oid = k.conrelid
+            JOIN pg_namespace n ON n.oid = t.relnamespace
+            WHERE n.nspname = 'fature_v2' AND k.contype = 'f'
+            ORDER BY t.relname, k.conname
+        """)
+        self.deferred['foreign_keys'] = [
+            {'name': name, 'table': table, 'definition': definition}
+            for name, table, definition in cursor.fetchall()
+        ]
+        
+        psycopg2.extras.execute_values(cursor, """
+            INSERT INTO fature_v2.deferred_objects (object_type, object_name, table_name, definition, index_method)
+            VALUES %s
+            ON CONFLICT (object_type, object_name) DO UPDATE
+            SET table_name = EXCLUDED.table_name,
+                definition = EXCLUDED.definition,
+                index_method = EXCLUDED.index_method,
+                deferred_at = NOW(),
+                restored_at = NULL
+        """, [('index', i['name'], i['table'], i['definition'], i['method']) for i in self.deferred['indexes']] +
+             [('foreign_key', k['name'], k['table'], k['definition'], None) for k in self.deferred['foreign_keys']])
+        
+        for fk in self.deferred['foreign_keys']:
+            cursor.execute(f'ALTER TABLE fature_v2.{fk["table"]} DROP CONSTRAINT "{fk["name"]}"')
+        for index in self.deferred['indexes']:
+            cursor.execute(f'DROP INDEX fature_v2."{index["name"]}"')
+        
+        logger.info(f"Adiados para após a carga: {len(self.deferred['indexes'])} índices, "
+                    f"{len(self.deferred['foreign_keys'])} chaves estrangeiras")
+        return self.deferred
+    
+    def load_deferred_objects(self, cursor) -> Dict:
+        """Carregar de deferred_objects os objetos ainda não recriados"""
+        cursor.execute("""
+            SELECT object_type, object_name, table_name, definition, index_method
+            FROM fature_v2.deferred_objects
+            WHERE restored_at IS NULL
+            ORDER BY table_name, object_name
+        """)
+        self.deferred = {'indexes': [], 'foreign_keys': []}
+        for object_type, name, table, definition, method in cursor.fetchall():
+            if object_type == 'index':
+                self.deferred['indexes'].append(
+                    {'name': name, 'table': table, 'definition': definition, 'method': method})
+            else:
+                self.deferred['foreign_keys'].append({'name': name, 'table': table, 'definition': definition})
+        return self.deferred
+    
+    def _mark_restored(self, cursor, object_type: str, name: str):
+        cursor.execute("""
+            UPDATE fature_v2.deferred_objects
+            SET restored_at = NOW()
+            WHERE object_type = %s AND object_name = %s
+        """, (object_type, name))
+    
+    def _build_index(self, index: Dict) -> Dict:
+        """Criar um índice em conexão própria do pool (executado em thread)"""
+        pool = get_pool(self.config['database'])
+        conn = pool.getconn('migration')
+        result = {'index': index['name'], 'table': index['table'], 'method': index['method']}
+        start_time = time.time()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SET LOCAL maintenance_work_mem = %s", (self.post_load['maintenance_work_mem'],))
+                cursor.execute("SET LOCAL max_parallel_maintenance_workers = %s",
+                               (self.post_load['max_parallel_maintenance_workers'],))
+                cursor.execute(index['definition'])
+                self._mark_restored(cursor, 'index', index['name'])
+            conn.commit()
+            result['success'] = True
+        except Exception as e:
+            conn.rollback()
+            result['success'] = False
+            result['error'] = str(e)
+        finally:
+            pool.putconn(conn)
+        result['duration_ms'] = int((time.time() - start_time) * 1000)
+        return result
+    
+    def build_secondary_indexes(self, conn: psycopg2.extensions.connection) -> bool:
+        """Criar os índices adiados em paralelo (conexões separadas), maiores tabelas primeiro"""
+        with conn.cursor() as cursor:
+            indexes = self.load_deferred_objects(cursor)['indexes']
+            if not indexes:
+                conn.commit()
+                return True
+            
+            cursor.execute("""
+                SELECT relname, pg_relation_size(oid)
+                FROM pg_class
+                WHERE relnamespace = 'fature_v2'::regnamespace AND relkind = 'r'
+            """)
+            table_sizes = dict(cursor.fetchall())
+        conn.commit()
+        
+        # Builds mais longos primeiro (GiST é o mais caro em cada tabela)
+        indexes = sorted(indexes, key=lambda i: (-table_sizes.get(i['table'], 0), i['method'] != 'gist'))
+        
+        start_time = time.time()
+        workers = max(1, min(self.post_load['index_workers'], len(indexes)))
+        logger.info(f"Criando {len(indexes)} índices secundários com {workers} conexões paralelas...")
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._build_index, index) for index in indexes]
+            for future in as_completed(futures):
+                result = future.result()
+                self.stats['index_builds'].append(result)
+                if result['success']:
+                    logger.info(f"Índice {result['index']} ({result['table']}, {result['method']}): "
+                                f"{result['duration_ms']}ms")
+                else:
+                    logger.error(f"Erro ao criar índice {result['index']}: {result['error']}")
+        
+        failed = [r for r in self.stats['index_builds'] if not r['success']]
+        logger.info(f"Índices secundários concluídos em {(time.time() - start_time):.1f}s "
+                    f"({len(failed)} falhas)")
+        return not failed
+    
+    def _validate_table_foreign_keys(self, table: str, names: List[str]) -> List[Dict]:
+        """Validar as chaves estrangeiras de uma tabela (VALIDATE não pode rodar em paralelo na mesma tabela)"""
+        pool = get_pool(self.config['database'])
+        conn = pool.getconn('migration')
+        results = []
+        try:
+            for name in names:
+                start_time = time.time()
+                result = {'constraint': name, 'table': table}
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute(f'ALTER TABLE fature_v2.{table} VALIDATE CONSTRAINT "{name}"')
+                        self._mark_restored(cursor, 'foreign_key', name)
+                    conn.commit()
+                    result['success'] = True
+                except Exception as e:
+                    conn.rollback()
+                    result['success'] = False
+                    result['error'] = str(e)
+                result['duration_ms'] = int((time.time() - start_time) * 1000)
+                results.append(result)
+        finally:
+            pool.putconn(conn)
+        return results
+    
+    def validate_foreign_keys(self, conn: psycopg2.extensions.connection) -> bool:
+        """Recriar as chaves estrangeiras como NOT VALID e validá-las em paralelo por tabela"""
+        try:
+            with conn.cursor() as cursor:
+                foreign_keys = self.load_deferred_objects(cursor)['foreign_keys']
+                
+                # Numa retomada, a chave pode já existir como NOT VALID
+                cursor.execute("""
+                    SELECT conname FROM pg_constraint
+                    WHERE connamespace = 'fature_v2'::regnamespace AND contype = 'f'
+                """)
+                existing = {row[0] for row in cursor.fetchall()}
+                
+                for fk in foreign_keys:
+                    if fk['name'] not in existing:
+                        cursor.execute(f'ALTER TABLE fature_v2.{fk["table"]} '
+                                       f'ADD CONSTRAINT "{fk["name"]}" {fk["definition"]} NOT VALID')
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Erro ao recriar chaves estrangeiras: {e}")
+            conn.rollback()
+            return False
+        
+        if not foreign_keys:
+            return True
+        
+        by_table = {}
+        for fk in foreign_keys:
+            by_table.setdefault(fk['table'], []).append(fk['name'])
+        
+        workers = max(1, min(self.post_load['index_workers'], len(by_table)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._validate_table_foreign_keys, table, names)
+                       for table, names in by_table.items()]
+            for future in as_completed(futures):
+                for result in future.result():
+                    self.stats['foreign_key_validations'].append(result)
+                    if result['success']:
+                        logger.info(f"Chave estrangeira {result['constraint']} validada: {result['duration_ms']}ms")
+                    else:
+                        logger.error(f"Chave estrangeira {result['constraint']} inválida: {result['error']}")
+        
+        return all(r['success'] for r in self.stats['foreign_key_validations'])
+    
+    def restore_deferred_objects(self) -> bool:
+        """Recriar os índices e chaves estrangeiras pendentes em deferred_objects
+        
+        Chamado no caminho de falha de run_migration e pelo comando post_load, para
+        retomar uma migração interrompida entre create_new_schema e a fase pós-carga.
+        """
+        pool = get_pool(self.config['database'])
+        conn = pool.getconn('migration')
+        try:
+            indexes_ok = self.build_secondary_indexes(conn)
+            foreign_keys_ok = self.validate_foreign_keys(conn)
+            logger.info(self.post_load_report())
+            return indexes_ok and foreign_keys_ok
+        finally:
+            pool.putconn(conn)
+    
+    def upgrade_schema(self) -> List[str]:
+        """Adicionar a um schema existente as colunas de SCHEMA_UPGRADES e os triggers
+        de SCHEMA_UPGRADE_TRIGGERS que faltam
+        
+        information_schema e pg_trigger são consultados antes: o ALTER TABLE (ACCESS
+        EXCLUSIVE) e o CREATE TRIGGER só rodam para o que está ausente.
+        """
+        added = []
+        with get_pool(self.config['database']).connection('migration') as conn:
+            with conn.cursor() as cursor:
+                for table, column, definition in SCHEMA_UPGRADES:
+                    cursor.execute("""
+                        SELECT 1 FROM information_schema.columns
+                        WHERE table_schema = 'fature_v2' AND table_name = %s AND column_name = %s
+                    """, (table, column))
+                    if cursor.fetchone():
+                        continue
+                    
+                    cursor.execute("SET LOCAL lock_timeout = '10s';")
+                    cursor.execute(f"ALTER TABLE fature_v2.{table} ADD COLUMN IF NOT EXISTS {column} {definition};")
+                    added.append(f"{table}.{column}")
+                    logger.info(f"Coluna fature_v2.{table}.{column} adicionada")
+                
+                for table, name, event, function in SCHEMA_UPGRADE_TRIGGERS:
+                    cursor.execute("""
+                        SELECT 1 FROM pg_trigger
+                        WHERE tgrelid = %s::regclass AND tgname = %s
+                    """, (f"fature_v2.{table}", name))
+                    if cursor.fetchone():
+                        continue
+                    
+                    cursor.execute("SET LOCAL lock_timeout = '10s';")
+                    cursor.execute(UPGRADE_FUNCTIONS[function])
+                    cursor.execute(f"""
+                        CREATE TRIGGER {name}
+                            {event} ON fature_v2.{table}
+                            FOR EACH ROW EXECUTE FUNCTION fature_v2.{function}();
+                    """)
+                    added.append(f"{table}.{name}")
+                    logger.info(f"Trigger {name} criado em fature_v2.{table}")
+        return added
+    
+    def post_load_report(self) -> str:
+        """Tempos da fase pós-carga (índices e chaves estrangeiras)"""
+        lines = ["=== FASE PÓS-CARGA ==="]
+        for result in sorted(self.stats['index_builds'], key=lambda r: -r['duration_ms']):
+            status = "✅" if result['success'] else "❌"
+            lines.append(f"{status} índice {result['index']} ({result['table']}, {result['method']}): "
+                         f"{result['duration_ms']}ms")
+        for result in sorted(self.stats['foreign_key_validations'], key=lambda r: -r['duration_ms']):
+            status = "✅" if result['success'] else "❌"
+            lines.append(f"{status} chave estrangeira {result['constraint']} ({result['table']}): "
+                         f"{result['duration_ms']}ms")
+        return "\n".join(lines)
+    
     def migrate_affiliates_batch(self, conn: psycopg2.extensions.connection, 
                                 start_id: int, batch_size: int) -> Dict:
         """Migrar lote de afiliados"""
@@ -230,6 +553,22 @@ class FatureMigration:
                 validation_results['referral_counts_match'] = (count_mismatches == 0)
                 logger.info(f"Inconsistências em contadores: {count_mismatches}")
                 
+                # Validar registros órfãos no índice hierárquico
+                cursor.execute("""
+                    SELECT COUNT(*) FROM fature_v2.hierarchy_index hi
+                    WHERE NOT EXISTS (
+                              SELECT 1 FROM fature_v2.affiliates_optimized a
+                              WHERE a.affiliate_id = hi.ancestor_id
+                          )
+                       OR NOT EXISTS (
+                              SELECT 1 FROM fature_v2.affiliates_optimized a
+                              WHERE a.affiliate_id = hi.descendant_id
+                          );
+                """)
+                orphaned_pairs = cursor.fetchone()[0]
+                validation_results['no_orphaned_records'] = (orphaned_pairs == 0)
+                logger.info(f"Relacionamentos órfãos em hierarchy_index: {orphaned_pairs}")
+                
                 # Teste de performance
                 start_time = time.time()
                 cursor.execute("""
@@ -253,6 +592,8 @@ class FatureMigration:
         logger.info("=== INICIANDO MIGRAÇÃO FATURE CPA V2 ===")
         
         conn = None
+        schema_created = False
+        post_load_started = False
         try:
             # Conectar ao banco
             conn = self.connect_database()
@@ -260,6 +601,7 @@ class FatureMigration:
             # Criar novo schema
             if not self.create_new_schema(conn):
                 return False
+            schema_created = True
             
             # Obter contagem total de afiliados
             with conn.cursor() as cursor:
@@ -298,6 +640,19 @@ class FatureMigration:
             if not self.build_hierarchy_index(conn):
                 return False
             
+            # Fase pós-carga: índices secundários, chaves estrangeiras e estatísticas
+            post_load_started = True
+            indexes_ok = self.build_secondary_indexes(conn)
+            foreign_keys_ok = self.validate_foreign_keys(conn)
+            logger.info(self.post_load_report())
+            if not (indexes_ok and foreign_keys_ok):
+                return False
+            
+            with conn.cursor() as cursor:
+                cursor.execute("ANALYZE fature_v2.affiliates_optimized;")
+                cursor.execute("ANALYZE fature_v2.hierarchy_index;")
+            conn.commit()
+            
             # Validar migração
             validation_results = self.validate_migration(conn)
             
@@ -322,15 +677,36 @@ class FatureMigration:
             
         finally:
             if conn:
-                conn.close()
+                get_pool(self.config['database']).putconn(conn)
+            
+            # Falha antes da fase pós-carga: não deixar o schema sem índices e chaves estrangeiras
+            if schema_created and not post_load_started:
+                logger.warning("Migração interrompida antes da fase pós-carga; recriando objetos adiados...")
+                try:
+                    self.restore_deferred_objects()
+                except Exception as e:
+                    logger.error(f"Erro ao recriar objetos adiados (use o comando post_load): {e}")
             
             self.stats['end_time'] = datetime.now()
             duration = self.stats['end_time'] - self.stats['start_time']
             logger.info(f"Tempo total de migração: {duration}")
 
 if __name__ == "__main__":
+    file_handler = logging.FileHandler('migration.log')
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logging.getLogger().addHandler(file_handler)
+    
     migration = FatureMigration()
-    success = migration.run_migration()
+    
+    if len(sys.argv) > 1 and sys.argv[1] == "post_load":
+        # Retomar a fase pós-carga a partir de fature_v2.deferred_objects
+        success = migration.restore_deferred_objects()
+    elif len(sys.argv) > 1 and sys.argv[1] == "upgrade":
+        added = migration.upgrade_schema()
+        print(f"Colunas e triggers adicionados: {', '.join(added) if added else 'nenhum'}")
+        sys.exit(0)
+    else:
+        success = migration.run_migration()
     
     if success:
         print("🎉 Migração concluída com sucesso!")
@@ -15,9 +15,12 @@ import logging
 from datetime import datetime, timedelta
 from typing import Dict, List
 import smtplib
-from email.mime.text import MimeText
+from email.mime.text import MIMEText
 import requests
 
+from db_connection import database_config, get_pool
+from query_instrumentation import SLOW_QUERY_MS
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -26,19 +29,13 @@ class FatureMonitor:
     
     def __init__(self):
         self.config = {
-            'database': {
-                'host': 'hopper.proxy.rlwy.net',
-                'port': 48603,
-                'database': 'railway',
-                'user': 'postgres',
-                'password': 'xWyLIRXlRfgqYMVJRKYLlEAIngEgakTl'
-            },
+            'database': database_config(),
             'alerts': {
                 'email': 'admin@fature.com',
                 'webhook_url': 'https://hooks.slack.com/services/YOUR/WEBHOOK/URL'
             },
             'thresholds': {
-                'slow_query_ms': 100,
+                'slow_query_ms': SLOW_QUERY_MS,
                 'max_pending_commissions': 1000,
                 'max_error_rate_percent': 5.0,
                 'min_throughput_per_second': 100
@@ -48,9 +45,9 @@ class FatureMonitor:
         self.last_metrics = {}
         self.alert_cooldown = {}  # Evitar spam de alertas
         
-    def connect_database(self):
-        """Conectar ao banco de dados"""
-        return psycopg2.connect(**self.config['database'])
+    def connection(self, profile: str = 'monitor'):
+        """Conexão do pool compartilhado (devolvida ao final do bloco with)"""
+        return get_pool(self.config['database']).connection(profile)
     
     def collect_metrics(self) -> Dict:
         """Coletar métricas do sistema"""
@@ -64,7 +61,7 @@ class FatureMonitor:
         }
         
         try:
-            with self.connect_database() as conn:
+            with self.connection() as conn:
                 with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
                     
                     # Métricas de afiliados
@@ -108,15 +105,17 @@ class FatureMonitor:
                     """)
                     metrics['commissions'] = dict(cursor.fetchone())
                     
-                    # Métricas de performance
+                    # Métricas de performance (registros amostrados pesam 1/sample_rate;
+                    # comandos lentos são sempre registrados)
                     cursor.execute("""
                         SELECT 
-                            COUNT(*) as queries_last_hour,
-                            AVG(query_duration_ms) as avg_query_duration,
+                            ROUND(COALESCE(SUM(1 / w.rate), 0))::BIGINT as queries_last_hour,
+                            SUM(query_duration_ms / w.rate) / NULLIF(SUM(1 / w.rate), 0) as avg_query_duration,
                             MAX(query_duration_ms) as max_query_duration,
                             COUNT(*) FILTER (WHERE query_duration_ms > %s) as slow_queries,
                             COUNT(DISTINCT query_type) as unique_query_types
-                        FROM fature_v2.query_performance_log
+                        FROM fature_v2.query_performance_log,
+                        LATERAL (SELECT COALESCE((parameters->>'sample_rate')::float, 1) AS rate) w
                         WHERE created_at >= NOW() - INTERVAL '1 hour';
                     """, (self.config['thresholds']['slow_query_ms'],))
                     metrics['performance'] = dict(cursor.fetchone())
@@ -135,6 +134,54 @@ class FatureMonitor:
             
         return metrics
     
+    def get_query_history(self, hours: int = 168) -> List[Dict]:
+        """Desempenho por query_type nas últimas `hours` horas
+        
+        Horas já resumidas por log_retention.py vêm de query_performance_hourly;
+        somente as horas posteriores são agregadas a partir das linhas brutas.
+        """
+        with self.connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.execute("""
+                    WITH bounds AS (
+                        SELECT
+                            date_trunc('hour', LOCALTIMESTAMP - %(hours)s * INTERVAL '1 hour') AS since,
+                            COALESCE((
+                                SELECT (details->>'rolled_until')::timestamp
+                                FROM fature_v2.refresh_state
+                                WHERE job_name = 'log_retention'
+                            ), '-infinity'::timestamp) AS rolled_until
+                    ),
+                    combined AS (
+                        SELECT query_type, query_count, total_duration_ms, max_duration_ms, slow_count, p95_ms
+                        FROM fature_v2.query_performance_hourly, bounds
+                        WHERE hour >= bounds.since AND hour < bounds.rolled_until
+                        UNION ALL
+                        SELECT
+                            query_type,
+                            SUM(1 / w.rate),
+                            SUM(query_duration_ms / w.rate),
+                            MAX(query_duration_ms),
+                            COUNT(*) FILTER (WHERE query_duration_ms > %(slow_ms)s),
+                            NULL
+                        FROM fature_v2.query_performance_log, bounds,
+                        LATERAL (SELECT COALESCE((parameters->>'sample_rate')::float, 1) AS rate) w
+                        WHERE created_at >= GREATEST(bounds.since, bounds.rolled_until)
+                        GROUP BY query_type
+                    )
+                    SELECT
+                        query_type,
+                        ROUND(SUM(query_count))::BIGINT as queries,
+                        SUM(total_duration_ms) / NULLIF(SUM(query_count), 0) as avg_duration_ms,
+                        MAX(max_duration_ms) as max_duration_ms,
+                        SUM(slow_count) as slow_queries,
+                        MAX(p95_ms) as worst_hourly_p95_ms
+                    FROM combined
+                    GROUP BY query_type
+                    ORDER BY SUM(total_duration_ms) DESC
+                """, {'hours': hours, 'slow_ms': self.config['thresholds']['slow_query_ms']})
+                return [dict(row) for row in cursor.fetchall()]
+    
     def check_alerts(self, metrics: Dict) -> List[Dict]:
         """Verificar condições de alerta"""
         alerts = []
@@ -328,6 +375,15 @@ if __name__ == "__main__":
         # Monitoramento contínuo
         interval = int(sys.argv[2]) if len(sys.argv) > 2 else 300
         monitor.run_continuous_monitoring(interval)
+    elif len(sys.argv) > 1 and sys.argv[1] == "--history":
+        # Histórico por tipo de consulta (resumos horários + horas recentes)
+        hours = int(sys.argv[2]) if len(sys.argv) > 2 else 168
+        print(f"=== CONSULTAS NAS ÚLTIMAS {hours}h ===")
+        for row in monitor.get_query_history(hours):
+            p95 = f"{row['worst_hourly_p95_ms']}ms" if row['worst_hourly_p95_ms'] is not None else "-"
+            print(f"{row['query_type']}: {row['queries']:,} consultas, média {row['avg_duration_ms'] or 0:.1f}ms, "
+                  f"máx {row['max_duration_ms']}ms, lentas {row['slow_queries']}, pior p95 horário {p95}")
+        sys.exit(0)
     else:
         # Execução única
         healthy = monitor.run_monitoring_cycle()
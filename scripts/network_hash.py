@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Hash de Rede (Merkle) - Fature CPA v2
+
+Preenche affiliates_optimized.network_hash com um hash no estilo Merkle da rede
+de cada afiliado:
+
+    hash(X) = SHA-256( hash_da_linha(X) || hash(filho_1) || ... || hash(filho_n) )
+
+com os filhos em ordem de affiliate_id. Qualquer alteração em um afiliado muda o
+hash dele e de todos os seus ancestrais, e apenas deles; jobs seguintes (estatísticas,
+recálculo de comissões, invalidação de cache) podem pular redes cujo hash não mudou.
+
+Modos:
+- full: carrega todos os afiliados via COPY e calcula de baixo para cima em uma passada
+- incremental: parte dos afiliados alterados desde a última execução (updated_at ou
+  hash ausente), recalcula somente eles e seus ancestrais, reaproveitando o hash
+  gravado dos filhos não alterados. A exclusão de um afiliado atualiza updated_at
+  do pai (trg_update_referral_counters) e move_subtree o das duas cadeias de ancestrais
+
+Em ambos os modos só são gravadas as linhas cujo hash mudou, sem alterar updated_at.
+"""
+
+import psycopg2
+import numpy as np
+import hashlib
+import logging
+import time
+import json
+import io
+from datetime import timedelta
+from typing import Dict, List
+import sys
+
+from db_connection import database_config, get_pool
+from compact_hierarchy import CompactHierarchy
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+JOB_NAME = 'network_hash'
+
+# Colunas que compõem o hash da própria linha (contadores derivados ficam de fora:
+# eles já são cobertos pelos hashes dos filhos)
+ROW_HASH_COLUMNS = [
+    'affiliate_id', 'parent_affiliate_id', 'external_id', 'status',
+    'total_deposits', 'total_bets', 'total_withdrawals', 'total_ggr',
+    'total_cpa_earned', 'total_rev_earned', 'total_commissions_paid'
+]
+
+ROWS_SQL = """
+    COPY (
+        SELECT {columns}, network_hash
+        FROM fature_v2.affiliates_optimized
+        {where}
+    ) TO STDOUT
+"""
+
+
+def row_digest(row_text: str) -> bytes:
+    """Hash da própria linha (texto COPY das colunas de ROW_HASH_COLUMNS)"""
+    return hashlib.sha256(row_text.encode('utf-8')).digest()
+
+
+def combine_digest(own: bytes, children: List[bytes]) -> bytes:
+    """Hash do nó a partir do hash da linha e dos hashes dos filhos (em ordem de ID)"""
+    digest = hashlib.sha256(own)
+    for child in children:
+        digest.update(child)
+    return digest.digest()
+
+
+def compute_hashes(hierarchy: CompactHierarchy, own: List[bytes]) -> List[bytes]:
+    """Calcular o hash de todos os nós em uma passada do nível mais profundo até as raízes
+
+    own[i] é o hash da linha do nó i (índice da hierarquia).
+    """
+    n = len(hierarchy)
+    parent = hierarchy.parent
+
+    # Filhos agrupados por pai; argsort estável mantém a ordem de affiliate_id
+    order = np.argsort(parent, kind='stable')
+    sorted_parent = parent[order]
+    starts = np.searchsorted(sorted_parent, np.arange(n), side='left').tolist()
+    ends = np.searchsorted(sorted_parent, np.arange(n), side='right').tolist()
+    order = order.tolist()
+
+    hashes = [None] * n
+    for node in hierarchy.level_order[::-1].tolist():
+        children = [hashes[child] for child in order[starts[node]:ends[node]]]
+        hashes[node] = combine_digest(own[node], children)
+    return hashes
+
+
+class FatureNetworkHash:
+    """Cálculo e gravação de affiliates_optimized.network_hash"""
+
+    def __init__(self):
+        self.config = {
+            'database': database_config(),
+            'overlap_seconds': 300,
+            # Acima disso o modo incremental vira full (carga em massa)
+            'max_incremental_nodes': 200000
+        }
+
+    def connection(self, profile: str = 'default'):
+        """Conexão do pool compartilhado (devolvida ao final do bloco with)"""
+        return get_pool(self.config['database']).connection(profile)
+
+    def _load_rows(self, cursor, where: str = "", params: Dict = None) -> List[str]:
+        """Linhas COPY (colunas do hash + network_hash gravado)"""
+        query = ROWS_SQL.format(columns=', '.join(ROW_HASH_COLUMNS), where=where)
+        if params:
+            query = cursor.mogrify(query, params).decode('utf-8')
+
+        buffer = io.StringIO()
+        cursor.copy_expert(query, buffer)
+        return buffer.getvalue().splitlines()
+
+    def _write_changed(self, cursor, changed: Dict[int, str]) -> int:
+        """Gravar hashes alterados via COPY para tabela temporária + UPDATE único"""
+        if not changed:
+            return 0
+
+        buffer = io.StringIO()
+        for affiliate_id, value in changed.items():
+            buffer.write(f"{affiliate_id}\t{value}\n")
+        buffer.seek(0)
+
+        cursor.execute("""
+            CREATE TEMP TABLE tmp_network_hash (
+                affiliate_id BIGINT PRIMARY KEY,
+                network_hash VARCHAR(64) NOT NULL
+            ) ON COMMIT DROP;
+        """)
+        cursor.copy_expert("COPY tmp_network_hash (affiliate_id, network_hash) FROM STDIN", buffer)
+        cursor.execute("""
+            UPDATE fature_v2.affiliates_optimized a
+            SET network_hash = t.network_hash
+            FROM tmp_network_hash t
+            WHERE a.affiliate_id = t.affiliate_id
+              AND a.network_hash IS DISTINCT FROM t.network_hash
+        """)
+        return cursor.rowcount
+
+    def compute_full(self, cursor) -> Dict[int, str]:
+        """Recalcular todos os hashes; retorna apenas os que mudaram"""
+        lines = self._load_rows(cursor)
+        if not lines:
+            return {}
+
+        rows = [line.rsplit('\t', 1) for line in lines]
+        ids = np.array([int(text.split('\t', 2)[0]) for text, _ in rows], dtype=np.int64)
+        parents = np.array([0 if text.split('\t', 2)[1] == '\\N' else int(text.split('\t', 2)[1])
+                            for text, _ in rows], dtype=np.int64)
+
+        hierarchy = CompactHierarchy.build(ids, parents)
+        positions = hierarchy.indices_of(ids).tolist()
+
+        own = [None] * len(hierarchy)
+        stored = [None] * len(hierarchy)
+        for position, (text, current) in zip(positions, rows):
+            own[position] = row_digest(text)
+            stored[position] = None if current == '\\N' else current
+
+        hashes = compute_hashes(hierarchy, own)
+        affiliate_ids = hierarchy.affiliate_ids.tolist()
+
+        changed = {}
+        for index, digest in enumerate(hashes):
+            value = digest.hex()
+            if value != stored[index]:
+                changed[affiliate_ids[index]] = value
+        return changed
+
+    def compute_incremental(self, cursor, since) -> Dict[int, str]:
+        """Recalcular somente os afiliados alterados e os caminhos até as raízes
+
+        Retorna None se a quantidade de nós afetados exigir o modo full.
+        """
+        cursor.execute("""
+            SELECT hierarchy_path::text
+            FROM fature_v2.affiliates_optimized
+            WHERE updated_at > %s OR network_hash IS NULL
+        """, (since,))
+
+        depth = {}
+        for (path,) in cursor.fetchall():
+            labels = path.split('.')
+            for position, label in enumerate(labels):
+                depth[int(label)] = position
+
+        if not depth:
+            return {}
+        if len(depth) > self.config['max_incremental_nodes']:
+            return None
+
+        dirty = list(depth)
+        own = {}
+        stored = {}
+        for line in self._load_rows(cursor, "WHERE affiliate_id = ANY(%(ids)s)", {'ids': dirty}):
+            text, current = line.rsplit('\t', 1)
+            affiliate_id = int(text.split('\t', 1)[0])
+            own[affiliate_id] = row_digest(text)
+            stored[affiliate_id] = None if current == '\\N' else current
+
+        # Filhos dos nós afetados, com o hash gravado (usado quando o filho não mudou)
+        cursor.execute("""
+            SELECT parent_affiliate_id, affiliate_id, network_hash
+            FROM fature_v2.affiliates_optimized
+            WHERE parent_affiliate_id = ANY(%s)
+            ORDER BY parent_affiliate_id, affiliate_id
+        """, (dirty,))
+        children = {}
+        for parent_id, child_id, child_hash in cursor.fetchall():
+            children.setdefault(parent_id, []).append((child_id, child_hash))
+
+        hashes = {}
+        for affiliate_id in sorted(dirty, key=lambda a: -depth[a]):
+            if affiliate_id not in own:
+                continue  # removido entre as consultas
+            child_digests = []
+            for child_id, child_hash in children.get(affiliate_id, []):
+                if child_id in hashes:
+                    child_digests.append(hashes[child_id])
+                elif child_hash is not None:
+                    child_digests.append(bytes.fromhex(child_hash))
+                else:
+                    # Filho sem hash e fora do conjunto: inconsistência, refazer tudo
+                    return None
+            hashes[affiliate_id] = combine_digest(own[affiliate_id], child_digests)
+
+        return {
+            affiliate_id: digest.hex()
+            for affiliate_id, digest in hashes.items()
+            if digest.hex() != stored[affiliate_id]
+        }
+
+    def refresh(self, full: bool = False) -> Dict:
+        """Atualizar network_hash (incremental por padrão)"""
+        start_time = time.time()
+        stats = {'mode': 'full' if full else 'incremental', 'changed': 0, 'updated': 0}
+
+        with self.connection('report') as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO fature_v2.refresh_state (job_name) VALUES (%s)
+                    ON CONFLICT (job_name) DO NOTHING
+                """, (JOB_NAME,))
+                cursor.execute("""
+                    SELECT last_run_at FROM fature_v2.refresh_state WHERE job_name = %s FOR UPDATE
+                """, (JOB_NAME,))
+                last_run_at = cursor.fetchone()[0]
+                cursor.execute("SELECT NOW()")
+                run_at = cursor.fetchone()[0]
+
+                changed = None
+                if not full and last_run_at is not None:
+                    since = last_run_at - timedelta(seconds=self.config['overlap_seconds'])
+                    changed = self.compute_incremental(cursor, since)
+
+                if changed is None:
+                    stats['mode'] = 'full'
+                    changed = self.compute_full(cursor)
+
+                stats['changed'] = len(changed)
+                stats['updated'] = self._write_changed(cursor, changed)
+                stats['duration_ms'] = int((time.time() - start_time) * 1000)
+
+                cursor.execute("""
+                    UPDATE fature_v2.refresh_state
+                    SET last_run_at = %s, details = %s, updated_at = NOW()
+                    WHERE job_name = %s
+                """, (run_at, json.dumps(stats), JOB_NAME))
+                cursor.execute("""
+                    INSERT INTO fature_v2.system_log (operation, details)
+                    VALUES ('network_hash_refresh', %s)
+                """, (json.dumps(stats),))
+
+        logger.info(f"✅ network_hash ({stats['mode']}): {stats['updated']} afiliados alterados "
+                    f"em {stats['duration_ms']}ms")
+        return stats
+
+    def get_hashes(self, affiliate_ids: List[int]) -> Dict[int, str]:
+        """Hashes atuais de um conjunto de afiliados (para comparação por jobs seguintes)"""
+        with self.connection('report') as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT affiliate_id, network_hash
+                    FROM fature_v2.affiliates_optimized
+                    WHERE affiliate_id = ANY(%s)
+                """, (list(affiliate_ids),))
+                return dict(cursor.fetchall())
+
+
+def main():
+    job = FatureNetworkHash()
+
+    if len(sys.argv) < 2:
+        print("Uso: python network_hash.py [comando]")
+        print("Comandos disponíveis:")
+        print("  refresh           - Recalcular hashes dos afiliados alterados e seus ancestrais")
+        print("  full              - Recalcular hashes de todos os afiliados")
+        print("  show AFILIADO...  - Exibir network_hash atual")
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    try:
+        if command in ("refresh", "full"):
+            job.refresh(full=(command == "full"))
+            sys.exit(0)
+
+        elif command == "show" and len(sys.argv) > 2:
+            for affiliate_id, value in job.get_hashes([int(a) for a in sys.argv[2:]]).items():
+                print(f"{affiliate_id}: {value}")
+            sys.exit(0)
+
+        else:
+            print(f"Comando não reconhecido: {command}")
+            sys.exit(1)
+
+    except psycopg2.Error as e:
+        logger.error(f"Erro ao atualizar network_hash: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+"""
+Gerenciador de Partições - Fature CPA v2
+
+Converte fature_v2.transactions (por transaction_date) e fature_v2.commissions
+(por created_at) em tabelas particionadas por intervalo de tempo e mantém as
+partições: cria partições futuras com antecedência e desanexa/arquiva as antigas
+em arquivos COPY compactados.
+
+A conversão é online, em quatro passos por tabela:
+
+1. prepare  - cria <tabela>_part particionada, com partições cobrindo os dados
+               existentes, e um trigger que espelha INSERT/UPDATE/DELETE da
+               tabela original na nova
+2. backfill - copia os dados existentes em blocos de chave primária
+               (um COMMIT por bloco, retomável)
+3. swap     - em uma transação curta: recupera o restante, troca os nomes,
+               transfere a sequência e recria as views dependentes
+4. maintain - (recorrente) cria partições futuras e arquiva as antigas
+
+Observações:
+- a chave primária passa a incluir a coluna de partição; por isso as FKs que
+  apontam para transactions(transaction_id) (commissions, commission_queue) são
+  removidas no swap
+- a tabela original permanece como <tabela>_legacy até ser removida manualmente
+- views materializadas dependentes não são recriadas (são listadas no swap)
+"""
+
+import psycopg2
+import logging
+import time
+import json
+import gzip
+import csv
+import os
+from datetime import datetime, date
+from typing import Dict, List, Tuple
+import sys
+
+from db_connection import database_config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SCHEMA = 'fature_v2'
+
+PARTITIONED_TABLES = {
+    'transactions': {
+        'key': 'transaction_date',
+        'pk': 'transaction_id',
+        'interval': 'month',
+        'indexes': [
+            "(affiliate_id, transaction_date)",
+            "(commission_eligible, commission_processed, transaction_date)",
+            "(transaction_type, transaction_date)"
+        ],
+        'foreign_keys': [
+            "FOREIGN KEY (affiliate_id) REFERENCES fature_v2.affiliates_optimized(affiliate_id)"
+        ],
+        'triggers': []
+    },
+    'commissions': {
+        'key': 'created_at',
+        'pk': 'commission_id',
+        'interval': 'month',
+        'indexes': [
+            "(beneficiary_affiliate_id, status)",
+            "(transaction_id, level_distance)",
+            "(status, created_at, batch_id)",
+            "(status, paid_at) WHERE status = 'paid'",
+            "(updated_at)"
+        ],
+        'foreign_keys': [
+            "FOREIGN KEY (beneficiary_affiliate_id) REFERENCES fature_v2.affiliates_optimized(affiliate_id)",
+            "FOREIGN KEY (source_affiliate_id) REFERENCES fature_v2.affiliates_optimized(affiliate_id)"
+        ],
+        # (nome, momento e evento, função): LIKE não copia triggers
+        'triggers': [
+            ('trg_commissions_updated_at', 'BEFORE UPDATE', 'set_updated_at')
+        ]
+    }
+}
+
+
+def period_start(value: date, interval: str) -> date:
+    """Início do período (dia ou mês) que contém a data"""
+    if interval == 'day':
+        return date(value.year, value.month, value.day)
+    return date(value.year, value.month, 1)
+
+
+def next_period(value: date, interval: str) -> date:
+    """Início do período seguinte"""
+    if interval == 'day':
+        return date.fromordinal(value.toordinal() + 1)
+    if value.month == 12:
+        return date(value.year + 1, 1, 1)
+    return date(value.year, value.month + 1, 1)
+
+
+def count_archive_rows(path: str) -> int:
+    """Registros de um arquivo CSV compactado com cabeçalho (campos podem conter quebras de linha)"""
+    with gzip.open(path, 'rt', newline='') as archive:
+        return max(sum(1 for _ in csv.reader(archive)) - 1, 0)
+
+
+def partition_name(table: str, start: date, interval: str) -> str:
+    """Nome da partição: transactions_p2025_06 (mensal) ou transactions_p2025_06_30 (diária)"""
+    if interval == 'day':
+        return f"{table}_p{start:%Y_%m_%d}"
+    return f"{table}_p{start:%Y_%m}"
+
+
+class FaturePartitionManager:
+    """Conversão e manutenção de partições por tempo"""
+
+    def __init__(self):
+        self.config = {
+            'database': database_config(),
+            'premake_periods': 3,
+            'retention_periods': {
+                'transactions': 24,
+                'commissions': 24
+            },
+            'backfill_chunk_size': 50000,
+            'backfill_pause_seconds': 0.05,
+            'archive_dir': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'partition_archive'),
+            'detach_concurrently': True
+        }
+
+    def connect_database(self):
+        """Conectar ao banco de dados"""
+        conn = psycopg2.connect(**self.config['database'])
+        conn.autocommit = False
+        return conn
+
+    def _table_config(self, table: str) -> Dict:
+        if table not in PARTITIONED_TABLES:
+            raise ValueError(f"Tabela não suportada: {table}")
+        return PARTITIONED_TABLES[table]
+
+    def is_partitioned(self, cursor, table: str) -> bool:
+        cursor.execute("""
+            SELECT c.relkind = 'p' FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = %s AND c.relname = %s
+        """, (SCHEMA, table))
+        row = cursor.fetchone()
+        return bool(row and row[0])
+
+    def list_partitions(self, cursor, table: str) -> List[Tuple[str, date, date]]:
+        """Partições existentes como (nome, início, fim), ordenadas por início"""
+        cursor.execute("""
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            JOIN pg_namespace n ON n.oid = p.relnamespace
+            WHERE n.nspname = %s AND p.relname = %s
+        """, (SCHEMA, table))
+
+        partitions = []
+        for name, bound in cursor.fetchall():
+            # FOR VALUES FROM ('2025-06-01 00:00:00') TO ('2025-07-01 00:00:00')
+            parts = bound.split("'")
+            if len(parts) >= 4:
+                start = datetime.fromisoformat(parts[1]).date()
+                end = datetime.fromisoformat(parts[3]).date()
+                partitions.append((name, start, end))
+        return sorted(partitions, key=lambda p: p[1])
+
+    def create_partition(self, cursor, parent: str, table: str, start: date, interval: str) -> str:
+        """Criar partição [start, próximo período) se ainda não existir"""
+        name = partition_name(table, start, interval)
+        end = next_period(start, interval)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {SCHEMA}.{name}
+            PARTITION OF {SCHEMA}.{parent}
+            FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}');
+        """)
+        return name
+
+    def ensure_partitions(self, cursor, parent: str, table: str, first: date, last: date) -> List[str]:
+        """Garantir partições de first até last + premake_periods"""
+        interval = self._table_config(table)['interval']
+        current = period_start(first, interval)
+        stop = period_start(last, interval)
+        for _ in range(self.config['premake_periods']):
+            stop = next_period(stop, interval)
+
+        created = []
+        while current <= stop:
+            created.append(self.create_partition(cursor, parent, table, current, interval))
+            current = next_period(current, interval)
+        return created
+
+    # ------------------------------------------------------------------
+    # Conversão online
+    # ------------------------------------------------------------------
+
+    def prepare(self, table: str) -> bool:
+        """Criar tabela particionada espelhada e o trigger de sincronização"""
+        cfg = self._table_config(table)
+        key, pk = cfg['key'], cfg['pk']
+        new_table = f"{table}_part"
+
+        conn = self.connect_database()
+        try:
+            with conn.cursor() as cursor:
+                if self.is_partitioned(cursor, table):
+                    logger.info(f"{SCHEMA}.{table} já é particionada")
+                    return True
+
+                cursor.execute(f"""
+                    SELECT MIN({key}), MAX({key}), COUNT(*) FILTER (WHERE {key} IS NULL)
+                    FROM {SCHEMA}.{table}
+                """)
+                first, last, null_keys = cursor.fetchone()
+                if null_keys:
+                    logger.error(f"{null_keys} linhas com {key} nulo em {table}; corrija antes de particionar")
+                    return False
+
+                today = date.today()
+                first = first.date() if first else today
+                last = max(last.date() if last else today, today)
+
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {SCHEMA}.{new_table} (
+                        LIKE {SCHEMA}.{table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS,
+                        PRIMARY KEY ({pk}, {key})
+                    ) PARTITION BY RANGE ({key});
+                """)
+                cursor.execute(f"ALTER TABLE {SCHEMA}.{new_table} ALTER COLUMN {key} SET NOT NULL;")
+
+                for i, columns in enumerate(cfg['indexes'], start=1):
+                    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{new_table}_{i} "
+                                   f"ON {SCHEMA}.{new_table} {columns};")
+                for i, fk in enumerate(cfg['foreign_keys'], start=1):
+                    cursor.execute(f"""
+                        DO $$ BEGIN
+                            ALTER TABLE {SCHEMA}.{new_table} ADD CONSTRAINT fk_{new_table}_{i} {fk};
+                        EXCEPTION WHEN duplicate_object THEN NULL;
+                        END $$;
+                    """)
+                for name, event, function in cfg['triggers']:
+                    cursor.execute(f"""
+                        DROP TRIGGER IF EXISTS {name} ON {SCHEMA}.{new_table};
+                        CREATE TRIGGER {name}
+                            {event} ON {SCHEMA}.{new_table}
+                            FOR EACH ROW EXECUTE FUNCTION {SCHEMA}.{function}();
+                    """)
+
+                created = self.ensure_partitions(cursor, new_table, table, first, last)
+
+                # Espelhar escritas da tabela original durante o backfill
+                cursor.execute(f"""
+                    CREATE OR REPLACE FUNCTION {SCHEMA}.sync_{new_table}()
+                    RETURNS TRIGGER AS $$
+                    BEGIN
+                        IF TG_OP = 'INSERT' THEN
+                            INSERT INTO {SCHEMA}.{new_table} SELECT NEW.*
+                            ON CONFLICT DO NOTHING;
+                            RETURN NEW;
+                        ELSIF TG_OP = 'UPDATE' THEN
+                            DELETE FROM {SCHEMA}.{new_table} WHERE {pk} = OLD.{pk};
+                            INSERT INTO {SCHEMA}.{new_table} SELECT NEW.*
+                            ON CONFLICT DO NOTHING;
+                            RETURN NEW;
+                        ELSE
+                            DELETE FROM {SCHEMA}.{new_table} WHERE {pk} = OLD.{pk};
+                            RETURN OLD;
+                        END IF;
+                    END;
+                    $$ LANGUAGE plpgsql;
+
+                    DROP TRIGGER IF EXISTS trg_sync_{new_table} ON {SCHEMA}.{table};
+                    CREATE TRIGGER trg_sync_{new_table}
+                        AFTER INSERT OR UPDATE OR DELETE ON {SCHEMA}.{table}
+                        FOR EACH ROW EXECUTE FUNCTION {SCHEMA}.sync_{new_table}();
+                """)
+
+                self._save_progress(cursor, table, {'last_id': 0, 'phase': 'prepared'})
+
+            conn.commit()
+            logger.info(f"✅ {SCHEMA}.{new_table} criada com {len(created)} partições")
+            return True
+
+        except Exception as e:
+            logger.error(f"Erro ao preparar particionamento de {table}: {e}")
+            conn.rollback()
+            return False
+        finally:
+            conn.close()
+
+    def _save_progress(self, cursor, table: str, progress: Dict):
+        cursor.execute("""
+            INSERT INTO fature_v2.refresh_state (job_name, details, last_run_at, updated_at)
+            VALUES (%s, %s, NOW(), NOW())
+            ON CONFLICT (job_name) DO UPDATE SET
+                details = EXCLUDED.details,
+                last_run_at = EXCLUDED.last_run_at,
+                updated_at = NOW()
+        """, (f"partition_{table}", json.dumps(progress)))
+
+    def _load_progress(self, cursor, table: str) -> Dict:
+        cursor.execute("SELECT details FROM fature_v2.refresh_state WHERE job_name = %s",
+                       (f"partition_{table}",))
+        row = cursor.fetchone()
+        return row[0] if row and row[0] else {}
+
+    def backfill(self, table: str) -> bool:
+        """Copiar linhas existentes para a tabela particionada em blocos de PK"""
+        cfg = self._table_config(table)
+        pk = cfg['pk']
+        new_table = f"{table}_part"
+        chunk = self.config['backfill_chunk_size']
+
+        conn = self.connect_database()
+        try:
+            with conn.cursor() as cursor:
+                progress = self._load_progress(cursor, table)
+                if progress.get('phase') not in ('prepared', 'backfilling'):
+                    logger.error(f"Execute 'prepare {table}' antes do backfill")
+                    return False
+
+                cursor.execute(f"SELECT COALESCE(MAX({pk}), 0) FROM {SCHEMA}.{table}")
+                max_id = cursor.fetchone()[0]
+            conn.commit()
+
+            last_id = progress.get('last_id', 0)
+            start_time = time.time()
+            copied = 0
+
+            while last_id < max_id:
+                upper = last_id + chunk
+                with conn.cursor() as cursor:
+                    # FOR SHARE bloqueia atualizações concorrentes do bloco e lê a versão mais recente
+                    cursor.execute(f"""
+                        INSERT INTO {SCHEMA}.{new_table}
+                        SELECT * FROM {SCHEMA}.{table}
+                        WHERE {pk} > %s AND {pk} <= %s
+                        FOR SHARE
+                        ON CONFLICT DO NOTHING
+                    """, (last_id, upper))
+                    copied += cursor.rowcount
+                    last_id = upper
+                    self._save_progress(cursor, table, {'last_id': last_id, 'phase': 'backfilling'})
+                conn.commit()
+
+                elapsed = time.time() - start_time
+                logger.info(f"Backfill {table}: até {pk}={min(last_id, max_id)} de {max_id} "
+                            f"({copied} linhas, {copied / elapsed if elapsed else 0:.0f} linhas/s)")
+                time.sleep(self.config['backfill_pause_seconds'])
+
+            with conn.cursor() as cursor:
+                self._save_progress(cursor, table, {'last_id': last_id, 'phase': 'backfilled'})
+            conn.commit()
+            logger.info(f"✅ Backfill de {table} concluído: {copied} linhas copiadas")
+            return True
+
+        except Exception as e:
+            logger.error(f"Erro no backfill de {table}: {e}")
+            conn.rollback()
+            return False
+        finally:
+            conn.close()
+
+    def swap(self, table: str) -> bool:
+        """Trocar a tabela original pela particionada em uma transação curta"""
+        cfg = self._table_config(table)
+        pk = cfg['pk']
+        new_table = f"{table}_part"
+        legacy = f"{table}_legacy"
+
+        conn = self.connect_database()
+        try:
+            with conn.cursor() as cursor:
+                progress = self._load_progress(cursor, table)
+                if progress.get('phase') != 'backfilled':
+                    logger.error(f"Backfill de {table} não concluído")
+                    return False
+
+                cursor.execute("SET LOCAL lock_timeout = '10s';")
+                cursor.execute(f"LOCK TABLE {SCHEMA}.{table} IN ACCESS EXCLUSIVE MODE;")
+
+                # Linhas acima da última marca do backfill (o trigger já cobre as novas)
+                cursor.execute(f"""
+                    INSERT INTO {SCHEMA}.{new_table}
+                    SELECT * FROM {SCHEMA}.{table} WHERE {pk} > %s
+                    ON CONFLICT DO NOTHING
+                """, (progress.get('last_id', 0),))
+
+                cursor.execute(f"SELECT COUNT(*) FROM {SCHEMA}.{table}")
+                old_count = cursor.fetchone()[0]
+                cursor.execute(f"SELECT COUNT(*) FROM {SCHEMA}.{new_table}")
+                new_count = cursor.fetchone()[0]
+                if old_count != new_count:
+                    raise RuntimeError(f"Contagens divergentes: original={old_count}, particionada={new_count}")
+
+                # Views dependentes (definições capturadas antes da troca de nomes)
+                cursor.execute("""
+                    SELECT DISTINCT v.oid::regclass::text, v.relkind, pg_get_viewdef(v.oid)
+                    FROM pg_depend d
+                    JOIN pg_rewrite r ON r.oid = d.objid
+                    JOIN pg_class v ON v.oid = r.ev_class
+                    WHERE d.refobjid = %s::regclass AND v.oid <> d.refobjid
+                """, (f"{SCHEMA}.{table}",))
+                dependent_views = cursor.fetchall()
+
+                # FKs de outras tabelas que apontam para a original
+                cursor.execute("""
+                    SELECT conrelid::regclass::text, conname
+                    FROM pg_constraint
+                    WHERE contype = 'f' AND confrelid = %s::regclass
+                """, (f"{SCHEMA}.{table}",))
+                for referencing, constraint in cursor.fetchall():
+                    cursor.execute(f"ALTER TABLE {referencing} DROP CONSTRAINT {constraint};")
+                    logger.warning(f"FK {constraint} de {referencing} removida (chave primária agora composta)")
+
+                cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", (f"{SCHEMA}.{table}", pk))
+                sequence = cursor.fetchone()[0]
+
+                cursor.execute(f"DROP TRIGGER IF EXISTS trg_sync_{new_table} ON {SCHEMA}.{table};")
+                cursor.execute(f"DROP FUNCTION IF EXISTS {SCHEMA}.sync_{new_table}();")
+                cursor.execute(f"ALTER TABLE {SCHEMA}.{table} RENAME TO {legacy};")
+                cursor.execute(f"ALTER TABLE {SCHEMA}.{new_table} RENAME TO {table};")
+                if sequence:
+                    cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {SCHEMA}.{table}.{pk};")
+
+                for view, kind, definition in dependent_views:
+                    if kind == 'v':
+                        cursor.execute(f"CREATE OR REPLACE VIEW {view} AS {definition}")
+                        logger.info(f"View {view} recriada sobre a tabela particionada")
+                    else:
+                        logger.warning(f"View materializada {view} continua apontando para {legacy}; "
+                                       f"recrie-a manualmente")
+
+                self._save_progress(cursor, table, {'last_id': progress.get('last_id', 0), 'phase': 'swapped'})
+
+            conn.commit()
+            logger.info(f"✅ {SCHEMA}.{table} agora é particionada; original mantida como {SCHEMA}.{legacy}")
+            return True
+
+        except Exception as e:
+            logger.error(f"Erro ao trocar {table}: {e}")
+            conn.rollback()
+            return False
+        finally:
+            conn.close()
+
+    # ------------------------------------------------------------------
+    # Manutenção recorrente
+    # ------------------------------------------------------------------
+
+    def archive_partition(self, table: str, partition: str) -> bool:
+        """Desanexar partição, exportar para COPY compactado, conferir o arquivo e removê-la
+        
+        A exportação roda com a partição já desanexada (sem escritas concorrentes). Se a
+        exportação ou a conferência falhar, a partição é anexada de volta com os mesmos
+        limites; o arquivo só recebe o nome final depois de conferido.
+        """
+        os.makedirs(self.config['archive_dir'], exist_ok=True)
+        path = os.path.join(self.config['archive_dir'], f"{partition}.csv.gz")
+        tmp_path = path + '.tmp'
+
+        conn = self.connect_database()
+        bound = None
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_get_expr(relpartbound, oid) FROM pg_class WHERE oid = %s::regclass",
+                               (f"{SCHEMA}.{partition}",))
+                bound = cursor.fetchone()[0]
+            conn.commit()
+
+            # DETACH ... CONCURRENTLY não pode rodar dentro de transação
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                concurrently = " CONCURRENTLY" if self.config['detach_concurrently'] else ""
+                cursor.execute(f"ALTER TABLE {SCHEMA}.{table} DETACH PARTITION {SCHEMA}.{partition}{concurrently};")
+            conn.autocommit = False
+
+        except Exception as e:
+            logger.error(f"Erro ao desanexar {partition}: {e}")
+            conn.close()
+            return False
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f"SELECT COUNT(*) FROM {SCHEMA}.{partition}")
+                expected = cursor.fetchone()[0]
+
+                with gzip.open(tmp_path, 'wt', newline='') as archive:
+                    cursor.copy_expert(f"COPY {SCHEMA}.{partition} TO STDOUT WITH (FORMAT csv, HEADER)", archive)
+
+                # Conferência pelo conteúdo do arquivo (rowcount não é confiável em COPY TO STDOUT)
+                exported = count_archive_rows(tmp_path)
+                if exported != expected:
+                    raise RuntimeError(f"Arquivo com {exported} de {expected} linhas")
+                os.replace(tmp_path, path)
+
+                cursor.execute(f"DROP TABLE {SCHEMA}.{partition};")
+                cursor.execute("""
+                    INSERT INTO fature_v2.system_log (operation, details)
+                    VALUES ('partition_archived', %s)
+                """, (json.dumps({'table': table, 'partition': partition, 'rows': expected, 'file': path}),))
+
+            conn.commit()
+            logger.info(f"Partição {partition} arquivada em {path} ({expected} linhas)")
+            return True
+
+        except Exception as e:
+            logger.error(f"Erro ao arquivar {partition}: {e}")
+            conn.rollback()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self._reattach_partition(table, partition, bound)
+            return False
+        finally:
+            conn.close()
+
+    def _reattach_partition(self, table: str, partition: str, bound: str):
+        """Anexar de volta uma partição desanexada cujo arquivamento falhou"""
+        statement = f"ALTER TABLE {SCHEMA}.{table} ATTACH PARTITION {SCHEMA}.{partition} {bound};"
+        conn = self.connect_database()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(statement)
+            conn.commit()
+            logger.warning(f"Partição {partition} anexada de volta a {table}")
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Partição {partition} continua desanexada ({e}); para reanexar: {statement}")
+        finally:
+            conn.close()
+
+    def maintain(self) -> Dict:
+        """Criar partições futuras e arquivar as que passaram da retenção"""
+        result = {'created': [], 'archived': [], 'errors': []}
+
+        for table, cfg in PARTITIONED_TABLES.items():
+            conn = self.connect_database()
+            try:
+                with conn.cursor() as cursor:
+                    if not self.is_partitioned(cursor, table):
+                        continue
+
+                    before = {p[0] for p in self.list_partitions(cursor, table)}
+                    today = date.today()
+                    self.ensure_partitions(cursor, table, table, today, today)
+                    partitions = self.list_partitions(cursor, table)
+                conn.commit()
+                result['created'].extend(p[0] for p in partitions if p[0] not in before)
+
+                cutoff = period_start(today, cfg['interval'])
+                for _ in range(self.config['retention_periods'][table]):
+                    cutoff = date.fromordinal(cutoff.toordinal() - 1)
+                    cutoff = period_start(cutoff, cfg['interval'])
+                expired = [p[0] for p in partitions if p[2] <= cutoff]
+
+            except Exception as e:
+                logger.error(f"Erro na manutenção de {table}: {e}")
+                conn.rollback()
+                result['errors'].append(f"{table}: {e}")
+                continue
+            finally:
+                conn.close()
+
+            for partition in expired:
+                if self.archive_partition(table, partition):
+                    result['archived'].append(partition)
+                else:
+                    result['errors'].append(f"{partition}: falha ao arquivar")
+
+        logger.info(f"Manutenção de partições: {len(result['created'])} criadas, "
+                    f"{len(result['archived'])} arquivadas, {len(result['errors'])} erros")
+        return result
+
+    def status(self) -> Dict:
+        """Situação de cada tabela gerenciada"""
+        status = {}
+        conn = self.connect_database()
+        try:
+            with conn.cursor() as cursor:
+                for table in PARTITIONED_TABLES:
+                    partitioned = self.is_partitioned(cursor, table)
+                    status[table] = {
+                        'partitioned': partitioned,
+                        'progress': self._load_progress(cursor, table),
+                        'partitions': [
+                            {'name': name, 'from': start.isoformat(), 'to': end.isoformat()}
+                            for name, start, end in self.list_partitions(
+                                cursor, table if partitioned else f"{table}_part")
+                        ]
+                    }
+        finally:
+            conn.close()
+        return status
+
+
+def main():
+    manager = FaturePartitionManager()
+
+    if len(sys.argv) < 2:
+        print("Uso: python partition_manager.py [comando] [tabela]")
+        print("Comandos disponíveis:")
+        print("  prepare TABELA   - Criar tabela particionada espelhada (transactions|commissions)")
+        print("  backfill TABELA  - Copiar dados existentes em blocos (retomável)")
+        print("  swap TABELA      - Trocar a tabela original pela particionada")
+        print("  maintain         - Criar partições futuras e arquivar antigas")
+        print("  status           - Exibir situação das tabelas")
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    if command in ("prepare", "backfill", "swap"):
+        if len(sys.argv) < 3:
+            print(f"Informe a tabela: {', '.join(PARTITIONED_TABLES)}")
+            sys.exit(1)
+        success = getattr(manager, command)(sys.argv[2])
+        sys.exit(0 if success else 1)
+
+    elif command == "maintain":
+        result = manager.maintain()
+        sys.exit(0 if not result['errors'] else 1)
+
+    elif command == "status":
+        print(json.dumps(manager.status(), indent=2, default=str))
+        sys.exit(0)
+
+    else:
+        print(f"Comando não reconhecido: {command}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
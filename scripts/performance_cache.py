@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+Cache em Duas Camadas - Fature CPA v2
+
+Camada 1: LRU em memória com TTL e limite de entradas, consultada sem acessar o banco.
+Camada 2: tabela fature_v2.performance_cache, com escrita assíncrona (write-behind).
+
+Os acessos (hit_count) são acumulados em memória e gravados em lote
+periodicamente, em vez de um UPDATE por leitura. Chaves frias são calculadas
+uma única vez mesmo com várias threads pedindo ao mesmo tempo (single-flight).
+
+A validade local usa time.monotonic(); expires_at no banco é sempre calculado
+com o NOW() do próprio banco. Cada invalidate() avança a geração da chave, e
+valores lidos ou calculados antes dela não voltam para nenhuma das camadas.
+"""
+
+import psycopg2
+import psycopg2.extras
+import logging
+import threading
+import time
+import json
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+import sys
+
+from db_connection import database_config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """Cálculo em andamento de uma chave (single-flight)"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.generation = 0
+
+
+class FaturePerformanceCache:
+    """Cache LRU/TTL local com performance_cache como segunda camada"""
+
+    def __init__(self):
+        self.config = {
+            'database': database_config(),
+            'max_entries': 10000,
+            'default_ttl_seconds': 3600,
+            'flush_interval_seconds': 30
+        }
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # chave -> (valor, expira_em monotônico)
+        self._flights = {}
+        self._generations = {}          # chave -> número de invalidações
+        self._pending_writes = {}       # chave -> (valor, expira_em monotônico, geração)
+        self._pending_hits = {}         # chave -> acessos ainda não gravados
+        self._conn = None
+        self._db_lock = threading.Lock()  # a conexão é compartilhada entre threads
+        self._flusher = None
+        self._stop = threading.Event()
+
+        self.stats = {
+            'local_hits': 0,
+            'db_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'flushes': 0,
+            'flush_errors': 0
+        }
+
+    def connect_database(self):
+        """Conectar ao banco de dados"""
+        return psycopg2.connect(**self.config['database'])
+
+    def _connection(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = self.connect_database()
+        return self._conn
+
+    # ------------------------------------------------------------------
+    # Camada local
+    # ------------------------------------------------------------------
+
+    def _get_local(self, key: str):
+        """Buscar na LRU local; retorna (encontrado, valor). Requer _lock."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+
+        if entry[1] <= time.monotonic():
+            del self._entries[key]
+            self.stats['expirations'] += 1
+            return False, None
+
+        self._entries.move_to_end(key)
+        return True, entry[0]
+
+    def _put_local(self, key: str, value: Any, expires_at: float):
+        """Inserir na LRU local, descartando as menos usadas. Requer _lock."""
+        if expires_at <= time.monotonic():
+            return
+
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.config['max_entries']:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+
+    def get(self, key: str, compute: Optional[Callable[[], Any]] = None,
+            ttl_seconds: Optional[int] = None) -> Any:
+        """Obter valor do cache, calculando-o com `compute` em caso de miss
+
+        Ordem: LRU local -> performance_cache -> compute(). Apenas uma thread calcula
+        cada chave fria; as demais aguardam o resultado.
+        """
+        with self._lock:
+            found, value = self._get_local(key)
+            if found:
+                self.stats['local_hits'] += 1
+                self._pending_hits[key] = self._pending_hits.get(key, 0) + 1
+                return value
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                flight.generation = self._generations.get(key, 0)
+                self._flights[key] = flight
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = self._load(key, compute, ttl_seconds, flight.generation)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                # invalidate() pode ter desligado este cálculo da chave
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+
+        return flight.value
+
+    def _load(self, key: str, compute: Optional[Callable[[], Any]], ttl_seconds: Optional[int],
+              generation: int) -> Any:
+        """Buscar na segunda camada ou calcular o valor"""
+        row = None
+        try:
+            row = self._fetch_db(key)
+        except psycopg2.Error as e:
+            logger.warning(f"performance_cache indisponível para {key}: {e}")
+            self._reset_connection()
+
+        if row is not None:
+            value, remaining_seconds = row
+            with self._lock:
+                self.stats['db_hits'] += 1
+                if self._generations.get(key, 0) == generation:
+                    self._pending_hits[key] = self._pending_hits.get(key, 0) + 1
+                    self._put_local(key, value, time.monotonic() + remaining_seconds)
+            return value
+
+        with self._lock:
+            self.stats['misses'] += 1
+
+        if compute is None:
+            return None
+
+        value = compute()
+        self._store(key, value, ttl_seconds, generation)
+        return value
+
+    def _store(self, key: str, value: Any, ttl_seconds: Optional[int], generation: Optional[int]):
+        """Gravar na LRU local e agendar a gravação, se a chave não foi invalidada desde `generation`"""
+        ttl = self.config['default_ttl_seconds'] if ttl_seconds is None else ttl_seconds
+        if ttl <= 0:
+            return
+        expires_at = time.monotonic() + ttl
+
+        with self._lock:
+            current = self._generations.get(key, 0)
+            if generation is not None and generation != current:
+                return
+            self._put_local(key, value, expires_at)
+            self._pending_writes[key] = (value, expires_at, current)
+
+    def set(self, key: str, value: Any, ttl_seconds: Optional[int] = None):
+        """Gravar na LRU local e agendar gravação em performance_cache
+
+        ttl_seconds=None usa default_ttl_seconds; 0 não guarda o valor.
+        """
+        self._store(key, value, ttl_seconds, None)
+
+    def invalidate(self, key: str):
+        """Remover chave das duas camadas"""
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._entries.pop(key, None)
+            self._flights.pop(key, None)
+            self._pending_writes.pop(key, None)
+            self._pending_hits.pop(key, None)
+
+        try:
+            with self._db_lock:
+                conn = self._connection()
+                with conn.cursor() as cursor:
+                    cursor.execute("DELETE FROM fature_v2.performance_cache WHERE cache_key = %s", (key,))
+                conn.commit()
+        except psycopg2.Error as e:
+            logger.warning(f"Erro ao invalidar {key}: {e}")
+            self._reset_connection()
+
+    def hit_rates(self) -> Dict:
+        """Taxas de acerto por camada"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['local_entries'] = len(self._entries)
+            stats['pending_writes'] = len(self._pending_writes)
+
+        total = stats['local_hits'] + stats['db_hits'] + stats['misses']
+        stats['requests'] = total
+        stats['local_hit_rate'] = stats['local_hits'] / total if total else 0.0
+        stats['db_hit_rate'] = stats['db_hits'] / total if total else 0.0
+        stats['miss_rate'] = stats['misses'] / total if total else 0.0
+        return stats
+
+    # ------------------------------------------------------------------
+    # Segunda camada (banco)
+    # ------------------------------------------------------------------
+
+    def _reset_connection(self):
+        with self._db_lock:
+            try:
+                if self._conn is not None:
+                    self._conn.close()
+            except psycopg2.Error:
+                pass
+            self._conn = None
+
+    def _fetch_db(self, key: str):
+        """Ler uma entrada válida de performance_cache: (valor, segundos restantes pelo relógio do banco)"""
+        with self._db_lock:
+            conn = self._connection()
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT cache_data, EXTRACT(EPOCH FROM expires_at - NOW())::FLOAT
+                    FROM fature_v2.performance_cache
+                    WHERE cache_key = %s AND expires_at > NOW()
+                """, (key,))
+                row = cursor.fetchone()
+            conn.commit()
+        return row
+
+    def flush(self) -> Dict:
+        """Gravar entradas novas e contadores de acesso acumulados em lote"""
+        with self._lock:
+            writes, self._pending_writes = self._pending_writes, {}
+            hits, self._pending_hits = self._pending_hits, {}
+
+        if not writes and not hits:
+            return {'writes': 0, 'hits': 0}
+
+        try:
+            with self._db_lock:
+                # invalidate() avança a geração antes do DELETE, que espera _db_lock:
+                # conferir aqui impede que um valor invalidado volte ao banco
+                now = time.monotonic()
+                with self._lock:
+                    rows = [(key, json.dumps(value, default=str), expires_at - now)
+                            for key, (value, expires_at, generation) in writes.items()
+                            if generation == self._generations.get(key, 0) and expires_at > now]
+
+                conn = self._connection()
+                with conn.cursor() as cursor:
+                    if rows:
+                        psycopg2.extras.execute_values(cursor, """
+                            INSERT INTO fature_v2.performance_cache (cache_key, cache_data, expires_at)
+                            VALUES %s
+                            ON CONFLICT (cache_key) DO UPDATE SET
+                                cache_data = EXCLUDED.cache_data,
+                                expires_at = EXCLUDED.expires_at,
+                                updated_at = NOW()
+                        """, rows, template="(%s, %s, NOW() + %s * INTERVAL '1 second')")
+
+                    if hits:
+                        psycopg2.extras.execute_values(cursor, """
+                            UPDATE fature_v2.performance_cache c
+                            SET hit_count = c.hit_count + h.hits,
+                                updated_at = NOW()
+                            FROM (VALUES %s) AS h(cache_key, hits)
+                            WHERE c.cache_key = h.cache_key
+                        """, list(hits.items()))
+
+                conn.commit()
+            with self._lock:
+                self.stats['flushes'] += 1
+            return {'writes': len(rows), 'hits': sum(hits.values())}
+
+        except psycopg2.Error as e:
+            logger.error(f"Erro ao gravar cache em lote: {e}")
+            self._reset_connection()
+
+            # Devolver pendências sem sobrescrever valores mais novos
+            with self._lock:
+                self.stats['flush_errors'] += 1
+                for key, entry in writes.items():
+                    self._pending_writes.setdefault(key, entry)
+                for key, count in hits.items():
+                    self._pending_hits[key] = self._pending_hits.get(key, 0) + count
+            return {'writes': 0, 'hits': 0, 'error': str(e)}
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.config['flush_interval_seconds']):
+            self.flush()
+
+    def start(self):
+        """Iniciar a thread de gravação periódica"""
+        if self._flusher is None or not self._flusher.is_alive():
+            self._stop.clear()
+            self._flusher = threading.Thread(target=self._flush_loop, name='cache-flusher', daemon=True)
+            self._flusher.start()
+
+    def close(self):
+        """Parar a thread de gravação e descarregar pendências"""
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+        self._reset_connection()
+
+
+def main():
+    cache = FaturePerformanceCache()
+
+    if len(sys.argv) < 2:
+        print("Uso: python performance_cache.py [comando]")
+        print("Comandos disponíveis:")
+        print("  get CHAVE           - Ler uma chave (LRU local -> performance_cache)")
+        print("  invalidate CHAVE    - Remover chave das duas camadas")
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    try:
+        if command == "get" and len(sys.argv) > 2:
+            value = cache.get(sys.argv[2])
+            print(json.dumps(value, indent=2, default=str) if value is not None else "(miss)")
+            print(json.dumps(cache.hit_rates(), indent=2))
+
+        elif command == "invalidate" and len(sys.argv) > 2:
+            cache.invalidate(sys.argv[2])
+            print(f"Chave {sys.argv[2]} removida")
+
+        else:
+            print(f"Comando não reconhecido: {command}")
+            sys.exit(1)
+    finally:
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+Instrumentação de Consultas - Fature CPA v2
+
+Registra em fature_v2.query_performance_log os comandos executados pelos scripts
+de migração, rollback e monitoramento (perfis de sessão migration, rollback e
+monitor do pool em db_connection).
+
+- cada execute/executemany/copy_expert é cronometrado no cursor
+- o SQL é normalizado (literais, listas e espaços) e identificado por SHA-256; a
+  normalização fica em cache por texto de comando
+- amostragem por taxa (sample_rate); comandos lentos (>= slow_ms) são sempre
+  registrados e a taxa aplicada vai em parameters->>'sample_rate', para que totais
+  e médias possam ser reponderados
+- os registros ficam em buffer limitado em memória e são gravados em lote via COPY
+  por uma thread em segundo plano, com conexão própria (fora do pool)
+
+O custo do registro no caminho do comando (sorteio, cache e append no buffer) é
+acompanhado em stats; o objetivo é ficar abaixo de 1% do tempo dos comandos.
+
+Configuração por ambiente:
+- FATURE_QUERY_LOG=0 desativa a instrumentação
+- FATURE_QUERY_LOG_SAMPLE_RATE (padrão 1.0)
+- FATURE_QUERY_LOG_PROFILES (padrão migration,rollback,monitor)
+- FATURE_SLOW_QUERY_MS (padrão 100): limite de consulta lenta, o mesmo usado pelo
+  monitor, pelo resumo horário e pela view real_time_metrics (fature.slow_query_ms)
+"""
+
+import psycopg2
+import psycopg2.extensions
+import logging
+import threading
+import hashlib
+import random
+import atexit
+import time
+import json
+import io
+import os
+import re
+from collections import deque
+from typing import Dict, Optional, Tuple
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Limite único de consulta lenta (ms)
+SLOW_QUERY_MS = int(os.environ.get('FATURE_SLOW_QUERY_MS', '100'))
+
+RECORDER_SETTINGS = {
+    'sample_rate': float(os.environ.get('FATURE_QUERY_LOG_SAMPLE_RATE', '1.0')),
+    'slow_ms': SLOW_QUERY_MS,
+    'profiles': os.environ.get('FATURE_QUERY_LOG_PROFILES', 'migration,rollback,monitor').split(','),
+    'flush_interval_seconds': 2.0,
+    'flush_batch_size': 500,
+    'max_buffer': 50000,
+    'normalize_cache_size': 2048,
+    'max_statement_chars': 500
+}
+
+_COMMENT = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'(?<![\w$.])-?\d+(?:\.\d+)?(?![\w$])')
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s')
+_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_ARRAY = re.compile(r'ARRAY\[[^\]]*\]', re.I)
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_sql(query: str) -> str:
+    """Forma canônica do comando: sem comentários, literais e placeholders viram ?"""
+    text = _COMMENT.sub(' ', query)
+    text = _STRING.sub('?', text)
+    text = _PLACEHOLDER.sub('?', text)
+    text = _NUMBER.sub('?', text)
+    text = _ARRAY.sub('ARRAY[?]', text)
+    text = _LIST.sub('(?)', text)
+    return _SPACES.sub(' ', text).strip().rstrip(';').strip()
+
+
+def statement_verb(normalized: str) -> str:
+    """Primeira palavra do comando (SELECT, UPDATE, COPY...)"""
+    return normalized.split(' ', 1)[0].upper() if normalized else 'EMPTY'
+
+
+class QueryRecorder:
+    """Buffer de registros de consultas com gravação em lote em segundo plano"""
+
+    def __init__(self, params: Optional[Dict], settings: Optional[Dict] = None):
+        """params: conexão para a gravação (None = apenas estatísticas, sem gravar)"""
+        self.params = dict(params) if params else None
+        self.settings = dict(RECORDER_SETTINGS, **(settings or {}))
+        self.profiles = frozenset(self.settings['profiles'])
+        self.sample_rate = self.settings['sample_rate']
+        self.slow_ns = int(self.settings['slow_ms'] * 1_000_000)
+
+        self._buffer = deque(maxlen=self.settings['max_buffer'])
+        self._cache = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+        self.stats = {'statements': 0, 'recorded': 0, 'written': 0, 'dropped': 0, 'flush_errors': 0,
+                      'statement_ns': 0, 'record_ns': 0}
+
+    # ------------------------------------------------------------------
+    # Caminho do comando
+    # ------------------------------------------------------------------
+
+    def _describe(self, query) -> Tuple[str, str, str]:
+        """(verbo, hash, texto normalizado), com cache por texto de comando"""
+        entry = self._cache.get(query)
+        if entry is None:
+            normalized = normalize_sql(query)
+            entry = (statement_verb(normalized),
+                     hashlib.sha256(normalized.encode('utf-8')).hexdigest(),
+                     normalized[:self.settings['max_statement_chars']])
+            if len(self._cache) >= self.settings['normalize_cache_size']:
+                self._cache.clear()
+            self._cache[query] = entry
+        return entry
+
+    def record(self, source: str, query, duration_ns: int, rowcount: int):
+        """Registrar um comando executado (chamado pelo cursor instrumentado)"""
+        stats = self.stats
+        stats['statements'] += 1
+        stats['statement_ns'] += duration_ns
+
+        slow = duration_ns >= self.slow_ns
+        if not slow and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+
+        start = time.perf_counter_ns()
+        if not isinstance(query, str):
+            query = query.decode('utf-8') if isinstance(query, bytes) else str(query)
+        verb, digest, normalized = self._describe(query)
+
+        if len(self._buffer) == self._buffer.maxlen:
+            stats['dropped'] += 1
+        self._buffer.append((
+            f"{source}.{verb}",
+            duration_ns // 1_000_000,
+            rowcount if 0 <= rowcount < 2 ** 31 else None,
+            digest,
+            1.0 if slow else self.sample_rate,
+            normalized
+        ))
+        stats['recorded'] += 1
+
+        if self.params is not None:
+            if self._thread is None:
+                self._start()
+            if len(self._buffer) >= self.settings['flush_batch_size']:
+                self._wake.set()
+        stats['record_ns'] += time.perf_counter_ns() - start
+
+    @property
+    def overhead_ratio(self) -> float:
+        """Tempo gasto registrando / tempo dos comandos"""
+        if not self.stats['statement_ns']:
+            return 0.0
+        return self.stats['record_ns'] / self.stats['statement_ns']
+
+    # ------------------------------------------------------------------
+    # Gravação em segundo plano
+    # ------------------------------------------------------------------
+
+    def _start(self):
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='fature-query-log', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        conn = None
+        while not self._stop.is_set():
+            self._wake.wait(self.settings['flush_interval_seconds'])
+            self._wake.clear()
+            conn = self._flush(conn)
+        self._flush(conn)
+        if conn is not None and not conn.closed:
+            conn.close()
+
+    def _flush(self, conn):
+        """Gravar o conteúdo atual do buffer via COPY; retorna a conexão (reaberta se necessário)"""
+        rows = []
+        while self._buffer:
+            try:
+                rows.append(self._buffer.popleft())
+            except IndexError:
+                break
+        if not rows:
+            return conn
+
+        buffer = io.StringIO()
+        for query_type, duration_ms, rowcount, digest, rate, normalized in rows:
+            parameters = json.dumps({'sample_rate': rate, 'statement': normalized}).replace('\\', '\\\\')
+            affected = '\\N' if rowcount is None else rowcount
+            buffer.write(f"{query_type}\t{duration_ms}\t{affected}\t{digest}\t{parameters}\n")
+        buffer.seek(0)
+
+        try:
+            if conn is None or conn.closed:
+                conn = psycopg2.connect(**dict(self.params, application_name='fature-query-log'))
+                conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.copy_expert("""
+                    COPY fature_v2.query_performance_log
+                        (query_type, query_duration_ms, affected_rows, query_hash, parameters)
+                    FROM STDIN
+                """, buffer)
+            self.stats['written'] += len(rows)
+        except psycopg2.Error as e:
+            self.stats['flush_errors'] += 1
+            self.stats['dropped'] += len(rows)
+            logger.warning(f"Falha ao gravar {len(rows)} registros em query_performance_log: {e}")
+            if conn is not None and not conn.closed:
+                conn.close()
+            conn = None
+        return conn
+
+    def close(self, timeout: float = 10.0):
+        """Gravar o restante do buffer e encerrar a thread"""
+        if self._thread is not None:
+            self._stop.set()
+            self._wake.set()
+            self._thread.join(timeout)
+            self._thread = None
+        if self.stats['statements']:
+            logger.info(f"Instrumentação: {self.stats['recorded']}/{self.stats['statements']} comandos "
+                        f"registrados, {self.stats['written']} gravados, "
+                        f"custo {self.overhead_ratio * 100:.3f}% do tempo dos comandos")
+
+
+# ----------------------------------------------------------------------
+# Cursores e conexões instrumentados
+# ----------------------------------------------------------------------
+
+_cursor_classes = {}
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def _instrumented_cursor_class(base):
+    """Subclasse de `base` (cursor, RealDictCursor...) que cronometra os comandos"""
+    cls = _cursor_classes.get(base)
+    if cls is not None:
+        return cls
+
+    class InstrumentedCursor(base):
+        def execute(self, query, vars=None):
+            start = time.perf_counter_ns()
+            try:
+                return super().execute(query, vars)
+            finally:
+                self.fature_recorder.record(self.fature_source, query,
+                                            time.perf_counter_ns() - start, self.rowcount)
+
+        def executemany(self, query, vars_list):
+            start = time.perf_counter_ns()
+            try:
+                return super().executemany(query, vars_list)
+            finally:
+                self.fature_recorder.record(self.fature_source, query,
+                                            time.perf_counter_ns() - start, self.rowcount)
+
+        def copy_expert(self, sql, file, size=8192):
+            start = time.perf_counter_ns()
+            try:
+                return super().copy_expert(sql, file, size)
+            finally:
+                self.fature_recorder.record(self.fature_source, sql,
+                                            time.perf_counter_ns() - start, self.rowcount)
+
+    InstrumentedCursor.__name__ = f"Instrumented{base.__name__}"
+    _cursor_classes[base] = InstrumentedCursor
+    return InstrumentedCursor
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """Conexão cujos cursores são instrumentados quando o perfil atual está habilitado"""
+
+    fature_profile = None
+
+    def cursor(self, *args, **kwargs):
+        recorder = _recorder
+        if recorder is None or self.fature_profile not in recorder.profiles:
+            return super().cursor(*args, **kwargs)
+
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _instrumented_cursor_class(base)
+        cursor = super().cursor(*args, **kwargs)
+        cursor.fature_recorder = recorder
+        cursor.fature_source = self.fature_profile
+        return cursor
+
+
+def configure_recorder(params: Dict, settings: Optional[Dict] = None) -> Optional[QueryRecorder]:
+    """Criar (uma vez por processo) o recorder que grava no banco de `params`"""
+    global _recorder
+    if os.environ.get('FATURE_QUERY_LOG', '1') == '0':
+        return None
+
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = QueryRecorder(params, settings)
+            atexit.register(_recorder.close)
+        return _recorder
+
+
+def get_recorder() -> Optional[QueryRecorder]:
+    return _recorder
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Uso: python query_instrumentation.py [comando]")
+        print("Comandos disponíveis:")
+        print("  normalize SQL       - Exibir o SQL normalizado e o hash")
+        print("  overhead [N] [MS]   - Medir o custo do registro (N comandos de MS ms, sem banco)")
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    if command == "normalize" and len(sys.argv) > 2:
+        normalized = normalize_sql(sys.argv[2])
+        print(normalized)
+        print(hashlib.sha256(normalized.encode('utf-8')).hexdigest())
+        sys.exit(0)
+
+    elif command == "overhead":
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        statement_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+        recorder = QueryRecorder(None, {'max_buffer': count})
+        queries = [f"SELECT * FROM fature_v2.affiliates_optimized WHERE affiliate_id = %s /* {i} */"
+                   for i in range(50)]
+
+        for i in range(count):
+            recorder.record('monitor', queries[i % len(queries)], int(statement_ms * 1_000_000), 1)
+
+        per_record_us = recorder.stats['record_ns'] / max(recorder.stats['recorded'], 1) / 1000
+        ratio = recorder.overhead_ratio * 100
+        print(f"Registros: {recorder.stats['recorded']:,}")
+        print(f"Custo por registro: {per_record_us:.2f}µs")
+        print(f"{'✅' if ratio < 1.0 else '❌'} Custo relativo a comandos de {statement_ms}ms: {ratio:.3f}%")
+        sys.exit(0 if ratio < 1.0 else 1)
+
+    else:
+        print(f"Comando não reconhecido: {command}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
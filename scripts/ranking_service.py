@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Serviço de Rankings Top-K por Nível - Fature CPA v2
+
+Mantém em memória os contadores de indicações por nível (level_referrals) e,
+para cada nível, um heap com os K afiliados de maior contagem. Novos afiliados
+incrementam os contadores dos seus ancestrais e atualizam os heaps de forma
+incremental, então qualquer ranking (nível, limite) é servido sem consultar
+o banco. Substitui o GROUP BY sobre hierarchy_index de
+fature_v2.get_top_performers_cached.
+
+Empates são desempatados pelo menor affiliate_id.
+"""
+
+import psycopg2
+import numpy as np
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+import sys
+
+from db_connection import database_config
+from compact_hierarchy import CompactHierarchy
+from level_referrals import FatureLevelReferrals
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class TopKHeap:
+    """Top-K de um nível para contadores que só crescem
+
+    Heap mínimo de (contagem, -affiliate_id) com remoção preguiçosa: entradas
+    desatualizadas ficam no heap até chegarem ao topo ou até a compactação.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.members = {}       # affiliate_id -> contagem atual no top-K
+        self.heap = []
+        self._sorted = None
+
+    def _is_current(self, entry: Tuple[int, int]) -> bool:
+        return self.members.get(-entry[1]) == entry[0]
+
+    def _min_entry(self) -> Optional[Tuple[int, int]]:
+        while self.heap and not self._is_current(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0] if self.heap else None
+
+    def offer(self, affiliate_id: int, count: int):
+        """Informar a contagem atual de um afiliado"""
+        key = (count, -affiliate_id)
+
+        if affiliate_id in self.members:
+            if self.members[affiliate_id] == count:
+                return
+            self.members[affiliate_id] = count
+            heapq.heappush(self.heap, key)
+        elif len(self.members) < self.capacity:
+            self.members[affiliate_id] = count
+            heapq.heappush(self.heap, key)
+        else:
+            current_min = self._min_entry()
+            if key <= current_min:
+                return
+            heapq.heappop(self.heap)
+            del self.members[-current_min[1]]
+            self.members[affiliate_id] = count
+            heapq.heappush(self.heap, key)
+
+        self._sorted = None
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(c, -a) for a, c in self.members.items()]
+            heapq.heapify(self.heap)
+
+    def top(self, limit: int) -> List[Tuple[int, int]]:
+        """Os `limit` primeiros como (affiliate_id, contagem)"""
+        if self._sorted is None:
+            self._sorted = sorted(self.members.items(), key=lambda item: (-item[1], item[0]))
+        return self._sorted[:limit]
+
+
+class FatureRankingService:
+    """Rankings por nível atualizados incrementalmente"""
+
+    def __init__(self):
+        self.config = {
+            'database': database_config(),
+            'max_levels': 5,
+            'top_k': 100,
+            'overlap_seconds': 300
+        }
+
+        self.hierarchy = None
+        self.counts = None        # linhas = afiliados (hierarquia + novos), colunas = níveis
+        self.parent = None        # linha do pai (-1 para raiz)
+        self.size = 0
+        self.new_rows = {}        # affiliate_id -> linha, para afiliados após o carregamento
+        self.new_ids = []
+        self.heaps = {}
+        self.pending = []         # afiliados cujo pai ainda não chegou
+        self.watermark = datetime.min  # maior created_at já lido
+
+    def connect_database(self):
+        """Conectar ao banco de dados"""
+        return psycopg2.connect(**self.config['database'])
+
+    # ------------------------------------------------------------------
+    # Carregamento
+    # ------------------------------------------------------------------
+
+    def load(self, conn):
+        """Carregar hierarquia, calcular contadores e montar os heaps"""
+        start_time = time.time()
+        max_levels = self.config['max_levels']
+
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT COALESCE(MAX(created_at), '-infinity'::TIMESTAMP)
+                FROM fature_v2.affiliates_optimized
+            """)
+            watermark = cursor.fetchone()[0]
+
+        self.hierarchy = CompactHierarchy.from_database(conn)
+        counter = FatureLevelReferrals()
+        counter.config['max_levels'] = max_levels
+        counts = counter.compute_counts(self.hierarchy)
+
+        self.size = len(self.hierarchy)
+        self.counts = counts
+        self.parent = self.hierarchy.parent.astype(np.int64)
+        self.new_rows = {}
+        self.new_ids = []
+        self.watermark = watermark
+
+        self.heaps = {}
+        for level in range(1, max_levels + 1):
+            heap = TopKHeap(self.config['top_k'])
+            for affiliate_id, count in self._rank_rows(level, self.config['top_k']):
+                heap.offer(affiliate_id, count)
+            self.heaps[level] = heap
+
+        logger.info(f"Rankings carregados para {self.size} afiliados "
+                    f"({(time.time() - start_time) * 1000:.0f}ms)")
+
+    # ------------------------------------------------------------------
+    # Atualização incremental
+    # ------------------------------------------------------------------
+
+    def _row_of(self, affiliate_id: int) -> int:
+        row = self.new_rows.get(affiliate_id)
+        if row is not None:
+            return row
+        return self.hierarchy.index_of(affiliate_id)
+
+    def _affiliate_of(self, row: int) -> int:
+        if row < len(self.hierarchy):
+            return int(self.hierarchy.affiliate_ids[row])
+        return self.new_ids[row - len(self.hierarchy)]
+
+    def _rank_rows(self, level: int, limit: int) -> List[Tuple[int, int]]:
+        """Ranking completo sobre o array de contadores (contagem desc, affiliate_id asc)"""
+        ids = np.concatenate([self.hierarchy.affiliate_ids, np.array(self.new_ids, dtype=np.int64)])
+        column = self.counts[:self.size, level]
+        rows = np.lexsort((ids, -column))[:limit]
+        return [(int(ids[row]), int(column[row])) for row in rows if column[row] > 0]
+
+    def _append_row(self, affiliate_id: int, parent_row: int) -> int:
+        if self.size == len(self.counts):
+            capacity = max(1024, len(self.counts) * 2)
+            self.counts = np.resize(self.counts, (capacity, self.counts.shape[1]))
+            self.counts[self.size:] = 0
+            self.parent = np.resize(self.parent, capacity)
+
+        row = self.size
+        self.counts[row] = 0
+        self.counts[row, 0] = 1
+        self.parent[row] = parent_row
+        self.new_rows[affiliate_id] = row
+        self.new_ids.append(affiliate_id)
+        self.size += 1
+        return row
+
+    def _is_known(self, affiliate_id: int) -> bool:
+        try:
+            self._row_of(affiliate_id)
+            return True
+        except KeyError:
+            return False
+
+    def add_affiliate(self, affiliate_id: int, parent_id: Optional[int]) -> bool:
+        """Registrar um novo afiliado e atualizar os contadores dos ancestrais
+
+        Retorna False se o pai ainda não é conhecido (o afiliado fica pendente).
+        """
+        if self._is_known(affiliate_id):
+            return True  # já contabilizado
+
+        if parent_id:
+            try:
+                parent_row = self._row_of(parent_id)
+            except KeyError:
+                return False
+        else:
+            parent_row = -1
+
+        self._append_row(affiliate_id, parent_row)
+
+        ancestor = parent_row
+        for level in range(1, self.config['max_levels'] + 1):
+            if ancestor < 0:
+                break
+            self.counts[ancestor, level] += 1
+            self.heaps[level].offer(self._affiliate_of(ancestor), int(self.counts[ancestor, level]))
+            ancestor = int(self.parent[ancestor])
+
+        return True
+
+    def sync(self, conn) -> int:
+        """Aplicar afiliados inseridos no banco desde a última sincronização
+
+        created_at é o início da transação que inseriu o afiliado, então uma
+        linha pode ficar visível depois de outras mais recentes. A leitura
+        recua overlap_seconds antes da marca d'água e descarta os afiliados
+        já contabilizados.
+        """
+        since = self.watermark
+        if since > datetime.min + timedelta(seconds=self.config['overlap_seconds']):
+            since -= timedelta(seconds=self.config['overlap_seconds'])
+
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT affiliate_id, parent_affiliate_id, created_at
+                FROM fature_v2.affiliates_optimized
+                WHERE created_at >= %s
+                ORDER BY created_at, affiliate_id
+            """, (since,))
+            rows = cursor.fetchall()
+
+        if rows:
+            self.watermark = max(self.watermark, rows[-1][2])
+
+        added = 0
+        queue = dict(self.pending)
+        for affiliate_id, parent_id, _ in rows:
+            if not self._is_known(affiliate_id):
+                queue[affiliate_id] = parent_id
+        queue = list(queue.items())
+
+        # Filhos podem chegar antes do pai: repetir enquanto houver progresso
+        while queue:
+            remaining = [item for item in queue if not self.add_affiliate(*item)]
+            added += len(queue) - len(remaining)
+            if len(remaining) == len(queue):
+                break
+            queue = remaining
+
+        self.pending = queue
+        return added
+
+    # ------------------------------------------------------------------
+    # Consultas
+    # ------------------------------------------------------------------
+
+    def top(self, level: int, limit: int = 10) -> List[Dict]:
+        """Ranking dos afiliados com mais indicações em um nível"""
+        if level not in self.heaps:
+            raise ValueError(f"Nível {level} fora do intervalo 1..{self.config['max_levels']}")
+
+        if limit <= self.config['top_k']:
+            ranking = self.heaps[level].top(limit)
+        else:
+            ranking = self._rank_rows(level, limit)
+
+        return [{'affiliate_id': affiliate_id, 'referrals_count': count} for affiliate_id, count in ranking]
+
+    def verify(self, conn, level: int, limit: int) -> Dict:
+        """Comparar o ranking em memória com a agregação completa em SQL"""
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT ancestor_id, COUNT(descendant_id) AS referrals_count
+                FROM fature_v2.hierarchy_index
+                WHERE level_distance = %s
+                GROUP BY ancestor_id
+                ORDER BY referrals_count DESC, ancestor_id
+                LIMIT %s
+            """, (level, limit))
+            expected = [{'affiliate_id': a, 'referrals_count': c} for a, c in cursor.fetchall()]
+
+        actual = self.top(level, limit)
+        return {
+            'level': level,
+            'limit': limit,
+            'match': actual == expected,
+            'expected': expected,
+            'actual': actual
+        }
+
+
+def main():
+    service = FatureRankingService()
+
+    if len(sys.argv) < 2:
+        print("Uso: python ranking_service.py [comando]")
+        print("Comandos disponíveis:")
+        print("  top NIVEL [LIMITE]     - Exibir ranking de um nível")
+        print("  verify [LIMITE]        - Comparar todos os níveis com a agregação SQL")
+        print("  watch [INTERVALO]      - Manter rankings atualizados com novos afiliados")
+        sys.exit(1)
+
+    command = sys.argv[1]
+    conn = service.connect_database()
+
+    try:
+        service.load(conn)
+
+        if command == "top":
+            level = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+            limit = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+            start_time = time.time()
+            ranking = service.top(level, limit)
+            elapsed = (time.time() - start_time) * 1000
+
+            print(f"=== TOP {limit} NÍVEL {level} ({elapsed:.2f}ms) ===")
+            for position, entry in enumerate(ranking, start=1):
+                print(f"{position}º {entry['affiliate_id']}: {entry['referrals_count']:,}")
+
+        elif command == "verify":
+            limit = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+            all_match = True
+            for level in range(1, service.config['max_levels'] + 1):
+                result = service.verify(conn, level, limit)
+                status = "✅" if result['match'] else "❌"
+                print(f"{status} Nível {level}")
+                if not result['match']:
+                    all_match = False
+                    print(f"   SQL:     {result['expected']}")
+                    print(f"   Memória: {result['actual']}")
+            sys.exit(0 if all_match else 1)
+
+        elif command == "watch":
+            interval = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+            while True:
+                added = service.sync(conn)
+                conn.commit()
+                if added:
+                    logger.info(f"{added} novos afiliados aplicados aos rankings")
+                time.sleep(interval)
+
+        else:
+            print(f"Comando não reconhecido: {command}")
+            sys.exit(1)
+
+    except KeyboardInterrupt:
+        logger.info("Serviço de rankings interrompido pelo usuário")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
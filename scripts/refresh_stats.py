@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Atualização Incremental de Estatísticas - Fature CPA v2
+
+Substitui o REFRESH MATERIALIZED VIEW de affiliate_performance_stats pela tabela
+fature_v2.affiliate_stats, recalculada apenas para os afiliados alterados desde a
+última execução:
+
+- novas transações (transaction_id acima da marca d'água)
+- comissões alteradas desde a última execução (updated_at, mantido por trigger:
+  pagamento e também cancelamento de comissões já pagas)
+- novos relacionamentos em hierarchy_index (id acima da marca d'água)
+- afiliados alterados (updated_at) e todos os seus ancestrais pelo hierarchy_path.
+  Pares removidos de hierarchy_index não deixam rastro: a exclusão de um afiliado
+  atualiza o pai e move_subtree o antigo pai, e os ancestrais deles são os que
+  perderam pares
+
+Cada métrica é agregada separadamente antes do join, evitando a multiplicação de
+linhas (hierarchy_index x commissions x transactions) da view materializada.
+"""
+
+import psycopg2
+import logging
+import time
+import json
+from datetime import datetime, timedelta
+from typing import Dict
+import sys
+
+from db_connection import database_config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+JOB_NAME = 'affiliate_stats'
+
+# Afiliados afetados desde a última execução
+TOUCHED_SQL = """
+    INSERT INTO tmp_touched_affiliates (affiliate_id)
+    SELECT affiliate_id FROM fature_v2.transactions
+    WHERE transaction_id > %(last_transaction_id)s
+    UNION
+    SELECT beneficiary_affiliate_id FROM fature_v2.commissions
+    WHERE updated_at > %(since)s
+    UNION
+    SELECT ancestor_id FROM fature_v2.hierarchy_index
+    WHERE id > %(last_hierarchy_id)s
+    UNION
+    SELECT unnest(string_to_array(hierarchy_path::text, '.'))::BIGINT
+    FROM fature_v2.affiliates_optimized
+    WHERE updated_at > %(since)s
+    ON CONFLICT DO NOTHING
+"""
+
+# Métricas pré-agregadas por fonte e combinadas 1:1 por afiliado
+UPSERT_SQL = """
+    WITH network AS (
+        SELECT hi.ancestor_id AS affiliate_id, COUNT(*) AS calculated_network_size
+        FROM fature_v2.hierarchy_index hi
+        {network_filter}
+        GROUP BY hi.ancestor_id
+    ),
+    earned AS (
+        SELECT c.beneficiary_affiliate_id AS affiliate_id,
+               SUM(c.commission_amount) AS total_commissions_earned
+        FROM fature_v2.commissions c
+        {earned_filter}
+        GROUP BY c.beneficiary_affiliate_id
+    ),
+    generated AS (
+        SELECT t.affiliate_id,
+               COUNT(*) AS total_transactions_generated,
+               MAX(t.transaction_date) AS last_transaction_date
+        FROM fature_v2.transactions t
+        {generated_filter}
+        GROUP BY t.affiliate_id
+    )
+    INSERT INTO fature_v2.affiliate_stats (
+        affiliate_id, hierarchy_level, direct_referrals_count, total_network_size,
+        calculated_network_size, total_commissions_earned, total_transactions_generated,
+        last_transaction_date, created_at, updated_at, refreshed_at
+    )
+    SELECT
+        a.affiliate_id, a.hierarchy_level, a.direct_referrals_count, a.total_network_size,
+        COALESCE(n.calculated_network_size, 0),
+        COALESCE(e.total_commissions_earned, 0),
+        COALESCE(g.total_transactions_generated, 0),
+        g.last_transaction_date, a.created_at, a.updated_at, NOW()
+    FROM fature_v2.affiliates_optimized a
+    {affiliate_filter}
+    LEFT JOIN network n ON n.affiliate_id = a.affiliate_id
+    LEFT JOIN earned e ON e.affiliate_id = a.affiliate_id
+    LEFT JOIN generated g ON g.affiliate_id = a.affiliate_id
+    ON CONFLICT (affiliate_id) DO UPDATE SET
+        hierarchy_level = EXCLUDED.hierarchy_level,
+        direct_referrals_count = EXCLUDED.direct_referrals_count,
+        total_network_size = EXCLUDED.total_network_size,
+        calculated_network_size = EXCLUDED.calculated_network_size,
+        total_commissions_earned = EXCLUDED.total_commissions_earned,
+        total_transactions_generated = EXCLUDED.total_transactions_generated,
+        last_transaction_date = EXCLUDED.last_transaction_date,
+        created_at = EXCLUDED.created_at,
+        updated_at = EXCLUDED.updated_at,
+        refreshed_at = EXCLUDED.refreshed_at
+"""
+
+INCREMENTAL_FILTERS = {
+    'network_filter': "JOIN tmp_touched_affiliates tt ON tt.affiliate_id = hi.ancestor_id",
+    'earned_filter': ("JOIN tmp_touched_affiliates tt ON tt.affiliate_id = c.beneficiary_affiliate_id "
+                      "WHERE c.status = 'paid'"),
+    'generated_filter': "JOIN tmp_touched_affiliates tt ON tt.affiliate_id = t.affiliate_id",
+    'affiliate_filter': "JOIN tmp_touched_affiliates tt ON tt.affiliate_id = a.affiliate_id"
+}
+
+FULL_FILTERS = {
+    'network_filter': "",
+    'earned_filter': "WHERE c.status = 'paid'",
+    'generated_filter': "",
+    'affiliate_filter': ""
+}
+
+
+class FatureStatsRefresh:
+    """Atualização incremental de fature_v2.affiliate_stats"""
+
+    def __init__(self):
+        self.config = {
+            'database': database_config(),
+            # Reprocessar uma margem antes da marca d'água cobre transações que
+            # confirmaram fora de ordem; recalcular um afiliado é idempotente
+            'overlap_seconds': 300,
+            'id_overlap': 1000
+        }
+
+    def connect_database(self):
+        """Conectar ao banco de dados"""
+        conn = psycopg2.connect(**self.config['database'])
+        conn.autocommit = False
+        return conn
+
+    def load_state(self, cursor) -> Dict:
+        """Ler marcas d'água da última execução (None se nunca executado)"""
+        cursor.execute("""
+            SELECT last_transaction_id, last_hierarchy_id, last_run_at
+            FROM fature_v2.refresh_state
+            WHERE job_name = %s
+            FOR UPDATE
+        """, (JOB_NAME,))
+        row = cursor.fetchone()
+        if row is None or row[2] is None:
+            return None
+        return {'last_transaction_id': row[0], 'last_hierarchy_id': row[1], 'last_run_at': row[2]}
+
+    def save_state(self, cursor, transaction_id: int, hierarchy_id: int, run_at: datetime, details: Dict):
+        """Gravar novas marcas d'água"""
+        cursor.execute("""
+            INSERT INTO fature_v2.refresh_state (
+                job_name, last_transaction_id, last_hierarchy_id, last_run_at, details, updated_at
+            ) VALUES (%s, %s, %s, %s, %s, NOW())
+            ON CONFLICT (job_name) DO UPDATE SET
+                last_transaction_id = EXCLUDED.last_transaction_id,
+                last_hierarchy_id = EXCLUDED.last_hierarchy_id,
+                last_run_at = EXCLUDED.last_run_at,
+                details = EXCLUDED.details,
+                updated_at = NOW()
+        """, (JOB_NAME, transaction_id, hierarchy_id, run_at, json.dumps(details)))
+
+    def refresh(self, full: bool = False) -> Dict:
+        """Recalcular estatísticas dos afiliados alterados (ou de todos, se full=True)"""
+        start_time = time.time()
+        stats = {'mode': 'full' if full else 'incremental', 'touched': 0, 'upserted': 0}
+
+        conn = self.connect_database()
+        try:
+            with conn.cursor() as cursor:
+                # Serializa execuções concorrentes do job
+                cursor.execute("""
+                    INSERT INTO fature_v2.refresh_state (job_name) VALUES (%s)
+                    ON CONFLICT (job_name) DO NOTHING
+                """, (JOB_NAME,))
+                state = self.load_state(cursor)
+
+                cursor.execute("""
+                    SELECT
+                        NOW(),
+                        (SELECT COALESCE(MAX(transaction_id), 0) FROM fature_v2.transactions),
+                        (SELECT COALESCE(MAX(id), 0) FROM fature_v2.hierarchy_index)
+                """)
+                run_at, max_transaction_id, max_hierarchy_id = cursor.fetchone()
+
+                if state is None:
+                    full = True
+                    stats['mode'] = 'full'
+
+                if full:
+                    cursor.execute(UPSERT_SQL.format(**FULL_FILTERS))
+                    stats['upserted'] = cursor.rowcount
+                    stats['touched'] = stats['upserted']
+                else:
+                    cursor.execute("""
+                        CREATE TEMP TABLE tmp_touched_affiliates (
+                            affiliate_id BIGINT PRIMARY KEY
+                        ) ON COMMIT DROP;
+                    """)
+                    cursor.execute(TOUCHED_SQL, {
+                        'last_transaction_id': max(state['last_transaction_id'] - self.config['id_overlap'], 0),
+                        'last_hierarchy_id': max(state['last_hierarchy_id'] - self.config['id_overlap'], 0),
+                        'since': state['last_run_at'] - timedelta(seconds=self.config['overlap_seconds'])
+                    })
+                    stats['touched'] = cursor.rowcount
+                    cursor.execute("ANALYZE tmp_touched_affiliates;")
+
+                    cursor.execute(UPSERT_SQL.format(**INCREMENTAL_FILTERS))
+                    stats['upserted'] = cursor.rowcount
+
+                stats['duration_ms'] = int((time.time() - start_time) * 1000)
+                self.save_state(cursor, max_transaction_id, max_hierarchy_id, run_at, stats)
+
+                cursor.execute("""
+                    INSERT INTO fature_v2.system_log (operation, details)
+                    VALUES ('incremental_stats_refresh', %s)
+                """, (json.dumps(stats),))
+
+            conn.commit()
+            logger.info(f"✅ affiliate_stats ({stats['mode']}): {stats['upserted']} afiliados "
+                        f"recalculados em {stats['duration_ms']}ms")
+
+        except Exception as e:
+            logger.error(f"Erro na atualização de estatísticas: {e}")
+            conn.rollback()
+            stats['error'] = str(e)
+        finally:
+            conn.close()
+
+        return stats
+
+
+def main():
+    job = FatureStatsRefresh()
+
+    if len(sys.argv) < 2:
+        print("Uso: python refresh_stats.py [comando]")
+        print("Comandos disponíveis:")
+        print("  refresh  - Recalcular apenas afiliados alterados desde a última execução")
+        print("  full     - Recalcular todos os afiliados")
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    if command in ("refresh", "full"):
+        stats = job.refresh(full=(command == "full"))
+        sys.exit(0 if 'error' not in stats else 1)
+
+    else:
+        print(f"Comando não reconhecido: {command}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,38 +12,51 @@ import psycopg2.extras
 import logging
 import time
 import json
+import statistics
 from datetime import datetime
-from typing import Dict
+from typing import Dict, List
 import sys
 import os
 
+from db_connection import database_config, get_pool
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Throughput medido em execuções anteriores (usado pelo comando plan)
+THROUGHPUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rollback_throughput.json')
+
+# Valores conservadores usados enquanto não há histórico local
+DEFAULT_THROUGHPUT = {
+    'copy_bytes_per_second': 50 * 1024 * 1024,
+    'drop_seconds_per_relation': 0.05,
+}
+
+# Custo extra de escrita por índice na tabela de destino (fração do custo do heap)
+INDEX_WRITE_FACTOR = 0.3
+
+# Quantidade máxima de amostras mantidas por métrica
+MAX_THROUGHPUT_SAMPLES = 20
+
 class FatureRollback:
     """Sistema de rollback para emergências"""
     
     def __init__(self):
         self.config = {
-            'database': {
-                'host': 'hopper.proxy.rlwy.net',
-                'port': 48603,
-                'database': 'railway',
-                'user': 'postgres',
-                'password': 'xWyLIRXlRfgqYMVJRKYLlEAIngEgakTl'
-            }
+            'database': database_config()
         }
         
         self.rollback_steps = []
+        self.throughput_samples = {}
         
-    def connect_database(self):
-        """Conectar ao banco de dados"""
-        return psycopg2.connect(**self.config['database'])
+    def connection(self, profile: str = 'rollback'):
+        """Conexão do pool compartilhado (devolvida ao final do bloco with)"""
+        return get_pool(self.config['database']).connection(profile)
     
     def create_backup_tables(self) -> bool:
         """Criar backup das tabelas originais antes da migração"""
         try:
-            with self.connect_database() as conn:
+            with self.connection() as conn:
                 with conn.cursor() as cursor:
                     logger.info("Criando backup das tabelas originais...")
                     
@@ -57,13 +70,17 @@ class FatureRollback:
                     tables_to_backup = ['transactions', 'commissions', 'payments']
                     
                     for table in tables_to_backup:
+                        # Savepoint: uma tabela ausente não aborta a transação inteira
+                        cursor.execute("SAVEPOINT optional_backup;")
                         try:
                             cursor.execute(f"""
-                                CREATE TABLE IF NOT EXISTS public.{table}_backup_pre_v2 AS 
+                                CREATE TABLE IF NOT EXISTS public.{table}_backup_pre_v2 AS
                                 SELECT * FROM public.{table};
                             """)
+                            cursor.execute("RELEASE SAVEPOINT optional_backup;")
                             logger.info(f"Backup criado para tabela: {table}")
                         except psycopg2.Error as e:
+                            cursor.execute("ROLLBACK TO SAVEPOINT optional_backup;")
                             logger.warning(f"Tabela {table} não existe ou erro no backup: {e}")
                     
                     # Criar tabela de log de rollback
@@ -89,7 +106,7 @@ class FatureRollback:
     def log_rollback_step(self, step_name: str, status: str, details: str = None, error: str = None):
         """Registrar passo do rollback"""
         try:
-            with self.connect_database() as conn:
+            with self.connection() as conn:
                 with conn.cursor() as cursor:
                     cursor.execute("""
                         INSERT INTO public.rollback_log (step_name, status, details, error_message)
@@ -110,7 +127,7 @@ class FatureRollback:
         }
         
         try:
-            with self.connect_database() as conn:
+            with self.connection('monitor') as conn:
                 with conn.cursor() as cursor:
                     # Verificar se schema v2 existe
                     cursor.execute("""
@@ -172,7 +189,7 @@ class FatureRollback:
         logger.info("🚨 INICIANDO ROLLBACK DE EMERGÊNCIA 🚨")
         
         try:
-            with self.connect_database() as conn:
+            with self.connection() as conn:
                 with conn.cursor() as cursor:
                     
                     # Passo 1: Verificar se backup existe
@@ -196,12 +213,17 @@ class FatureRollback:
                     # Passo 2: Criar backup do estado atual (por segurança)
                     self.log_rollback_step("backup_current", "started", "Criando backup do estado atual")
                     
+                    source_bytes = self._relation_size(cursor, 'fature_v2.affiliates_optimized')
+                    step_start = time.time()
+                    
                     cursor.execute("""
                         DROP TABLE IF EXISTS public.affiliates_v2_backup_rollback;
                         CREATE TABLE public.affiliates_v2_backup_rollback AS 
                         SELECT * FROM fature_v2.affiliates_optimized;
                     """)
                     
+                    self._add_copy_sample(source_bytes, 0, time.time() - step_start)
+                    
                     self.log_rollback_step("backup_current", "completed", "Backup do estado atual criado")
                     
                     # Passo 3: Desativar triggers e constraints
@@ -214,12 +236,18 @@ class FatureRollback:
                     # Passo 4: Restaurar tabela principal
                     self.log_rollback_step("restore_main_table", "started", "Restaurando tabela principal")
                     
+                    source_bytes = self._relation_size(cursor, 'public.affiliates_backup_pre_v2')
+                    target_indexes = self._index_count(cursor, 'public.affiliates')
+                    step_start = time.time()
+                    
                     cursor.execute("""
                         TRUNCATE TABLE public.affiliates;
                         INSERT INTO public.affiliates 
                         SELECT * FROM public.affiliates_backup_pre_v2;
                     """)
                     
+                    self._add_copy_sample(source_bytes, target_indexes, time.time() - step_start)
+                    
                     # Verificar contagem
                     cursor.execute("SELECT COUNT(*) FROM public.affiliates;")
                     restored_count = cursor.fetchone()[0]
@@ -242,12 +270,18 @@ class FatureRollback:
                             if cursor.fetchone()[0]:
                                 self.log_rollback_step(f"restore_{table}", "started", f"Restaurando {table}")
                                 
+                                source_bytes = self._relation_size(cursor, f'public.{table}_backup_pre_v2')
+                                target_indexes = self._index_count(cursor, f'public.{table}')
+                                step_start = time.time()
+                                
                                 cursor.execute(f"""
                                     TRUNCATE TABLE public.{table};
                                     INSERT INTO public.{table} 
                                     SELECT * FROM public.{table}_backup_pre_v2;
                                 """)
                                 
+                                self._add_copy_sample(source_bytes, target_indexes, time.time() - step_start)
+                                
                                 cursor.execute(f"SELECT COUNT(*) FROM public.{table};")
                                 count = cursor.fetchone()[0]
                                 
@@ -267,12 +301,20 @@ class FatureRollback:
                     # Passo 7: Remover schema v2 (opcional, para limpeza)
                     self.log_rollback_step("cleanup_v2", "started", "Limpando schema v2")
                     
+                    relation_count = self._schema_relation_count(cursor, 'fature_v2')
+                    step_start = time.time()
+                    
                     cursor.execute("DROP SCHEMA IF EXISTS fature_v2 CASCADE;")
                     
+                    if relation_count > 0:
+                        self._add_throughput_sample('drop_seconds_per_relation',
+                                                    (time.time() - step_start) / relation_count)
+                    
                     self.log_rollback_step("cleanup_v2", "completed", "Schema v2 removido")
                     
                     # Commit final
                     conn.commit()
+                    self.save_throughput_history()
                     
                     logger.info("✅ ROLLBACK CONCLUÍDO COM SUCESSO!")
                     logger.info(f"Sistema restaurado para estado anterior com {restored_count} afiliados")
@@ -285,6 +327,258 @@ class FatureRollback:
             self.log_rollback_step("rollback_failed", "failed", error=error_msg)
             return False
     
+    def _relation_size(self, cursor, relation: str) -> int:
+        """Tamanho do heap de uma relação em bytes (0 se não existir)"""
+        cursor.execute("SELECT COALESCE(pg_relation_size(to_regclass(%s)), 0);", (relation,))
+        return cursor.fetchone()[0]
+    
+    def _index_count(self, cursor, relation: str) -> int:
+        """Quantidade de índices de uma relação"""
+        cursor.execute("""
+            SELECT COUNT(*) FROM pg_index WHERE indrelid = to_regclass(%s);
+        """, (relation,))
+        return cursor.fetchone()[0]
+    
+    def _schema_relation_count(self, cursor, schema: str) -> int:
+        """Quantidade de relações (tabelas, índices, views, sequências) de um schema"""
+        cursor.execute("""
+            SELECT COUNT(*) FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = %s;
+        """, (schema,))
+        return cursor.fetchone()[0]
+    
+    def _add_throughput_sample(self, metric: str, value: float):
+        """Acumular amostra de throughput para persistir ao final do rollback"""
+        self.throughput_samples.setdefault(metric, []).append(value)
+    
+    def _add_copy_sample(self, source_bytes: int, target_indexes: int, elapsed: float):
+        """Registrar throughput de cópia normalizado pelo custo de manutenção de índices"""
+        if source_bytes > 0 and elapsed > 0:
+            effective_bytes = source_bytes * (1 + INDEX_WRITE_FACTOR * target_indexes)
+            self._add_throughput_sample('copy_bytes_per_second', effective_bytes / elapsed)
+    
+    def load_throughput_history(self) -> Dict:
+        """Carregar amostras de throughput de execuções anteriores"""
+        try:
+            with open(THROUGHPUT_FILE, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Histórico de throughput ilegível, usando valores padrão: {e}")
+            return {}
+    
+    def save_throughput_history(self):
+        """Persistir amostras medidas neste rollback no histórico local"""
+        if not self.throughput_samples:
+            return
+        
+        history = self.load_throughput_history()
+        for metric, samples in self.throughput_samples.items():
+            merged = history.get(metric, []) + samples
+            history[metric] = merged[-MAX_THROUGHPUT_SAMPLES:]
+        
+        try:
+            with open(THROUGHPUT_FILE, 'w') as f:
+                json.dump(history, f, indent=2)
+            self.throughput_samples = {}
+        except OSError as e:
+            logger.warning(f"Não foi possível salvar histórico de throughput: {e}")
+    
+    def get_throughput(self) -> Dict:
+        """Throughput estimado por métrica (mediana do histórico ou valor padrão)"""
+        history = self.load_throughput_history()
+        throughput = dict(DEFAULT_THROUGHPUT)
+        for metric in throughput:
+            samples = history.get(metric)
+            if samples:
+                throughput[metric] = statistics.median(samples)
+        throughput['measured'] = sorted(m for m in DEFAULT_THROUGHPUT if history.get(m))
+        return throughput
+    
+    def inspect_tables(self, cursor, relations: List[str]) -> Dict:
+        """Coletar tamanho, índices e tuplas mortas das relações envolvidas no rollback"""
+        cursor.execute("""
+            SELECT
+                n.nspname || '.' || c.relname AS relation,
+                pg_relation_size(c.oid) AS heap_bytes,
+                pg_total_relation_size(c.oid) AS total_bytes,
+                c.reltuples::BIGINT AS estimated_rows,
+                (SELECT COUNT(*) FROM pg_index i WHERE i.indrelid = c.oid) AS index_count,
+                COALESCE(s.n_live_tup, 0) AS live_tuples,
+                COALESCE(s.n_dead_tup, 0) AS dead_tuples,
+                s.last_autovacuum
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+            WHERE c.relkind IN ('r', 'p')
+              AND n.nspname || '.' || c.relname = ANY(%s);
+        """, (relations,))
+        return {row['relation']: dict(row) for row in cursor.fetchall()}
+    
+    def find_blocking_sessions(self, cursor, relations: List[str], schemas: List[str]) -> List[Dict]:
+        """Listar sessões que mantêm locks em relações que o rollback precisa bloquear"""
+        cursor.execute("""
+            SELECT DISTINCT ON (l.pid, relation)
+                l.pid,
+                n.nspname || '.' || c.relname AS relation,
+                l.mode,
+                l.granted,
+                a.usename,
+                a.application_name,
+                a.state,
+                a.xact_start,
+                NOW() - a.xact_start AS transaction_age,
+                LEFT(a.query, 200) AS query
+            FROM pg_locks l
+            JOIN pg_class c ON c.oid = l.relation
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            LEFT JOIN pg_stat_activity a ON a.pid = l.pid
+            WHERE l.pid <> pg_backend_pid()
+              AND l.locktype = 'relation'
+              AND (n.nspname || '.' || c.relname = ANY(%s) OR n.nspname = ANY(%s))
+            ORDER BY l.pid, relation, a.xact_start;
+        """, (relations, schemas))
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def _estimate_copy_step(self, step_name: str, source: Dict, target: Dict, throughput: Dict) -> Dict:
+        """Estimar duração de um passo TRUNCATE + INSERT SELECT (ou CREATE TABLE AS)"""
+        heap_bytes = source['heap_bytes'] if source else 0
+        index_count = target['index_count'] if target else 0
+        effective_bytes = heap_bytes * (1 + INDEX_WRITE_FACTOR * index_count)
+        return {
+            'step': step_name,
+            'source': source['relation'] if source else None,
+            'target': target['relation'] if target else None,
+            'bytes': heap_bytes,
+            'rows': source['estimated_rows'] if source else 0,
+            'target_indexes': index_count,
+            'source_dead_tuples': source['dead_tuples'] if source else 0,
+            'estimated_seconds': effective_bytes / throughput['copy_bytes_per_second']
+        }
+    
+    def plan_rollback(self) -> Dict:
+        """Planejar rollback sem executá-lo: tamanhos, locks e tempo estimado por estratégia"""
+        tables = ['affiliates'] + ['transactions', 'commissions', 'payments']
+        relations = ['fature_v2.affiliates_optimized']
+        for table in tables:
+            relations.extend([f'public.{table}', f'public.{table}_backup_pre_v2'])
+        
+        plan = {
+            'generated_at': datetime.now().isoformat(),
+            'throughput': self.get_throughput(),
+            'tables': {},
+            'blocking_sessions': [],
+            'strategies': [],
+            'recommended': None
+        }
+        throughput = plan['throughput']
+        
+        try:
+            with self.connection('report') as conn:
+                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                    info = self.inspect_tables(cursor, relations)
+                    plan['tables'] = info
+                    
+                    plan['blocking_sessions'] = self.find_blocking_sessions(
+                        cursor, [r for r in relations if r.startswith('public.')], ['fature_v2']
+                    )
+                
+                with conn.cursor() as cursor:
+                    v2_relations = self._schema_relation_count(cursor, 'fature_v2')
+        except Exception as e:
+            logger.error(f"Erro ao planejar rollback: {e}")
+            plan['error'] = str(e)
+            return plan
+        
+        blocked = {session['relation'] for session in plan['blocking_sessions']}
+        drop_step = {
+            'step': 'cleanup_v2',
+            'relations': v2_relations,
+            'estimated_seconds': v2_relations * throughput['drop_seconds_per_relation']
+        }
+        
+        # Estratégia 1: rollback completo (rollback-full)
+        full_steps = []
+        full_problems = []
+        if 'public.affiliates_backup_pre_v2' not in info:
+            full_problems.append("Backup public.affiliates_backup_pre_v2 não encontrado")
+        if 'fature_v2.affiliates_optimized' in info:
+            full_steps.append(self._estimate_copy_step(
+                'backup_current', info['fature_v2.affiliates_optimized'], None, throughput
+            ))
+        for table in tables:
+            backup = info.get(f'public.{table}_backup_pre_v2')
+            if backup:
+                full_steps.append(self._estimate_copy_step(
+                    'restore_main_table' if table == 'affiliates' else f'restore_{table}',
+                    backup, info.get(f'public.{table}'), throughput
+                ))
+        full_steps.append(drop_step)
+        full_locked = sorted(r for r in blocked if r.startswith('public.') or r.startswith('fature_v2.'))
+        
+        # Estratégia 2: remover apenas o schema v2 (rollback-schema)
+        schema_locked = sorted(r for r in blocked if r.startswith('fature_v2.'))
+        
+        for name, command, steps, problems, locked in (
+            ('full', 'rollback-full', full_steps, full_problems, full_locked),
+            ('schema_only', 'rollback-schema', [drop_step], [], schema_locked),
+        ):
+            if locked:
+                problems = problems + [f"Relações bloqueadas por outras sessões: {', '.join(locked)}"]
+            plan['strategies'].append({
+                'strategy': name,
+                'command': command,
+                'steps': steps,
+                'estimated_seconds': sum(step['estimated_seconds'] for step in steps),
+                'safe': not problems,
+                'problems': problems
+            })
+        
+        # Recomendar a estratégia segura mais rápida
+        safe = [s for s in plan['strategies'] if s['safe']]
+        if safe:
+            plan['recommended'] = min(safe, key=lambda s: s['estimated_seconds'])['strategy']
+        
+        return plan
+    
+    def format_plan(self, plan: Dict) -> str:
+        """Formatar plano de rollback para exibição"""
+        if 'error' in plan:
+            return f"Erro ao planejar rollback: {plan['error']}"
+        
+        throughput = plan['throughput']
+        source = "histórico local" if throughput['measured'] else "valores padrão"
+        report = "=== PLANO DE ROLLBACK (DRY-RUN) ===\n\n"
+        report += f"Throughput de cópia: {throughput['copy_bytes_per_second'] / 1024 / 1024:.1f} MB/s ({source})\n\n"
+        
+        report += "📦 TABELAS:\n"
+        for relation, table in sorted(plan['tables'].items()):
+            report += (f"- {relation}: {table['total_bytes'] / 1024 / 1024:.1f} MB, "
+                       f"~{table['estimated_rows']:,} linhas, {table['index_count']} índices, "
+                       f"{table['dead_tuples']:,} tuplas mortas\n")
+        
+        for strategy in plan['strategies']:
+            status_icon = "✅" if strategy['safe'] else "❌"
+            report += (f"\n{status_icon} Estratégia {strategy['strategy']} ({strategy['command']}): "
+                       f"~{strategy['estimated_seconds']:.1f}s\n")
+            for step in strategy['steps']:
+                report += f"   - {step['step']}: ~{step['estimated_seconds']:.1f}s\n"
+            for problem in strategy['problems']:
+                report += f"   ⚠️ {problem}\n"
+        
+        if plan['blocking_sessions']:
+            report += "\n🔒 SESSÕES BLOQUEANTES:\n"
+            for session in plan['blocking_sessions']:
+                report += (f"- pid {session['pid']} ({session['usename']}, {session['application_name']}): "
+                           f"{session['mode']} em {session['relation']}, estado {session['state']}, "
+                           f"transação há {session['transaction_age']}\n")
+                report += f"   {session['query']}\n"
+        
+        report += f"\nRecomendado: {plan['recommended'] or 'nenhuma estratégia segura no momento'}\n"
+        return report
+    
     def partial_rollback(self, component: str) -> bool:
         """Rollback parcial de componente específico"""
         logger.info(f"Executando rollback parcial: {component}")
@@ -292,10 +586,18 @@ class FatureRollback:
         if component == "schema_only":
             # Apenas remover schema v2, manter dados originais
             try:
-                with self.connect_database() as conn:
+                with self.connection() as conn:
                     with conn.cursor() as cursor:
+                        relation_count = self._schema_relation_count(cursor, 'fature_v2')
+                        step_start = time.time()
+                        
                         cursor.execute("DROP SCHEMA IF EXISTS fature_v2 CASCADE;")
                         conn.commit()
+                        
+                        if relation_count > 0:
+                            self._add_throughput_sample('drop_seconds_per_relation',
+                                                        (time.time() - step_start) / relation_count)
+                            self.save_throughput_history()
                         logger.info("Schema v2 removido com sucesso")
                         return True
             except Exception as e:
@@ -305,7 +607,7 @@ class FatureRollback:
         elif component == "triggers_only":
             # Desativar apenas triggers do v2
             try:
-                with self.connect_database() as conn:
+                with self.connection() as conn:
                     with conn.cursor() as cursor:
                         cursor.execute("""
                             SELECT 'DROP TRIGGER IF EXISTS ' || trigger_name || ' ON ' || event_object_table || ';'
@@ -331,7 +633,7 @@ class FatureRollback:
     def generate_rollback_report(self) -> str:
         """Gerar relatório do rollback"""
         try:
-            with self.connect_database() as conn:
+            with self.connection('report') as conn:
                 with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
                     cursor.execute("""
                         SELECT step_name, status, executed_at, details, error_message
@@ -370,6 +672,7 @@ def main():
         print("Comandos disponíveis:")
         print("  backup          - Criar backup das tabelas originais")
         print("  check           - Verificar saúde do sistema")
+        print("  plan            - Planejar rollback (dry-run com estimativa de tempo)")
         print("  rollback-full   - Rollback completo (CUIDADO!)")
         print("  rollback-schema - Rollback apenas do schema v2")
         print("  report          - Gerar relatório de rollback")
@@ -396,6 +699,14 @@ def main():
         
         sys.exit(0 if not health['critical_errors'] else 1)
     
+    elif command == "plan":
+        plan = rollback.plan_rollback()
+        if len(sys.argv) > 2 and sys.argv[2] == "--json":
+            print(json.dumps(plan, indent=2, default=str))
+        else:
+            print(rollback.format_plan(plan))
+        sys.exit(0 if plan['recommended'] else 1)
+    
     elif command == "rollback-full":
         print("⚠️  ATENÇÃO: Você está prestes a executar um rollback completo!")
         print("Isso irá restaurar o sistema para o estado anterior à migração v2.")
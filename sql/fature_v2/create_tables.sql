@@ -146,6 +146,7 @@ CREATE TABLE commissions (
     
     -- Auditoria
     created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
     batch_id BIGINT,
     
     -- Foreign keys
@@ -171,6 +172,7 @@ CREATE TABLE commission_queue (
     status VARCHAR(20) DEFAULT 'pending',
     attempts INTEGER DEFAULT 0,
     max_attempts INTEGER DEFAULT 3,
+    next_attempt_at TIMESTAMP DEFAULT NOW(),
     created_at TIMESTAMP DEFAULT NOW(),
     processed_at TIMESTAMP,
     error_message TEXT,
@@ -189,6 +191,25 @@ CREATE TABLE query_performance_log (
     created_at TIMESTAMP DEFAULT NOW()
 );
 
+-- Resumo horário de query_performance_log por query_type (scripts/log_retention.py);
+-- contagens e somas são ponderadas por 1/sample_rate, percentis por ordem ponderada
+CREATE TABLE query_performance_hourly (
+    hour TIMESTAMP NOT NULL,
+    query_type VARCHAR(100) NOT NULL,
+    query_count BIGINT NOT NULL,
+    sampled_count INTEGER NOT NULL,
+    total_duration_ms BIGINT NOT NULL,
+    max_duration_ms INTEGER,
+    slow_count INTEGER DEFAULT 0,
+    p50_ms INTEGER,
+    p95_ms INTEGER,
+    p99_ms INTEGER,
+    total_affected_rows BIGINT,
+    created_at TIMESTAMP DEFAULT NOW(),
+
+    PRIMARY KEY (hour, query_type)
+);
+
 CREATE TABLE performance_cache (
     cache_key VARCHAR(255) PRIMARY KEY,
     cache_data JSONB NOT NULL,
@@ -205,6 +226,48 @@ CREATE TABLE system_log (
     created_at TIMESTAMP DEFAULT NOW()
 );
 
+-- Estatísticas por afiliado atualizadas incrementalmente (scripts/refresh_stats.py)
+CREATE TABLE affiliate_stats (
+    affiliate_id BIGINT PRIMARY KEY,
+    hierarchy_level INTEGER,
+    direct_referrals_count INTEGER DEFAULT 0,
+    total_network_size INTEGER DEFAULT 0,
+    calculated_network_size INTEGER DEFAULT 0,
+    total_commissions_earned DECIMAL(15,2) DEFAULT 0,
+    total_transactions_generated INTEGER DEFAULT 0,
+    last_transaction_date TIMESTAMP,
+    created_at TIMESTAMP,
+    updated_at TIMESTAMP,
+    refreshed_at TIMESTAMP DEFAULT NOW(),
+    
+    FOREIGN KEY (affiliate_id) REFERENCES affiliates_optimized(affiliate_id) ON DELETE CASCADE
+);
+
+-- Marcas d'água dos jobs incrementais
+CREATE TABLE refresh_state (
+    job_name VARCHAR(100) PRIMARY KEY,
+    last_transaction_id BIGINT DEFAULT 0,
+    last_hierarchy_id BIGINT DEFAULT 0,
+    last_run_at TIMESTAMP,
+    details JSONB,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Índices secundários e chaves estrangeiras adiados pela migração (scripts/migrate_fature.py);
+-- restored_at fica nulo até o objeto ser recriado, permitindo retomar a fase pós-carga
+CREATE TABLE deferred_objects (
+    object_type VARCHAR(20) NOT NULL,
+    object_name VARCHAR(100) NOT NULL,
+    table_name VARCHAR(100) NOT NULL,
+    definition TEXT NOT NULL,
+    index_method VARCHAR(20),
+    deferred_at TIMESTAMP DEFAULT NOW(),
+    restored_at TIMESTAMP,
+    
+    PRIMARY KEY (object_type, object_name),
+    CONSTRAINT chk_deferred_type CHECK (object_type IN ('index', 'foreign_key'))
+);
+
 -- Sequência para lotes de comissão
 CREATE SEQUENCE commission_batch_seq START 1;
 
@@ -248,6 +311,8 @@ CREATE INDEX idx_performance_lookup ON affiliates_optimized(
     status, hierarchy_level, direct_referrals_count
 ) WHERE status = 'active' AND direct_referrals_count > 0;
 
+CREATE INDEX idx_affiliates_updated ON affiliates_optimized(updated_at);
+
 -- Índices para transações
 CREATE INDEX idx_transactions_affiliate ON transactions(affiliate_id, transaction_date);
 CREATE INDEX idx_transactions_processing ON transactions(commission_eligible, commission_processed, transaction_date);
@@ -258,6 +323,12 @@ CREATE INDEX idx_commissions_beneficiary ON commissions(beneficiary_affiliate_id
 CREATE INDEX idx_commissions_transaction ON commissions(transaction_id, level_distance);
 CREATE INDEX idx_commissions_processing ON commissions(status, created_at, batch_id);
 CREATE INDEX idx_commissions_payment ON commissions(status, paid_at) WHERE status = 'paid';
+CREATE INDEX idx_commissions_updated ON commissions(updated_at);
+
+-- Índices para estatísticas incrementais
+CREATE INDEX idx_stats_network_size ON affiliate_stats (calculated_network_size DESC);
+CREATE INDEX idx_stats_commissions ON affiliate_stats (total_commissions_earned DESC);
+CREATE INDEX idx_stats_level ON affiliate_stats (hierarchy_level, direct_referrals_count DESC);
 
 -- Índices para fila de processamento
 CREATE INDEX idx_queue_processing ON commission_queue(status, priority, created_at);
@@ -265,6 +336,9 @@ CREATE INDEX idx_queue_processing ON commission_queue(status, priority, created_
 -- Índices para monitoramento
 CREATE INDEX idx_perf_log_type_time ON query_performance_log(query_type, created_at);
 CREATE INDEX idx_perf_log_duration ON query_performance_log(query_duration_ms, created_at);
+-- Logs só recebem inserções: BRIN em created_at é mínimo e atende resumo e expurgo
+CREATE INDEX idx_perf_log_created_brin ON query_performance_log USING BRIN (created_at);
+CREATE INDEX idx_system_log_created_brin ON system_log USING BRIN (created_at);
 CREATE INDEX idx_cache_expiration ON performance_cache(expires_at);
 CREATE INDEX idx_cache_hits ON performance_cache(hit_count, updated_at);
 
@@ -272,6 +346,9 @@ CREATE INDEX idx_cache_hits ON performance_cache(hit_count, updated_at);
 -- FUNÇÕES E TRIGGERS
 -- =====================================================
 
+-- As funções usam nomes sem schema e fixam search_path (fature_v2, public): os gatilhos
+-- disparam em conexões do pool, cujo search_path é o padrão do banco
+
 -- Função para atualizar hierarquia em inserções
 CREATE OR REPLACE FUNCTION update_hierarchy_on_insert()
 RETURNS TRIGGER AS $$
@@ -281,10 +358,12 @@ DECLARE
 BEGIN
     -- Calcular caminho hierárquico
     IF NEW.parent_affiliate_id IS NOT NULL THEN
+        -- FOR SHARE: espera um move_subtree em andamento sobre o pai e lê o caminho já movido
         SELECT hierarchy_path, hierarchy_level 
         INTO parent_path, new_level
         FROM affiliates_optimized 
-        WHERE affiliate_id = NEW.parent_affiliate_id;
+        WHERE affiliate_id = NEW.parent_affiliate_id
+        FOR SHARE;
         
         IF parent_path IS NULL THEN
             RAISE EXCEPTION 'Parent affiliate % not found', NEW.parent_affiliate_id;
@@ -302,7 +381,7 @@ BEGIN
     
     RETURN NEW;
 END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE plpgsql SET search_path = fature_v2, public;
 
 -- Trigger para atualização automática
 CREATE TRIGGER trg_update_hierarchy_insert
@@ -315,7 +394,7 @@ RETURNS INTEGER AS $$
 DECLARE
     affiliate_path LTREE;
     path_elements TEXT[];
-    ancestor_id BIGINT;
+    v_ancestor_id BIGINT;
     level_dist INTEGER;
     inserted_count INTEGER := 0;
 BEGIN
@@ -333,13 +412,13 @@ BEGIN
     
     -- Inserir relacionamentos com todos os ancestrais
     FOR i IN 1..array_length(path_elements, 1)-1 LOOP
-        ancestor_id := path_elements[i]::BIGINT;
+        v_ancestor_id := path_elements[i]::BIGINT;
         level_dist := array_length(path_elements, 1) - i;
         
         INSERT INTO hierarchy_index (
             ancestor_id, descendant_id, level_distance
         ) VALUES (
-            ancestor_id, p_affiliate_id, level_dist
+            v_ancestor_id, p_affiliate_id, level_dist
         ) ON CONFLICT (ancestor_id, descendant_id) DO NOTHING;
         
         inserted_count := inserted_count + 1;
@@ -347,7 +426,7 @@ BEGIN
     
     RETURN inserted_count;
 END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE plpgsql SET search_path = fature_v2, public;
 
 -- Função para atualizar contadores
 CREATE OR REPLACE FUNCTION update_referral_counters()
@@ -383,19 +462,40 @@ BEGIN
         RETURN NEW;
         
     ELSIF TG_OP = 'DELETE' THEN
-        -- Lógica para remoção (se necessário)
+        -- A lista de filhos do pai mudou: updated_at novo o inclui nos jobs
+        -- incrementais (network_hash recalcula o pai e seus ancestrais)
+        IF OLD.parent_affiliate_id IS NOT NULL THEN
+            UPDATE affiliates_optimized
+            SET updated_at = NOW()
+            WHERE affiliate_id = OLD.parent_affiliate_id;
+        END IF;
+
         RETURN OLD;
     END IF;
     
     RETURN NULL;
 END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE plpgsql SET search_path = fature_v2, public;
 
 -- Trigger para contadores automáticos
 CREATE TRIGGER trg_update_referral_counters
     AFTER INSERT OR DELETE ON affiliates_optimized
     FOR EACH ROW EXECUTE FUNCTION update_referral_counters();
 
+-- Função para manter updated_at em qualquer alteração da linha
+CREATE OR REPLACE FUNCTION set_updated_at()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.updated_at = NOW();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Mudanças de status (pagamento, cancelamento, disputa) ficam visíveis para refresh_stats
+CREATE TRIGGER trg_commissions_updated_at
+    BEFORE UPDATE ON commissions
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+
 -- Função para construção completa do índice hierárquico
 CREATE OR REPLACE FUNCTION build_complete_hierarchy_index()
 RETURNS TABLE(
@@ -455,7 +555,7 @@ BEGIN
     RAISE NOTICE 'Índice hierárquico construído: % relacionamentos para % afiliados',
         relationship_count, affiliate_count;
 END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE plpgsql SET search_path = fature_v2, public;
 
 -- Função para cálculo de comissões em tempo real
 CREATE OR REPLACE FUNCTION calculate_commissions_realtime(
@@ -469,7 +569,8 @@ CREATE OR REPLACE FUNCTION calculate_commissions_realtime(
 BEGIN
     RETURN QUERY
     WITH commission_rules AS (
-        SELECT level_distance, commission_rate
+        -- Colunas qualificadas: level_distance também é coluna de saída da função
+        SELECT rules.level_distance, rules.commission_rate
         FROM (VALUES 
             (1, 0.05),  -- 5% nível 1
             (2, 0.03),  -- 3% nível 2
@@ -480,14 +581,14 @@ BEGIN
     ),
     transaction_data AS (
         SELECT t.affiliate_id, t.amount
-        FROM transactions t
+        FROM fature_v2.transactions t
         WHERE t.transaction_id = p_transaction_id
     )
     SELECT 
         hi.ancestor_id as beneficiary_id,
         hi.level_distance,
         (td.amount * cr.commission_rate) as commission_amount
-    FROM hierarchy_index hi
+    FROM fature_v2.hierarchy_index hi
     CROSS JOIN transaction_data td
     JOIN commission_rules cr ON hi.level_distance = cr.level_distance
     WHERE hi.descendant_id = td.affiliate_id
@@ -502,22 +603,22 @@ CREATE OR REPLACE FUNCTION get_top_performers_cached(
     p_limit INTEGER DEFAULT 10
 ) RETURNS JSONB AS $$
 DECLARE
-    cache_key VARCHAR(255);
+    v_cache_key VARCHAR(255);
     cached_result JSONB;
 BEGIN
-    cache_key := 'top_performers_level_' || p_level || '_limit_' || p_limit;
+    v_cache_key := 'top_performers_level_' || p_level || '_limit_' || p_limit;
     
     -- Verificar cache
     SELECT cache_data INTO cached_result
     FROM performance_cache
-    WHERE cache_key = cache_key
+    WHERE cache_key = v_cache_key
       AND expires_at > NOW();
     
     IF cached_result IS NOT NULL THEN
         -- Atualizar contador de hits
         UPDATE performance_cache 
         SET hit_count = hit_count + 1, updated_at = NOW()
-        WHERE cache_key = cache_key;
+        WHERE cache_key = v_cache_key;
         
         RETURN cached_result;
     END IF;
@@ -543,7 +644,7 @@ BEGIN
     
     -- Salvar no cache (válido por 1 hora)
     INSERT INTO performance_cache (cache_key, cache_data, expires_at)
-    VALUES (cache_key, cached_result, NOW() + INTERVAL '1 hour')
+    VALUES (v_cache_key, cached_result, NOW() + INTERVAL '1 hour')
     ON CONFLICT (cache_key) DO UPDATE SET
         cache_data = EXCLUDED.cache_data,
         expires_at = EXCLUDED.expires_at,
@@ -551,7 +652,7 @@ BEGIN
     
     RETURN cached_result;
 END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE plpgsql SET search_path = fature_v2, public;
 
 -- =====================================================
 -- VIEWS MATERIALIZADAS
@@ -612,13 +713,18 @@ commission_stats AS (
     FROM commissions
     WHERE created_at >= CURRENT_DATE
 ),
+-- Registros amostrados pesam 1/sample_rate (comandos lentos são sempre registrados).
+-- Limite de consulta lenta: fature.slow_query_ms, aplicado pelo pool Python a partir de
+-- FATURE_SLOW_QUERY_MS; outros clientes usam ALTER DATABASE ... SET fature.slow_query_ms
 performance_stats AS (
     SELECT 
-        COUNT(*) as queries_last_hour,
-        AVG(query_duration_ms) as avg_query_duration,
+        ROUND(COALESCE(SUM(1 / w.rate), 0))::BIGINT as queries_last_hour,
+        SUM(query_duration_ms / w.rate) / NULLIF(SUM(1 / w.rate), 0) as avg_query_duration,
         MAX(query_duration_ms) as max_query_duration,
-        COUNT(*) FILTER (WHERE query_duration_ms > 100) as slow_queries
-    FROM query_performance_log
+        COUNT(*) FILTER (WHERE query_duration_ms > s.slow_ms) as slow_queries
+    FROM query_performance_log,
+    LATERAL (SELECT COALESCE((parameters->>'sample_rate')::float, 1) AS rate) w,
+    (SELECT COALESCE(NULLIF(current_setting('fature.slow_query_ms', true), '')::INTEGER, 100) AS slow_ms) s
     WHERE created_at >= NOW() - INTERVAL '1 hour'
 )
 SELECT 
@@ -642,12 +748,15 @@ RETURNS INTEGER AS $$
 DECLARE
     deleted_count INTEGER;
 BEGIN
-    DELETE FROM performance_cache WHERE expires_at < NOW();
+    -- Nomes qualificados: chamada por log_retention.py fora do search_path fature_v2
+    DELETE FROM fature_v2.performance_cache WHERE expires_at < NOW();
     GET DIAGNOSTICS deleted_count = ROW_COUNT;
     
-    -- Log da operação
-    INSERT INTO system_log (operation, details)
-    VALUES ('cache_cleanup', jsonb_build_object('deleted_count', deleted_count));
+    -- Log da operação (somente quando algo foi removido)
+    IF deleted_count > 0 THEN
+        INSERT INTO fature_v2.system_log (operation, details)
+        VALUES ('cache_cleanup', jsonb_build_object('deleted_count', deleted_count));
+    END IF;
     
     RETURN deleted_count;
 END;
@@ -663,7 +772,7 @@ BEGIN
     INSERT INTO system_log (operation, details)
     VALUES ('refresh_materialized_view', jsonb_build_object('view_name', 'affiliate_performance_stats'));
 END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE plpgsql SET search_path = fature_v2, public;
 
 -- Função de saúde do sistema
 CREATE OR REPLACE FUNCTION system_health_check()
@@ -684,7 +793,7 @@ BEGIN
     
     RETURN health_data;
 END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE plpgsql SET search_path = fature_v2, public;
 
 -- =====================================================
 -- COMENTÁRIOS E DOCUMENTAÇÃO
@@ -696,11 +805,13 @@ COMMENT ON TABLE affiliates_optimized IS 'Tabela principal de afiliados com hier
 COMMENT ON TABLE hierarchy_index IS 'Índice materializado de todos os relacionamentos hierárquicos para consultas O(1)';
 COMMENT ON TABLE transactions IS 'Transações financeiras com suporte a processamento de comissões em tempo real';
 COMMENT ON TABLE commissions IS 'Comissões calculadas automaticamente para cada transação';
+COMMENT ON TABLE affiliate_stats IS 'Estatísticas por afiliado recalculadas apenas para afiliados alterados (substitui o refresh completo de affiliate_performance_stats)';
 
 COMMENT ON COLUMN affiliates_optimized.hierarchy_path IS 'Caminho hierárquico completo usando LTREE para consultas eficientes';
 COMMENT ON COLUMN affiliates_optimized.hierarchy_level IS 'Nível na hierarquia (1 = raiz)';
 COMMENT ON COLUMN affiliates_optimized.direct_referrals_count IS 'Contador cache de indicações diretas';
 COMMENT ON COLUMN affiliates_optimized.total_network_size IS 'Contador cache do tamanho total da rede';
+COMMENT ON COLUMN affiliates_optimized.network_hash IS 'Hash Merkle (SHA-256) da linha e das redes dos filhos; muda apenas quando algo na rede muda (scripts/network_hash.py)';
 
 COMMENT ON COLUMN hierarchy_index.level_distance IS 'Distância em níveis entre ancestral e descendente';
 COMMENT ON COLUMN hierarchy_index.path_weight IS 'Peso do caminho para cálculos de comissão diferenciados';
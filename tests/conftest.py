@@ -0,0 +1,78 @@
+"""
+Configuração dos testes Python dos scripts operacionais (scripts/ e bench/)
+
+Testes marcados com @pytest.mark.db precisam de um PostgreSQL descartável em
+FATURE_TEST_DATABASE_URL. O schema fature_v2 é recriado a partir de
+sql/fature_v2/create_tables.sql a cada teste; sem a variável, são ignorados.
+Os demais testam a lógica em memória (numpy) e rodam sem banco.
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHEMA_FILE = os.path.join(ROOT_DIR, 'sql', 'fature_v2', 'create_tables.sql')
+
+for directory in ('scripts', 'bench'):
+    path = os.path.join(ROOT_DIR, directory)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'db: requer PostgreSQL em FATURE_TEST_DATABASE_URL')
+
+
+@pytest.fixture
+def random_tree():
+    """Gerador de árvores aleatórias: (affiliate_ids, parent_ids com 0 para raiz) fora de ordem"""
+    np = pytest.importorskip('numpy')
+
+    def build(n, seed=0, roots=3):
+        rng = np.random.default_rng(seed)
+        ids = rng.choice(10 * n, size=n, replace=False).astype(np.int64) + 1
+        parents = np.zeros(n, dtype=np.int64)
+        for i in range(roots, n):
+            parents[i] = ids[rng.integers(max(0, i - 20), i)]
+        order = rng.permutation(n)
+        return ids[order], parents[order]
+
+    return build
+
+
+@pytest.fixture
+def offline_database(monkeypatch):
+    """Configuração de banco fictícia para instanciar as classes Fature* sem conectar"""
+    monkeypatch.setenv('FATURE_DATABASE_URL', 'postgresql://fature@localhost/fature_offline')
+
+
+@pytest.fixture
+def fature_db(monkeypatch):
+    """Schema fature_v2 vazio no banco de teste; os scripts usam esse banco via FATURE_DATABASE_URL"""
+    url = os.environ.get('FATURE_TEST_DATABASE_URL')
+    if not url:
+        pytest.skip('FATURE_TEST_DATABASE_URL não definido')
+
+    psycopg2 = pytest.importorskip('psycopg2')
+    from db_connection import close_pools
+
+    monkeypatch.setenv('FATURE_DATABASE_URL', url)
+    # Sem instrumentação: os testes de retenção contam as linhas de query_performance_log
+    monkeypatch.setenv('FATURE_QUERY_LOG', '0')
+
+    conn = psycopg2.connect(url)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("DROP SCHEMA IF EXISTS fature_v2 CASCADE;")
+            with open(SCHEMA_FILE) as f:
+                cursor.execute(f.read())
+        conn.commit()
+
+        yield conn
+
+    finally:
+        conn.rollback()
+        conn.close()
+        close_pools()
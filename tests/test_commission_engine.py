@@ -0,0 +1,132 @@
+import os
+from decimal import Decimal, ROUND_HALF_UP
+
+import numpy as np
+import psycopg2
+import pytest
+
+from commission_engine import FatureCommissionEngine
+
+
+@pytest.fixture
+def engine(offline_database):
+    """Cadeia 1 -> 2 -> ... -> 7 (o afiliado 7 tem seis ancestrais)"""
+    engine = FatureCommissionEngine()
+    engine.affiliate_ids = np.arange(1, 8, dtype=np.int64)
+    engine.parent_index = np.arange(-1, 6, dtype=np.int64)
+    engine.depth = np.arange(1, 8, dtype=np.int32)
+    return engine
+
+
+def _expected_cents(amount_cents, rate):
+    """ROUND(amount * rate, 2) do PostgreSQL (half-up em numeric), em centavos"""
+    value = (Decimal(amount_cents) / 100 * Decimal(str(rate))).quantize(Decimal('0.01'), ROUND_HALF_UP)
+    return int(value * 100)
+
+
+def test_commissions_round_half_up_to_cents(engine):
+    amounts = np.array([1, 9, 10, 30, 99, 100, 150, 1_001, 12_345, 99_999_999], dtype=np.int64)
+    n = len(amounts)
+
+    result = engine.calculate_batch(np.arange(100, 100 + n), np.full(n, 7), amounts)
+
+    rules = engine.config['commission_rules']
+    expected = sorted(
+        (100 + i, 7 - level, level, _expected_cents(int(amount), rules[level]))
+        for level in range(1, 6)
+        for i, amount in enumerate(amounts.tolist())
+        if _expected_cents(int(amount), rules[level]) > 0
+    )
+    actual = sorted(zip(result['transaction_id'].tolist(), result['beneficiary_id'].tolist(),
+                        result['level_distance'].tolist(), result['commission_cents'].tolist()))
+    assert actual == expected
+    assert set(result['source_id'].tolist()) == {7}
+
+
+def test_levels_stop_at_root_and_unknown_sources_are_skipped(engine):
+    result = engine.calculate_batch(np.array([1, 2, 3]), np.array([3, 1, 42]),
+                                    np.array([10_000, 10_000, 10_000]))
+
+    assert sorted(zip(result['transaction_id'].tolist(), result['beneficiary_id'].tolist(),
+                      result['commission_cents'].tolist())) == [(1, 1, 300), (1, 2, 500)]
+
+
+def test_format_cents_and_rate_validation(engine):
+    assert engine._format_cents(0) == '0.00'
+    assert engine._format_cents(7) == '0.07'
+    assert engine._format_cents(123_456) == '1234.56'
+
+    engine.config['commission_rules'][1] = 0.00005
+    with pytest.raises(ValueError):
+        engine._build_rate_table()
+
+
+@pytest.fixture
+def engine_db(fature_db):
+    with fature_db.cursor() as cursor:
+        for affiliate_id, parent_id in ((1, None), (2, 1), (3, 2)):
+            cursor.execute("""
+                INSERT INTO fature_v2.affiliates_optimized
+                    (affiliate_id, parent_affiliate_id, external_id, name, registration_date,
+                     hierarchy_path, hierarchy_level)
+                VALUES (%s, %s, %s, %s, NOW(), '0', 1)
+            """, (affiliate_id, parent_id, f"ext-{affiliate_id}", f"Afiliado {affiliate_id}"))
+        cursor.execute("""
+            INSERT INTO fature_v2.transactions (affiliate_id, transaction_type, amount)
+            SELECT 3, 'deposit', 100 FROM generate_series(1, 3)
+        """)
+        cursor.execute("SELECT LOCALTIMESTAMP - INTERVAL '1 hour', LOCALTIMESTAMP + INTERVAL '1 hour'")
+        window = cursor.fetchone()
+    fature_db.commit()
+    return fature_db, window
+
+
+def _commissions_by_transaction(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT transaction_id, COUNT(*) FROM fature_v2.commissions
+            GROUP BY transaction_id ORDER BY transaction_id
+        """)
+        rows = cursor.fetchall()
+    conn.commit()
+    return rows
+
+
+@pytest.mark.db
+def test_process_window_skips_transactions_claimed_by_worker(engine_db):
+    conn, (start, end) = engine_db
+    worker = psycopg2.connect(os.environ['FATURE_TEST_DATABASE_URL'])
+    try:
+        # Transação 1 em processamento pelo commission_worker
+        with worker.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM fature_v2.transactions WHERE transaction_id = 1 FOR UPDATE")
+
+        engine = FatureCommissionEngine()
+        stats = engine.process_window(start, end)
+        assert 'error' not in stats
+        assert (stats['transactions'], stats['commissions']) == (2, 4)
+        assert _commissions_by_transaction(conn) == [(2, 2), (3, 2)]
+
+        with worker.cursor() as cursor:
+            cursor.execute("""
+                UPDATE fature_v2.transactions SET commission_processed = true WHERE transaction_id = 1
+            """)
+        worker.commit()
+    finally:
+        worker.close()
+
+    stats = engine.process_window(start, end)
+    assert (stats['transactions'], stats['commissions']) == (0, 0)
+    assert _commissions_by_transaction(conn) == [(2, 2), (3, 2)]
+
+
+@pytest.mark.db
+def test_mark_only_returns_transactions_still_pending(engine_db):
+    conn, _ = engine_db
+    with conn.cursor() as cursor:
+        cursor.execute("UPDATE fature_v2.transactions SET commission_processed = true WHERE transaction_id = 2")
+    conn.commit()
+
+    marked = FatureCommissionEngine().mark_transactions_processed(conn, np.array([1, 2, 3]))
+    conn.commit()
+    assert sorted(marked.tolist()) == [1, 3]
@@ -0,0 +1,113 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from commission_payout import FatureCommissionPayout
+
+pytestmark = pytest.mark.db
+
+# beneficiário -> valores das comissões aprovadas
+APPROVED = {1: ['10.05', '0.10', '3.33'], 2: ['7.77'], 3: ['0.01', '0.02']}
+
+
+@pytest.fixture
+def payout_db(fature_db):
+    with fature_db.cursor() as cursor:
+        for affiliate_id, parent_id in ((1, None), (2, 1), (3, 2), (4, 3)):
+            cursor.execute("""
+                INSERT INTO fature_v2.affiliates_optimized
+                    (affiliate_id, parent_affiliate_id, external_id, name, registration_date,
+                     hierarchy_path, hierarchy_level)
+                VALUES (%s, %s, %s, %s, NOW(), '0', 1)
+            """, (affiliate_id, parent_id, f"ext-{affiliate_id}", f"Afiliado {affiliate_id}"))
+        cursor.execute("""
+            INSERT INTO fature_v2.transactions (affiliate_id, transaction_type, amount)
+            VALUES (4, 'deposit', 1000) RETURNING transaction_id
+        """)
+        transaction_id = cursor.fetchone()[0]
+
+        def commission(beneficiary_id, amount, status='approved', created_at=None):
+            cursor.execute("""
+                INSERT INTO fature_v2.commissions
+                    (transaction_id, beneficiary_affiliate_id, source_affiliate_id, level_distance,
+                     base_amount, commission_rate, commission_amount, status, created_at)
+                VALUES (%s, %s, 4, 1, 1000, 0.01, %s, %s, COALESCE(%s, NOW() - INTERVAL '1 day'))
+            """, (transaction_id, beneficiary_id, amount, status, created_at))
+
+        for beneficiary_id, amounts in APPROVED.items():
+            for amount in amounts:
+                commission(beneficiary_id, amount)
+        commission(1, '50.00', status='pending')
+        commission(2, '9.99', created_at=datetime.now() + timedelta(days=1))
+    fature_db.commit()
+    return fature_db
+
+
+def _payout(tmp_path):
+    payout = FatureCommissionPayout()
+    payout.config['export_dir'] = str(tmp_path)
+    payout.config['beneficiaries_per_batch'] = 2
+    payout.config['max_beneficiaries_in_memory'] = 1
+    return payout
+
+
+def _rows(conn, sql):
+    with conn.cursor() as cursor:
+        cursor.execute(sql)
+        return cursor.fetchall()
+
+
+def test_run_pays_approved_commissions_and_exports_after_commit(payout_db, tmp_path):
+    stats = _payout(tmp_path).run(datetime.now())
+
+    assert 'error' not in stats
+    assert stats['commissions'] == 6
+    assert stats['beneficiaries'] == 3
+    assert [batch['beneficiaries'] for batch in stats['batches']] == [2, 1]
+    assert stats['total_amount'] == pytest.approx(21.28)
+
+    paid = dict(_rows(payout_db, """
+        SELECT affiliate_id, total_commissions_paid FROM fature_v2.affiliates_optimized
+    """))
+    assert {k: str(v) for k, v in paid.items()} == {1: '13.48', 2: '7.77', 3: '0.03', 4: '0.00'}
+    assert _rows(payout_db, """
+        SELECT status, COUNT(*), COUNT(batch_id) FROM fature_v2.commissions GROUP BY status ORDER BY status
+    """) == [('approved', 1, 0), ('paid', 6, 6), ('pending', 1, 0)]
+
+    assert os.listdir(tmp_path) == [os.path.basename(stats['export_file'])]
+    with open(stats['export_file']) as f:
+        assert len(f.read().splitlines()) == 4
+
+
+def test_preview_does_not_consume_batch_sequence(payout_db, tmp_path):
+    stats = _payout(tmp_path).run(datetime.now(), dry_run=True)
+
+    assert [batch['batch_id'] for batch in stats['batches']] == [1, 2]
+    assert _rows(payout_db, "SELECT is_called FROM fature_v2.commission_batch_seq") == [(False,)]
+    assert _rows(payout_db, "SELECT COUNT(*) FROM fature_v2.commissions WHERE status = 'paid'") == [(0,)]
+    assert os.listdir(tmp_path) == []
+
+
+def test_failed_commit_leaves_no_export(payout_db, tmp_path):
+    with payout_db.cursor() as cursor:
+        cursor.execute("""
+            CREATE FUNCTION fature_v2.reject_payout() RETURNS TRIGGER AS $$
+            BEGIN
+                RAISE EXCEPTION 'pagamento recusado no COMMIT';
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE CONSTRAINT TRIGGER trg_reject_payout
+                AFTER UPDATE ON fature_v2.commissions
+                DEFERRABLE INITIALLY DEFERRED
+                FOR EACH ROW EXECUTE FUNCTION fature_v2.reject_payout();
+        """)
+    payout_db.commit()
+
+    stats = _payout(tmp_path).run(datetime.now())
+
+    assert 'recusado' in stats['error']
+    assert 'export_file' not in stats
+    assert os.listdir(tmp_path) == []
+    assert _rows(payout_db, "SELECT COUNT(*) FROM fature_v2.commissions WHERE status = 'paid'") == [(0,)]
@@ -0,0 +1,187 @@
+import threading
+
+import pytest
+
+from commission_worker import CLAIM_IDS_SQL, FatureCommissionWorker
+from migrate_fature import FatureMigration
+
+pytestmark = pytest.mark.db
+
+
+@pytest.fixture
+def queue_db(fature_db):
+    """Árvore 1 -> 2 -> 3 e transações 1 (afiliado 3) e 2 (afiliado 2)"""
+    with fature_db.cursor() as cursor:
+        for affiliate_id, parent_id in ((1, None), (2, 1), (3, 2)):
+            cursor.execute("""
+                INSERT INTO fature_v2.affiliates_optimized
+                    (affiliate_id, parent_affiliate_id, external_id, name, registration_date,
+                     hierarchy_path, hierarchy_level)
+                VALUES (%s, %s, %s, %s, NOW(), '0', 1)
+            """, (affiliate_id, parent_id, f"ext-{affiliate_id}", f"Afiliado {affiliate_id}"))
+        cursor.execute("""
+            INSERT INTO fature_v2.transactions (transaction_id, affiliate_id, transaction_type, amount)
+            VALUES (1, 3, 'deposit', 100), (2, 2, 'deposit', 200)
+        """)
+    fature_db.commit()
+    return fature_db
+
+
+def _enqueue(conn, *transaction_ids, delay_seconds=0):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO fature_v2.commission_queue (transaction_id, next_attempt_at)
+            SELECT id, NOW() + %s * INTERVAL '1 second' FROM unnest(%s::BIGINT[]) id
+            RETURNING queue_id
+        """, (delay_seconds, list(transaction_ids)))
+        queue_ids = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+    return queue_ids
+
+
+def _rows(conn, sql):
+    with conn.cursor() as cursor:
+        cursor.execute(sql)
+        rows = cursor.fetchall()
+    conn.commit()
+    return rows
+
+
+COMMISSIONS_SQL = """
+    SELECT transaction_id, beneficiary_affiliate_id, level_distance, commission_amount::text
+    FROM fature_v2.commissions ORDER BY transaction_id, level_distance
+"""
+
+
+def test_batch_claims_due_items_and_writes_commissions_once(queue_db):
+    _enqueue(queue_db, 1, 1, 2)
+    _enqueue(queue_db, 2, delay_seconds=3600)
+
+    worker = FatureCommissionWorker()
+    conn = worker.connect_database()
+    try:
+        assert worker.process_batch(conn) == 3
+        assert worker.process_batch(conn) == 0
+    finally:
+        conn.close()
+
+    assert worker.stats['commissions'] == 3
+    assert _rows(queue_db, COMMISSIONS_SQL) == [(1, 2, 1, '5.00'), (1, 1, 2, '3.00'), (2, 1, 1, '10.00')]
+    assert _rows(queue_db, """
+        SELECT status, attempts, COUNT(*) FROM fature_v2.commission_queue GROUP BY 1, 2 ORDER BY 1
+    """) == [('pending', 0, 1), ('processed', 1, 3)]
+    assert _rows(queue_db, "SELECT transaction_id FROM fature_v2.commission_queue WHERE status = 'pending'") \
+        == [(2,)]
+    assert _rows(queue_db, "SELECT bool_and(commission_processed) FROM fature_v2.transactions") == [(True,)]
+
+
+def test_queue_items_of_same_transaction_in_two_workers(queue_db):
+    first_item, _ = _enqueue(queue_db, 1, 1)
+
+    first = FatureCommissionWorker()
+    first_conn = first.connect_database()
+    outcome = {}
+    try:
+        # Primeiro worker processa um item e ainda não fez COMMIT
+        with first_conn.cursor() as cursor:
+            cursor.execute(first._process_sql(CLAIM_IDS_SQL), {'queue_ids': [first_item]})
+            assert cursor.fetchone() == (1, 1, 2)
+
+        second = FatureCommissionWorker()
+
+        def run_second():
+            conn = second.connect_database()
+            try:
+                outcome['processed'] = second.process_batch(conn)
+            finally:
+                conn.close()
+
+        thread = threading.Thread(target=run_second)
+        thread.start()
+        thread.join(1)
+        assert thread.is_alive()
+
+        first_conn.commit()
+        thread.join(10)
+        assert not thread.is_alive()
+    finally:
+        first_conn.close()
+
+    assert outcome['processed'] == 1
+    assert second.stats['commissions'] == 0
+    assert _rows(queue_db, COMMISSIONS_SQL) == [(1, 2, 1, '5.00'), (1, 1, 2, '3.00')]
+
+
+def test_failed_item_is_retried_with_backoff_and_then_given_up(queue_db):
+    with queue_db.cursor() as cursor:
+        cursor.execute("""
+            CREATE FUNCTION fature_v2.reject_transaction_1() RETURNS TRIGGER AS $$
+            BEGIN
+                IF NEW.transaction_id = 1 THEN
+                    RAISE EXCEPTION 'comissão recusada';
+                END IF;
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER trg_reject_transaction_1
+                BEFORE INSERT ON fature_v2.commissions
+                FOR EACH ROW EXECUTE FUNCTION fature_v2.reject_transaction_1();
+        """)
+    queue_db.commit()
+    failing, working = _enqueue(queue_db, 1, 2)
+
+    worker = FatureCommissionWorker()
+    worker.config.update({'backoff_base_seconds': 30, 'backoff_max_seconds': 45})
+    conn = worker.connect_database()
+    state_sql = f"""
+        SELECT status, attempts, EXTRACT(EPOCH FROM next_attempt_at - processed_at)::INTEGER,
+               error_message LIKE '%%comissão recusada%%'
+        FROM fature_v2.commission_queue WHERE queue_id = {failing}
+    """
+    try:
+        # Lote falha inteiro e é reprocessado item a item
+        assert worker.process_batch(conn) == 2
+        assert _rows(queue_db, state_sql) == [('pending', 1, 30, True)]
+        assert _rows(queue_db, f"SELECT status FROM fature_v2.commission_queue WHERE queue_id = {working}") \
+            == [('processed',)]
+
+        # Antes do backoff o item não é reivindicado
+        assert worker.process_batch(conn) == 0
+
+        expected = [('pending', 2, 45, True), ('failed', 3, 45, True)]
+        for state in expected:
+            with queue_db.cursor() as cursor:
+                cursor.execute(f"""
+                    UPDATE fature_v2.commission_queue SET next_attempt_at = NOW() WHERE queue_id = {failing}
+                """)
+            queue_db.commit()
+            assert worker.process_batch(conn) == 1
+            assert _rows(queue_db, state_sql) == [state]
+
+        assert worker.process_batch(conn) == 0
+    finally:
+        conn.close()
+
+    assert worker.stats['failed'] == 3
+    assert _rows(queue_db, "SELECT DISTINCT transaction_id FROM fature_v2.commissions") == [(2,)]
+
+
+def test_missing_backoff_column_is_added_by_migration_upgrade(fature_db):
+    worker = FatureCommissionWorker()
+    conn = worker.connect_database()
+    try:
+        worker.check_schema(conn)
+
+        with fature_db.cursor() as cursor:
+            cursor.execute("ALTER TABLE fature_v2.commission_queue DROP COLUMN next_attempt_at")
+        fature_db.commit()
+
+        with pytest.raises(RuntimeError, match='migrate_fature.py upgrade'):
+            worker.check_schema(conn)
+
+        assert FatureMigration().upgrade_schema() == ['commission_queue.next_attempt_at']
+        assert FatureMigration().upgrade_schema() == []
+        worker.check_schema(conn)
+    finally:
+        conn.close()
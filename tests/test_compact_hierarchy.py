@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from compact_hierarchy import CompactHierarchy
+
+
+def _chains(ids, parents):
+    """Cadeia de ancestrais (pai primeiro) de cada afiliado, por força bruta"""
+    parent_of = dict(zip(ids.tolist(), parents.tolist()))
+    chains = {}
+    for affiliate_id in parent_of:
+        chain, current = [], parent_of[affiliate_id]
+        while current:
+            chain.append(current)
+            current = parent_of[current]
+        chains[affiliate_id] = chain
+    return chains
+
+
+def _assert_matches_brute_force(hierarchy, ids, parents, max_levels=5):
+    chains = _chains(ids, parents)
+    by_level = {affiliate_id: [0] * max_levels for affiliate_id in chains}
+    network = {affiliate_id: set() for affiliate_id in chains}
+    for affiliate_id, chain in chains.items():
+        for distance, ancestor in enumerate(chain, start=1):
+            network[ancestor].add(affiliate_id)
+            if distance <= max_levels:
+                by_level[ancestor][distance - 1] += 1
+
+    for affiliate_id, chain in chains.items():
+        assert hierarchy.ancestors(affiliate_id, max_levels) == chain[:max_levels]
+        assert hierarchy.network_size(affiliate_id) == len(network[affiliate_id])
+        assert hierarchy.network_by_level(affiliate_id, max_levels) == by_level[affiliate_id]
+        assert int(hierarchy.depth[hierarchy.index_of(affiliate_id)]) == len(chain)
+
+
+def test_queries_match_brute_force(random_tree):
+    ids, parents = random_tree(400, seed=7)
+    hierarchy = CompactHierarchy.build(ids, parents)
+
+    assert len(hierarchy) == 400
+    assert np.all(np.diff(hierarchy.affiliate_ids) > 0)
+    _assert_matches_brute_force(hierarchy, ids, parents)
+
+    chains = _chains(ids, parents)
+    rng = np.random.default_rng(1)
+    for affiliate_id, root_id in rng.choice(ids, size=(500, 2)):
+        expected = int(root_id) in chains[int(affiliate_id)]
+        assert hierarchy.is_in_network(int(affiliate_id), int(root_id)) == expected
+    assert not hierarchy.is_in_network(int(ids[0]), int(ids[0]))
+
+
+def test_save_and_load_round_trip(random_tree, tmp_path):
+    ids, parents = random_tree(300, seed=3)
+    hierarchy = CompactHierarchy.build(ids, parents)
+    path = str(tmp_path / 'hierarchy.bin')
+
+    hierarchy.save(path)
+    loaded = CompactHierarchy.load(path)
+
+    assert len(loaded) == len(hierarchy)
+    assert loaded.max_depth == hierarchy.max_depth
+    for name in ('affiliate_ids', 'parent', 'depth', 'tin', 'tout', 'level_order', 'level_tin', 'level_start'):
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(hierarchy, name))
+    _assert_matches_brute_force(loaded, ids, parents)
+
+
+def test_empty_hierarchy_round_trip(tmp_path):
+    hierarchy = CompactHierarchy.build(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+    path = str(tmp_path / 'empty.bin')
+    hierarchy.save(path)
+
+    loaded = CompactHierarchy.load(path)
+    assert len(loaded) == 0
+    assert loaded.max_depth == -1
+
+
+def test_unknown_parent_is_root_and_unknown_id_raises():
+    hierarchy = CompactHierarchy.build(np.array([10, 20, 30]), np.array([0, 10, 99]))
+
+    assert hierarchy.ancestors(20) == [10]
+    assert hierarchy.ancestors(30) == []
+    assert hierarchy.indices_of(np.array([20, 25])).tolist() == [1, -1]
+    with pytest.raises(KeyError):
+        hierarchy.index_of(25)
+
+
+def test_invalid_hierarchies_are_rejected(tmp_path):
+    with pytest.raises(ValueError, match='duplicado'):
+        CompactHierarchy.build(np.array([1, 2, 2]), np.array([0, 1, 1]))
+    with pytest.raises(ValueError, match='Ciclo'):
+        CompactHierarchy.build(np.array([1, 2, 3]), np.array([0, 3, 2]))
+
+    path = tmp_path / 'other.bin'
+    path.write_bytes(b'NOTAHIER' + b'\0' * 16)
+    with pytest.raises(ValueError):
+        CompactHierarchy.load(str(path))
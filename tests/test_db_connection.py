@@ -0,0 +1,54 @@
+import os
+
+import psycopg2
+import pytest
+
+import db_connection
+from db_connection import FatureConnectionPool, database_config
+
+
+@pytest.fixture
+def no_database_env(monkeypatch, tmp_path):
+    for variable in ['FATURE_DATABASE_URL', 'DATABASE_URL'] + list(db_connection.ENV_FIELDS.values()):
+        monkeypatch.delenv(variable, raising=False)
+    monkeypatch.setattr(db_connection, 'CONFIG_FILE', str(tmp_path / 'db_config.json'))
+    return tmp_path
+
+
+def test_database_config_requires_password(no_database_env, monkeypatch):
+    with pytest.raises(ValueError):
+        database_config()
+
+    monkeypatch.setenv('FATURE_DB_PASSWORD', 'segredo')
+    assert database_config()['password'] == 'segredo'
+
+
+def test_database_config_reads_password_from_config_file(no_database_env):
+    (no_database_env / 'db_config.json').write_text('{"password": "segredo", "port": "6543"}')
+
+    config = database_config()
+    assert config['password'] == 'segredo'
+    assert config['port'] == 6543
+
+
+@pytest.mark.db
+def test_failed_profile_discards_connection_and_frees_slot(fature_db, monkeypatch):
+    pool = FatureConnectionPool({'dsn': os.environ['FATURE_TEST_DATABASE_URL']},
+                                {'max_connections': 1, 'checkout_timeout_seconds': 1})
+    try:
+        def broken_profile(conn, profile):
+            raise psycopg2.OperationalError("falha simulada ao aplicar o perfil")
+
+        with monkeypatch.context() as patch:
+            patch.setattr(pool, '_apply_profile', broken_profile)
+            for _ in range(2):
+                # Com a vaga perdida, a segunda tentativa esgotaria o tempo com PoolError
+                with pytest.raises(psycopg2.OperationalError):
+                    pool.getconn('report')
+
+        with pool.connection('report') as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT current_setting('application_name')")
+                assert cursor.fetchone()[0] == 'fature-report'
+    finally:
+        pool.closeall()
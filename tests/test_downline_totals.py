@@ -0,0 +1,44 @@
+import numpy as np
+
+from compact_hierarchy import CompactHierarchy
+from downline_totals import METRICS, DownlineTotals
+
+
+def test_query_matches_brute_force(random_tree):
+    ids, parents = random_tree(250, seed=5)
+    hierarchy = CompactHierarchy.build(ids, parents)
+    rng = np.random.default_rng(2)
+    values = rng.integers(0, 10_000_000, size=(len(hierarchy), len(METRICS)), dtype=np.int64)
+    totals = DownlineTotals(hierarchy, values)
+
+    parent_of = dict(zip(ids.tolist(), parents.tolist()))
+    row_of = {affiliate_id: row for row, affiliate_id in enumerate(hierarchy.affiliate_ids.tolist())}
+    network = {affiliate_id: np.zeros(len(METRICS), dtype=np.int64) for affiliate_id in parent_of}
+    levels = {affiliate_id: np.zeros((5, len(METRICS)), dtype=np.int64) for affiliate_id in parent_of}
+    level_sizes = {affiliate_id: [0] * 5 for affiliate_id in parent_of}
+    network_size = dict.fromkeys(parent_of, 0)
+    for affiliate_id in parent_of:
+        distance, ancestor = 1, parent_of[affiliate_id]
+        while ancestor:
+            network[ancestor] += values[row_of[affiliate_id]]
+            network_size[ancestor] += 1
+            if distance <= 5:
+                levels[ancestor][distance - 1] += values[row_of[affiliate_id]]
+                level_sizes[ancestor][distance - 1] += 1
+            distance, ancestor = distance + 1, parent_of[ancestor]
+
+    query_ids = ids.tolist() + [0, -5]
+    result = totals.query(query_ids, max_levels=5)
+
+    assert result['found'].tolist() == [True] * len(ids) + [False, False]
+    for i, affiliate_id in enumerate(ids.tolist()):
+        np.testing.assert_array_equal(result['own'][i], values[row_of[affiliate_id]])
+        np.testing.assert_array_equal(result['network'][i], network[affiliate_id])
+        assert result['network_size'][i] == network_size[affiliate_id]
+        np.testing.assert_array_equal(result['levels'][i], levels[affiliate_id])
+        assert result['level_sizes'][i].tolist() == level_sizes[affiliate_id]
+
+    for i in (-2, -1):
+        assert not result['own'][i].any() and not result['network'][i].any()
+        assert result['network_size'][i] == 0
+        assert not result['levels'][i].any() and not result['level_sizes'][i].any()
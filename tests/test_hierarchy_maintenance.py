@@ -0,0 +1,119 @@
+import threading
+
+import psycopg2
+import pytest
+
+from hierarchy_maintenance import FatureHierarchyMaintenance
+
+pytestmark = pytest.mark.db
+
+# 1 -> 2 -> 3 e 1 -> 4
+TREE = ((1, None), (2, 1), (3, 2), (4, 1))
+
+
+def _insert_affiliate(cursor, affiliate_id, parent_id):
+    cursor.execute("""
+        INSERT INTO fature_v2.affiliates_optimized
+            (affiliate_id, parent_affiliate_id, external_id, name, registration_date,
+             hierarchy_path, hierarchy_level)
+        VALUES (%s, %s, %s, %s, NOW(), '0', 1)
+    """, (affiliate_id, parent_id, f"ext-{affiliate_id}", f"Afiliado {affiliate_id}"))
+
+
+@pytest.fixture
+def tree_db(fature_db):
+    with fature_db.cursor() as cursor:
+        for affiliate_id, parent_id in TREE:
+            _insert_affiliate(cursor, affiliate_id, parent_id)
+    fature_db.commit()
+    return fature_db
+
+
+def _in_thread(target):
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = target()
+        except Exception as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+
+def _path(conn, affiliate_id):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT hierarchy_path::text FROM fature_v2.affiliates_optimized WHERE affiliate_id = %s",
+                       (affiliate_id,))
+        path = cursor.fetchone()[0]
+    conn.commit()
+    return path
+
+
+def test_move_waits_for_insert_under_subtree(tree_db):
+    url = tree_db.dsn
+    insert_conn = psycopg2.connect(url)
+    try:
+        with insert_conn.cursor() as cursor:
+            _insert_affiliate(cursor, 5, 3)
+
+        thread, outcome = _in_thread(lambda: FatureHierarchyMaintenance().move_subtree(2, 4))
+        thread.join(1)
+        assert thread.is_alive()
+
+        insert_conn.commit()
+        thread.join(10)
+        assert not thread.is_alive()
+    finally:
+        insert_conn.close()
+
+    assert 'error' not in outcome
+    assert outcome['result']['subtree_size'] == 3
+    assert _path(tree_db, 5) == '1.4.2.3.5'
+
+    report = FatureHierarchyMaintenance().verify_subtree(2)
+    assert report['valid'], report
+    with tree_db.cursor() as cursor:
+        cursor.execute("""
+            SELECT ancestor_id, level_distance FROM fature_v2.hierarchy_index
+            WHERE descendant_id = 5 ORDER BY level_distance
+        """)
+        assert cursor.fetchall() == [(3, 1), (2, 2), (4, 3), (1, 4)]
+
+
+def test_insert_waits_for_move_of_parent(tree_db):
+    url = tree_db.dsn
+    move_conn = psycopg2.connect(url)
+    try:
+        # Simula um move_subtree em andamento: linha do pai bloqueada e caminho já reescrito
+        with move_conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT 1 FROM fature_v2.affiliates_optimized WHERE affiliate_id = 3 FOR UPDATE;
+                UPDATE fature_v2.affiliates_optimized
+                SET hierarchy_path = '1.4.3', hierarchy_level = 3
+                WHERE affiliate_id = 3;
+            """)
+
+        def insert_child():
+            conn = psycopg2.connect(url)
+            try:
+                with conn.cursor() as cursor:
+                    _insert_affiliate(cursor, 5, 3)
+                conn.commit()
+            finally:
+                conn.close()
+
+        thread, outcome = _in_thread(insert_child)
+        thread.join(1)
+        assert thread.is_alive()
+
+        move_conn.commit()
+        thread.join(10)
+        assert not thread.is_alive()
+    finally:
+        move_conn.close()
+
+    assert 'error' not in outcome
+    assert _path(tree_db, 5) == '1.4.3.5'
@@ -0,0 +1,16 @@
+import numpy as np
+
+from compact_hierarchy import CompactHierarchy
+from level_referrals import FatureLevelReferrals
+
+
+def test_compute_counts_matches_compact_hierarchy(random_tree, offline_database):
+    ids, parents = random_tree(300, seed=11)
+    hierarchy = CompactHierarchy.build(ids, parents)
+
+    counts = FatureLevelReferrals().compute_counts(hierarchy)
+
+    assert counts.shape == (300, 6)
+    assert np.all(counts[:, 0] == 1)
+    for node, affiliate_id in enumerate(hierarchy.affiliate_ids.tolist()):
+        assert counts[node, 1:].tolist() == hierarchy.network_by_level(affiliate_id, 5)
@@ -0,0 +1,73 @@
+import pytest
+
+from log_retention import FatureLogRetention
+
+pytestmark = pytest.mark.db
+
+
+def _insert_queries(conn, hours_ago, durations, sample_rate=1.0, query_type='monitor_select'):
+    """Linhas brutas 10 minutos depois do início da hora de `hours_ago` horas atrás"""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO fature_v2.query_performance_log
+                (query_type, query_duration_ms, affected_rows, parameters, created_at)
+            SELECT %s, d, 1, jsonb_build_object('sample_rate', %s::float),
+                   date_trunc('hour', LOCALTIMESTAMP) - %s * INTERVAL '1 hour' + INTERVAL '10 minutes'
+            FROM unnest(%s::int[]) d
+        """, (query_type, sample_rate, hours_ago, durations))
+    conn.commit()
+
+
+def _scalar(conn, sql, params=None):
+    with conn.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchone()[0]
+
+
+def test_rollup_summarizes_complete_hours_before_retention(fature_db):
+    for hours_ago in (30, 29, 28):
+        _insert_queries(fature_db, hours_ago, [10, 20, 30, 40])
+    _insert_queries(fature_db, 27, [10, 20, 30, 40], sample_rate=0.5)
+    _insert_queries(fature_db, 2, [500])
+
+    stats = FatureLogRetention().rollup()
+
+    assert stats['hours'] == 6
+    assert stats['summary_rows'] == 4
+    with fature_db.cursor() as cursor:
+        cursor.execute("""
+            SELECT query_count, sampled_count, total_duration_ms, p50_ms, p95_ms, slow_count
+            FROM fature_v2.query_performance_hourly
+            ORDER BY hour
+        """)
+        rows = cursor.fetchall()
+    assert rows[:3] == [(4, 4, 100, 20, 40, 0)] * 3
+    # Amostra de 50%: contagens e somas dobram, percentis seguem a ordem ponderada
+    assert rows[3] == (8, 4, 200, 20, 40, 0)
+
+    rolled_until = _scalar(fature_db, """
+        SELECT (details->>'rolled_until')::timestamp = date_trunc('hour', LOCALTIMESTAMP) - INTERVAL '24 hours'
+        FROM fature_v2.refresh_state WHERE job_name = 'log_retention'
+    """)
+    assert rolled_until is True
+
+    # Reexecução não resume de novo as mesmas horas
+    again = FatureLogRetention().rollup()
+    assert again['hours'] == 0 and again['summary_rows'] == 0
+
+
+def test_run_purges_only_rolled_up_raw_rows(fature_db):
+    _insert_queries(fature_db, 48, [10] * 30)
+    _insert_queries(fature_db, 2, [10] * 5)
+
+    job = FatureLogRetention()
+    job.config['delete_batch_size'] = 7
+    job.config['delete_pause_seconds'] = 0
+    stats = job.run()
+
+    assert stats['query_performance_log_deleted'] == 30
+    assert _scalar(fature_db, "SELECT COUNT(*) FROM fature_v2.query_performance_log") == 5
+    assert _scalar(fature_db, "SELECT SUM(query_count) FROM fature_v2.query_performance_hourly") == 30
+    assert _scalar(fature_db, """
+        SELECT COUNT(*) FROM fature_v2.system_log WHERE operation = 'log_retention'
+    """) == 1
@@ -0,0 +1,153 @@
+import logging
+
+import pytest
+
+from db_connection import get_pool
+from migrate_fature import FatureMigration
+from run_bench import BENCH_AFFILIATES_DDL, SQL_DIR
+
+pytestmark = pytest.mark.db
+
+# Base legada (public.affiliates): 1 -> 2 -> 3 -> 5 e 1 -> 4
+LEGACY_TREE = ((1, None), (2, 1), (3, 2), (4, 1), (5, 3))
+
+SECONDARY_OBJECTS_SQL = """
+    SELECT
+        (SELECT COUNT(*) FROM pg_index i
+         JOIN pg_class t ON t.oid = i.indrelid
+         WHERE t.relnamespace = 'fature_v2'::regnamespace AND t.relkind = 'r'
+           AND NOT EXISTS (SELECT 1 FROM pg_constraint k WHERE k.conindid = i.indexrelid)),
+        (SELECT COUNT(*) FROM pg_constraint
+         WHERE connamespace = 'fature_v2'::regnamespace AND contype = 'f' AND convalidated)
+"""
+
+
+@pytest.fixture
+def legacy_db(fature_db):
+    with fature_db.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS public.affiliates CASCADE;")
+        cursor.execute(BENCH_AFFILIATES_DDL)
+        for affiliate_id, parent_id in LEGACY_TREE:
+            cursor.execute("""
+                INSERT INTO public.affiliates
+                    (affiliate_id, parent_affiliate_id, external_id, name, registration_date, total_deposits)
+                VALUES (%s, %s, %s, %s, NOW(), %s)
+            """, (affiliate_id, parent_id, f"ext-{affiliate_id}", f"Afiliado {affiliate_id}", affiliate_id * 10))
+    fature_db.commit()
+    yield fature_db
+
+    fature_db.rollback()
+    with fature_db.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS public.affiliates CASCADE;")
+    fature_db.commit()
+
+
+def _rows(conn, sql):
+    with conn.cursor() as cursor:
+        cursor.execute(sql)
+        rows = cursor.fetchall()
+    conn.commit()
+    return rows
+
+
+def _secondary_objects(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(SECONDARY_OBJECTS_SQL)
+        return cursor.fetchone()
+
+
+def test_deferred_objects_survive_interrupted_migration(fature_db):
+    before = _secondary_objects(fature_db)
+    assert before[0] > 0 and before[1] > 0
+
+    with fature_db.cursor() as cursor:
+        deferred = FatureMigration().defer_secondary_objects(cursor)
+    fature_db.commit()
+    assert _secondary_objects(fature_db) == (0, 0)
+
+    # Processo novo, sem o estado em memória da migração interrompida
+    migration = FatureMigration()
+    assert migration.restore_deferred_objects()
+
+    assert _secondary_objects(fature_db) == before
+    with fature_db.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM fature_v2.deferred_objects WHERE restored_at IS NULL")
+        assert cursor.fetchone()[0] == 0
+    assert len(migration.stats['index_builds']) == len(deferred['indexes'])
+
+    # Nada pendente: nova retomada não faz nada
+    assert FatureMigration().restore_deferred_objects()
+
+
+def test_resume_keeps_foreign_keys_already_added_as_not_valid(fature_db):
+    with fature_db.cursor() as cursor:
+        deferred = FatureMigration().defer_secondary_objects(cursor)
+        fk = deferred['foreign_keys'][0]
+        cursor.execute(f'ALTER TABLE fature_v2.{fk["table"]} '
+                       f'ADD CONSTRAINT "{fk["name"]}" {fk["definition"]} NOT VALID')
+    fature_db.commit()
+
+    migration = FatureMigration()
+    assert migration.validate_foreign_keys(fature_db)
+    assert len(migration.stats['foreign_key_validations']) == len(deferred['foreign_keys'])
+
+
+def test_migrate_affiliates_batch_runs_insert_triggers_on_pool_connection(legacy_db):
+    migration = FatureMigration()
+    conn = migration.connect_database()
+    try:
+        result = migration.migrate_affiliates_batch(conn, 0, 100)
+    finally:
+        get_pool(migration.config['database']).putconn(conn)
+
+    assert result == {'processed': 5, 'success': 5, 'errors': 0}
+    assert _rows(legacy_db, """
+        SELECT affiliate_id, hierarchy_path::text, hierarchy_level, direct_referrals_count, total_network_size
+        FROM fature_v2.affiliates_optimized ORDER BY affiliate_id
+    """) == [(1, '1', 1, 2, 4), (2, '1.2', 2, 1, 2), (3, '1.2.3', 3, 1, 1), (4, '1.4', 2, 0, 0),
+             (5, '1.2.3.5', 4, 0, 0)]
+    assert _rows(legacy_db, """
+        SELECT ancestor_id, descendant_id, level_distance FROM fature_v2.hierarchy_index
+        ORDER BY descendant_id, level_distance
+    """) == [(1, 2, 1), (2, 3, 1), (1, 3, 2), (1, 4, 1), (3, 5, 1), (2, 5, 2), (1, 5, 3)]
+
+
+def test_run_migration_restores_deferred_objects_and_validates(legacy_db, monkeypatch):
+    schema_objects = _secondary_objects(legacy_db)
+    with legacy_db.cursor() as cursor:
+        cursor.execute("DROP SCHEMA fature_v2 CASCADE;")
+    legacy_db.commit()
+
+    # create_new_schema lê create_tables.sql do diretório atual
+    monkeypatch.chdir(SQL_DIR)
+    migration = FatureMigration()
+    validations = []
+    validate = migration.validate_migration
+
+    def recording_validate(conn):
+        validations.append(validate(conn))
+        return validations[-1]
+
+    monkeypatch.setattr(migration, 'validate_migration', recording_validate)
+
+    assert migration.run_migration()
+
+    assert migration.stats['affiliates_migrated'] == 5 and migration.stats['errors'] == 0
+    assert migration.stats['relationships_created'] == 7
+    assert all(validations[0].values()), validations[0]
+
+    # Fase pós-carga: tudo que foi adiado em create_new_schema voltou
+    assert _secondary_objects(legacy_db) == schema_objects
+    assert _rows(legacy_db, """
+        SELECT COUNT(*), COUNT(*) FILTER (WHERE restored_at IS NULL) FROM fature_v2.deferred_objects
+    """) == [(len(migration.stats['index_builds']) + len(migration.stats['foreign_key_validations']), 0)]
+    assert all(result['success'] for result in migration.stats['index_builds'])
+
+    assert _rows(legacy_db, """
+        SELECT affiliate_id, hierarchy_path::text, total_deposits::INTEGER
+        FROM fature_v2.affiliates_optimized ORDER BY affiliate_id
+    """) == [(1, '1', 10), (2, '1.2', 20), (3, '1.2.3', 30), (4, '1.4', 40), (5, '1.2.3.5', 50)]
+
+    # Importar o módulo não instala o FileHandler de migration.log
+    assert not [handler for handler in logging.getLogger().handlers
+                if getattr(handler, 'baseFilename', '').endswith('migration.log')]
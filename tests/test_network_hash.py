@@ -0,0 +1,107 @@
+import hashlib
+
+import pytest
+
+from compact_hierarchy import CompactHierarchy
+from hierarchy_maintenance import FatureHierarchyMaintenance
+from network_hash import FatureNetworkHash, compute_hashes
+
+
+def test_compute_hashes_matches_recursive_merkle(random_tree):
+    ids, parents = random_tree(400, seed=5)
+    hierarchy = CompactHierarchy.build(ids, parents)
+    own_of = {int(a): hashlib.sha256(f"linha {a}".encode()).digest() for a in ids.tolist()}
+    own = [own_of[int(a)] for a in hierarchy.affiliate_ids.tolist()]
+
+    children = {}
+    for affiliate_id, parent_id in zip(ids.tolist(), parents.tolist()):
+        children.setdefault(parent_id, []).append(affiliate_id)
+
+    def merkle(affiliate_id):
+        digest = hashlib.sha256(own_of[affiliate_id])
+        for child in sorted(children.get(affiliate_id, [])):
+            digest.update(merkle(child))
+        return digest.digest()
+
+    hashes = compute_hashes(hierarchy, own)
+
+    expected = {affiliate_id: merkle(affiliate_id) for affiliate_id in own_of}
+    actual = dict(zip(hierarchy.affiliate_ids.tolist(), hashes))
+    assert actual == expected
+
+
+# 1 -> 2 -> 3 -> 4, 2 -> 5, 1 -> 6 -> 7 e raiz 8
+TREE = ((1, None), (2, 1), (3, 2), (4, 3), (5, 2), (6, 1), (7, 6), (8, None))
+
+
+@pytest.fixture
+def hashed_db(fature_db):
+    with fature_db.cursor() as cursor:
+        for affiliate_id, parent_id in TREE:
+            cursor.execute("""
+                INSERT INTO fature_v2.affiliates_optimized
+                    (affiliate_id, parent_affiliate_id, external_id, name, registration_date,
+                     hierarchy_path, hierarchy_level)
+                VALUES (%s, %s, %s, %s, NOW(), '0', 1)
+            """, (affiliate_id, parent_id, f"ext-{affiliate_id}", f"Afiliado {affiliate_id}"))
+    fature_db.commit()
+    FatureNetworkHash().refresh(full=True)
+    return fature_db
+
+
+def _incremental_and_full(conn, change):
+    """Aplicar `change` e calcular os dois modos sobre os hashes gravados antes dela"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT clock_timestamp()")
+        since = cursor.fetchone()[0]
+    conn.commit()
+
+    change()
+
+    job = FatureNetworkHash()
+    with conn.cursor() as cursor:
+        incremental = job.compute_incremental(cursor, since)
+        full = job.compute_full(cursor)
+    conn.commit()
+    return incremental, full
+
+
+def _execute(conn, sql):
+    with conn.cursor() as cursor:
+        cursor.execute(sql)
+    conn.commit()
+
+
+@pytest.mark.db
+def test_incremental_matches_full_after_leaf_change(hashed_db):
+    # Sem trigger de UPDATE: quem altera o afiliado grava updated_at junto
+    incremental, full = _incremental_and_full(
+        hashed_db,
+        lambda: _execute(hashed_db, "UPDATE fature_v2.affiliates_optimized "
+                                    "SET total_deposits = 50, updated_at = NOW() WHERE affiliate_id = 4"))
+
+    assert sorted(full) == [1, 2, 3, 4]
+    assert incremental == full
+
+
+@pytest.mark.db
+def test_incremental_matches_full_after_move_subtree(hashed_db):
+    incremental, full = _incremental_and_full(
+        hashed_db, lambda: FatureHierarchyMaintenance().move_subtree(3, 6))
+
+    # A linha de 4 não muda (o pai continua 3): o hash dele é o mesmo
+    assert sorted(full) == [1, 2, 3, 6]
+    assert incremental == full
+
+
+@pytest.mark.db
+def test_incremental_matches_full_after_delete(hashed_db):
+    incremental, full = _incremental_and_full(
+        hashed_db,
+        lambda: _execute(hashed_db, """
+            DELETE FROM fature_v2.hierarchy_index WHERE descendant_id = 7 OR ancestor_id = 7;
+            DELETE FROM fature_v2.affiliates_optimized WHERE affiliate_id = 7;
+        """))
+
+    assert sorted(full) == [1, 6]
+    assert incremental == full
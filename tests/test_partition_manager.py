@@ -0,0 +1,81 @@
+import csv
+import gzip
+import os
+from datetime import date
+
+import pytest
+
+import partition_manager
+from partition_manager import FaturePartitionManager, count_archive_rows, next_period, partition_name, period_start
+
+
+def test_period_helpers():
+    assert period_start(date(2025, 6, 30), 'month') == date(2025, 6, 1)
+    assert next_period(date(2025, 12, 1), 'month') == date(2026, 1, 1)
+    assert next_period(date(2025, 6, 30), 'day') == date(2025, 7, 1)
+    assert partition_name('transactions', date(2025, 6, 1), 'month') == 'transactions_p2025_06'
+
+
+def test_count_archive_rows_handles_multiline_fields(tmp_path):
+    path = str(tmp_path / 'archive.csv.gz')
+    with gzip.open(path, 'wt', newline='') as archive:
+        writer = csv.writer(archive)
+        writer.writerow(['id', 'metadata'])
+        writer.writerows([[1, '{"a": 1}'], [2, 'linha 1\nlinha 2'], [3, '']])
+
+    assert count_archive_rows(path) == 3
+
+
+@pytest.fixture
+def events(fature_db, tmp_path):
+    with fature_db.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE fature_v2.events (id BIGINT, created_at DATE NOT NULL, note TEXT)
+                PARTITION BY RANGE (created_at);
+            CREATE TABLE fature_v2.events_p2024_01 PARTITION OF fature_v2.events
+                FOR VALUES FROM ('2024-01-01') TO ('2024-02-01');
+            CREATE TABLE fature_v2.events_p2024_02 PARTITION OF fature_v2.events
+                FOR VALUES FROM ('2024-02-01') TO ('2024-03-01');
+            INSERT INTO fature_v2.events
+            SELECT i, DATE '2024-01-01' + (i % 50), 'nota ' || i || E'\\ncom quebra'
+            FROM generate_series(1, 200) i;
+        """)
+    fature_db.commit()
+
+    manager = FaturePartitionManager()
+    manager.config['archive_dir'] = str(tmp_path)
+    return manager
+
+
+def _count(conn, sql):
+    # Sem transação aberta: DETACH ... CONCURRENTLY espera as transações em andamento
+    with conn.cursor() as cursor:
+        cursor.execute(sql)
+        value = cursor.fetchone()[0]
+    conn.commit()
+    return value
+
+
+@pytest.mark.db
+def test_archive_partition_exports_then_drops(events, fature_db, tmp_path):
+    january = _count(fature_db, "SELECT COUNT(*) FROM fature_v2.events WHERE created_at < '2024-02-01'")
+
+    assert events.archive_partition('events', 'events_p2024_01')
+
+    assert os.listdir(tmp_path) == ['events_p2024_01.csv.gz']
+    assert count_archive_rows(str(tmp_path / 'events_p2024_01.csv.gz')) == january
+    assert _count(fature_db, "SELECT to_regclass('fature_v2.events_p2024_01') IS NULL")
+    assert _count(fature_db, "SELECT COUNT(*) FROM fature_v2.events") == 200 - january
+
+
+@pytest.mark.db
+def test_failed_archive_reattaches_partition(events, fature_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(partition_manager, 'count_archive_rows', lambda path: -1)
+
+    assert not events.archive_partition('events', 'events_p2024_01')
+
+    assert os.listdir(tmp_path) == []
+    assert _count(fature_db, "SELECT COUNT(*) FROM fature_v2.events") == 200
+    assert _count(fature_db, """
+        SELECT pg_get_expr(relpartbound, oid) FROM pg_class WHERE oid = 'fature_v2.events_p2024_01'::regclass
+    """) == "FOR VALUES FROM ('2024-01-01') TO ('2024-02-01')"
@@ -0,0 +1,173 @@
+import threading
+import time
+
+import psycopg2
+import pytest
+
+from performance_cache import FaturePerformanceCache
+
+
+@pytest.fixture
+def cache(offline_database, monkeypatch):
+    """Cache sem segunda camada: toda conexão falha como banco indisponível"""
+    cache = FaturePerformanceCache()
+
+    def unavailable():
+        raise psycopg2.OperationalError('banco indisponível')
+
+    monkeypatch.setattr(cache, 'connect_database', unavailable)
+    return cache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('performance_cache.time.monotonic', lambda: now[0])
+    return now
+
+
+def test_lru_evicts_least_recently_used(cache):
+    cache.config['max_entries'] = 2
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+
+    cache.set('c', 3)
+
+    assert list(cache._entries) == ['a', 'c']
+    assert cache.stats['evictions'] == 1
+    assert cache.get('b') is None
+    assert cache.get('c', compute=lambda: 99) == 3
+    assert cache.stats['local_hits'] == 2
+
+
+def test_local_expiry_uses_monotonic_clock_and_explicit_zero_ttl(cache, clock):
+    cache.set('curta', 'v', ttl_seconds=10)
+    cache.set('padrao', 'v')
+    cache.set('zero', 'v', ttl_seconds=0)
+
+    assert 'zero' not in cache._entries and 'zero' not in cache._pending_writes
+
+    clock[0] += 10
+    assert cache.get('curta') is None
+    assert cache.get('padrao') == 'v'
+    assert cache.stats['expirations'] == 1
+
+    clock[0] += cache.config['default_ttl_seconds']
+    assert cache.get('padrao') is None
+
+
+def test_cold_key_is_computed_once_by_concurrent_callers(cache):
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        return {'total': 42}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('fria', compute)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    while 'fria' not in cache._flights:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == [{'total': 42}] * 8
+    assert cache.get('fria') == {'total': 42}
+
+
+def test_compute_in_flight_during_invalidate_is_not_stored(cache):
+    started, release = threading.Event(), threading.Event()
+
+    def stale():
+        started.set()
+        release.wait(5)
+        return 'antigo'
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(cache.get('k', stale)))
+    thread.start()
+    started.wait(5)
+
+    cache.invalidate('k')
+    # Após invalidate, um novo pedido não aguarda o cálculo antigo
+    assert cache.get('k', lambda: 'novo') == 'novo'
+
+    release.set()
+    thread.join(5)
+
+    assert results == ['antigo']
+    assert cache.get('k') == 'novo'
+    assert cache._pending_writes['k'][0] == 'novo'
+
+
+def _cache_rows(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT cache_key, cache_data, hit_count,
+                   EXTRACT(EPOCH FROM expires_at - NOW())::INTEGER
+            FROM fature_v2.performance_cache ORDER BY cache_key
+        """)
+        rows = cursor.fetchall()
+    conn.commit()
+    return rows
+
+
+@pytest.mark.db
+def test_writes_and_hits_are_flushed_in_batch(fature_db):
+    cache = FaturePerformanceCache()
+    try:
+        cache.set('a', {'v': 1}, ttl_seconds=600)
+        cache.set('b', [1, 2])
+        cache.set('zero', 0, ttl_seconds=0)
+        assert _cache_rows(fature_db) == []
+
+        assert cache.flush() == {'writes': 2, 'hits': 0}
+        rows = _cache_rows(fature_db)
+        assert [row[:3] for row in rows] == [('a', {'v': 1}, 0), ('b', [1, 2], 0)]
+        assert 598 <= rows[0][3] <= 600
+        assert cache.config['default_ttl_seconds'] - 2 <= rows[1][3] <= cache.config['default_ttl_seconds']
+
+        for _ in range(3):
+            assert cache.get('a') == {'v': 1}
+        assert cache.flush() == {'writes': 0, 'hits': 3}
+        assert _cache_rows(fature_db)[0][2] == 3
+    finally:
+        cache.close()
+
+    # Segunda instância: LRU vazia, valor vem do banco com a validade restante
+    other = FaturePerformanceCache()
+    try:
+        assert other.get('b') == [1, 2]
+        assert other.stats['db_hits'] == 1
+        remaining = other._entries['b'][1] - time.monotonic()
+        assert cache.config['default_ttl_seconds'] - 5 < remaining <= cache.config['default_ttl_seconds']
+    finally:
+        other.close()
+    assert _cache_rows(fature_db)[1][2] == 1
+
+
+@pytest.mark.db
+def test_invalidate_before_flush_keeps_value_out_of_database(fature_db):
+    cache = FaturePerformanceCache()
+    try:
+        cache.set('a', 'antigo')
+        assert cache.flush()['writes'] == 1
+
+        cache.set('a', 'pendente')
+        # Lote retirado da fila antes do invalidate e gravado depois dele
+        writes = dict(cache._pending_writes)
+        cache.invalidate('a')
+        cache._pending_writes.update(writes)
+
+        assert cache.flush()['writes'] == 0
+        assert _cache_rows(fature_db) == []
+        assert cache.get('a') is None
+    finally:
+        cache.close()
@@ -0,0 +1,80 @@
+import pytest
+
+from db_connection import get_pool
+from query_instrumentation import SLOW_QUERY_MS, QueryRecorder, normalize_sql, statement_verb
+
+
+@pytest.mark.parametrize('query, expected', [
+    ("SELECT * FROM t WHERE id = 42 AND name = 'O''Brien' -- comentário\n",
+     "SELECT * FROM t WHERE id = ? AND name = ?"),
+    ("select a from t where id in (1, 2, 3) and x = ANY(ARRAY[4,5])",
+     "select a from t where id in (?) and x = ANY(ARRAY[?])"),
+    ("/* lote */ UPDATE t\n   SET v = %(v)s\n WHERE id = %s;", "UPDATE t SET v = ? WHERE id = ?"),
+    ("SELECT col1, t2.x FROM t2 WHERE v > -3.5", "SELECT col1, t2.x FROM t2 WHERE v > ?"),
+    ("insert into t values (%s, %s, %s)", "insert into t values (?)"),
+])
+def test_normalize_sql(query, expected):
+    normalized = normalize_sql(query)
+    assert normalized == expected
+    assert statement_verb(normalized) == expected.split(' ', 1)[0].upper()
+
+
+def test_statement_verb_of_empty_statement():
+    assert statement_verb(normalize_sql("  -- nada\n")) == 'EMPTY'
+
+
+def test_recorder_always_keeps_slow_statements(monkeypatch):
+    recorder = QueryRecorder(None, {'sample_rate': 0.25, 'slow_ms': 100})
+    draws = iter([0.1, 0.9, 0.9])
+    monkeypatch.setattr('query_instrumentation.random.random', lambda: next(draws))
+
+    recorder.record('monitor', "SELECT 1", 5_000_000, 1)
+    recorder.record('monitor', "SELECT 2", 5_000_000, 1)
+    recorder.record('monitor', b"SELECT 3", 150_000_000, 1)
+
+    entries = list(recorder._buffer)
+    assert [(e[0], e[1], e[4], e[5]) for e in entries] == [
+        ('monitor.SELECT', 5, 0.25, 'SELECT ?'),
+        ('monitor.SELECT', 150, 1.0, 'SELECT ?'),
+    ]
+    assert entries[0][3] == entries[1][3]
+    assert recorder.stats['statements'] == 3 and recorder.stats['recorded'] == 2
+
+
+def _insert_queries(conn, durations, sample_rate):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO fature_v2.query_performance_log
+                (query_type, query_duration_ms, affected_rows, parameters, created_at)
+            SELECT 'monitor_select', d, 1, jsonb_build_object('sample_rate', %s::float), NOW()
+            FROM unnest(%s::int[]) d
+        """, (sample_rate, durations))
+    conn.commit()
+
+
+@pytest.mark.db
+def test_real_time_metrics_weights_samples_and_uses_shared_slow_limit(fature_db):
+    _insert_queries(fature_db, [10, 30], sample_rate=0.1)
+    _insert_queries(fature_db, [120, 180], sample_rate=1.0)
+
+    sql = """
+        SELECT queries_last_hour, avg_query_duration, max_query_duration, slow_queries
+        FROM fature_v2.real_time_metrics
+    """
+    with get_pool().connection('monitor') as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT current_setting('fature.slow_query_ms')")
+            assert cursor.fetchone()[0] == str(SLOW_QUERY_MS)
+            cursor.execute(sql)
+            queries, avg_duration, max_duration, slow = cursor.fetchone()
+
+    assert queries == 22
+    assert avg_duration == pytest.approx((10 * 10 + 30 * 10 + 120 + 180) / 22)
+    assert max_duration == 180
+    assert slow == 2
+
+    with fature_db.cursor() as cursor:
+        cursor.execute("SET LOCAL fature.slow_query_ms = 150")
+        cursor.execute(sql)
+        assert cursor.fetchone()[3] == 1
+    fature_db.rollback()
@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from ranking_service import FatureRankingService, TopKHeap
+
+
+def test_top_k_matches_sorted_counts_under_increments():
+    rng = random.Random(4)
+    heap = TopKHeap(capacity=10)
+    counts = {}
+
+    for step in range(5000):
+        affiliate_id = rng.randint(1, 60)
+        counts[affiliate_id] = counts.get(affiliate_id, 0) + rng.randint(0, 3)
+        heap.offer(affiliate_id, counts[affiliate_id])
+
+        if step % 50 == 0:
+            expected = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+            assert heap.top(10) == expected[:10]
+            assert heap.top(3) == expected[:3]
+
+    # Compactação mantém o heap limitado mesmo com muitas entradas desatualizadas
+    assert len(heap.heap) <= 4 * heap.capacity
+    assert len(heap.members) == 10
+
+
+def test_ties_prefer_lower_affiliate_id():
+    heap = TopKHeap(capacity=2)
+    for affiliate_id in (30, 20, 10):
+        heap.offer(affiliate_id, 5)
+
+    assert heap.top(2) == [(10, 5), (20, 5)]
+
+    heap.offer(40, 5)
+    assert heap.top(2) == [(10, 5), (20, 5)]
+
+    heap.offer(40, 6)
+    assert heap.top(2) == [(40, 6), (10, 5)]
+
+
+def _insert_affiliate(conn, affiliate_id, parent_id, seconds_ago=0):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO fature_v2.affiliates_optimized
+                (affiliate_id, parent_affiliate_id, external_id, name, registration_date,
+                 hierarchy_path, hierarchy_level, created_at)
+            VALUES (%s, %s, %s, %s, NOW(), '0', 1, NOW() - %s * INTERVAL '1 second')
+        """, (affiliate_id, parent_id, f"ext-{affiliate_id}", f"Afiliado {affiliate_id}", seconds_ago))
+    conn.commit()
+
+
+@pytest.mark.db
+def test_sync_picks_up_rows_committed_late_without_counting_twice(fature_db):
+    for affiliate_id, parent_id in ((1, None), (2, 1), (3, 1)):
+        _insert_affiliate(fature_db, affiliate_id, parent_id)
+
+    service = FatureRankingService()
+    service.load(fature_db)
+    fature_db.commit()
+
+    # created_at anterior à marca d'água: transação que começou antes e fez COMMIT depois
+    _insert_affiliate(fature_db, 4, 2, seconds_ago=60)
+    _insert_affiliate(fature_db, 5, 4)
+    # Filho com created_at anterior ao do pai: lido antes dele
+    _insert_affiliate(fature_db, 6, 3)
+    _insert_affiliate(fature_db, 7, 6, seconds_ago=30)
+
+    assert service.sync(fature_db) == 4
+    assert service.sync(fature_db) == 0
+    assert service.pending == []
+
+    for level in range(1, 4):
+        result = service.verify(fature_db, level, 10)
+        assert result['match'], result
+    assert service.top(1) == [{'affiliate_id': 1, 'referrals_count': 2},
+                              {'affiliate_id': 2, 'referrals_count': 1},
+                              {'affiliate_id': 3, 'referrals_count': 1},
+                              {'affiliate_id': 4, 'referrals_count': 1},
+                              {'affiliate_id': 6, 'referrals_count': 1}]
@@ -0,0 +1,119 @@
+import pytest
+
+from hierarchy_maintenance import FatureHierarchyMaintenance
+from migrate_fature import FatureMigration
+from refresh_stats import FatureStatsRefresh
+
+pytestmark = pytest.mark.db
+
+# 1 -> 2 -> 3 -> 4 -> 7, 1 -> 5 e raiz 6
+TREE = ((1, None), (2, 1), (3, 2), (4, 3), (5, 1), (6, None), (7, 4))
+
+# (beneficiário, valor, status)
+COMMISSIONS = ((3, 10, 'paid'), (2, 6, 'paid'), (1, 4, 'paid'), (2, 5, 'approved'))
+
+STATS_SQL = """
+    SELECT affiliate_id, hierarchy_level, direct_referrals_count, total_network_size,
+           calculated_network_size, total_commissions_earned, total_transactions_generated,
+           last_transaction_date, updated_at
+    FROM fature_v2.affiliate_stats ORDER BY affiliate_id
+"""
+
+
+@pytest.fixture
+def stats_db(fature_db):
+    with fature_db.cursor() as cursor:
+        for affiliate_id, parent_id in TREE:
+            cursor.execute("""
+                INSERT INTO fature_v2.affiliates_optimized
+                    (affiliate_id, parent_affiliate_id, external_id, name, registration_date,
+                     hierarchy_path, hierarchy_level)
+                VALUES (%s, %s, %s, %s, NOW(), '0', 1)
+            """, (affiliate_id, parent_id, f"ext-{affiliate_id}", f"Afiliado {affiliate_id}"))
+        cursor.execute("""
+            INSERT INTO fature_v2.transactions (transaction_id, affiliate_id, transaction_type, amount)
+            VALUES (1, 4, 'deposit', 1000)
+        """)
+        for beneficiary_id, amount, status in COMMISSIONS:
+            cursor.execute("""
+                INSERT INTO fature_v2.commissions
+                    (transaction_id, beneficiary_affiliate_id, source_affiliate_id, level_distance,
+                     base_amount, commission_rate, commission_amount, status, paid_at)
+                VALUES (1, %s, 4, 1, 1000, 0.01, %s, %s, CASE WHEN %s = 'paid' THEN NOW() END)
+            """, (beneficiary_id, amount, status, status))
+    fature_db.commit()
+
+    assert 'error' not in _job().refresh(full=True)
+    return fature_db
+
+
+def _job():
+    # Sem margem: só o que mudou depois da última execução entra no incremental
+    job = FatureStatsRefresh()
+    job.config.update({'overlap_seconds': 0, 'id_overlap': 0})
+    return job
+
+
+def _stats(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(STATS_SQL)
+        rows = cursor.fetchall()
+    conn.commit()
+    return rows
+
+
+def _incremental_and_full(conn):
+    stats = _job().refresh()
+    assert stats['mode'] == 'incremental' and 'error' not in stats
+    incremental = _stats(conn)
+
+    assert 'error' not in _job().refresh(full=True)
+    return incremental, _stats(conn)
+
+
+def _execute(conn, sql):
+    with conn.cursor() as cursor:
+        cursor.execute(sql)
+    conn.commit()
+
+
+def test_incremental_matches_full_after_move_subtree(stats_db):
+    FatureHierarchyMaintenance().move_subtree(3, 5)
+
+    incremental, full = _incremental_and_full(stats_db)
+    assert incremental == full
+    assert [row[4] for row in full] == [5, 0, 2, 1, 3, 0, 0]
+
+
+def test_incremental_matches_full_after_leaf_delete(stats_db):
+    # Os pares de 7 com os ancestrais acima do pai (1, 2 e 3) também somem
+    _execute(stats_db, """
+        DELETE FROM fature_v2.hierarchy_index WHERE descendant_id = 7;
+        DELETE FROM fature_v2.affiliates_optimized WHERE affiliate_id = 7;
+    """)
+
+    incremental, full = _incremental_and_full(stats_db)
+    assert incremental == full
+    assert [row[4] for row in full] == [4, 2, 1, 0, 0, 0]
+
+
+def test_incremental_matches_full_after_paid_commission_is_cancelled(stats_db):
+    _execute(stats_db, """
+        UPDATE fature_v2.commissions SET status = 'cancelled' WHERE beneficiary_affiliate_id = 2
+    """)
+
+    incremental, full = _incremental_and_full(stats_db)
+    assert incremental == full
+    assert [float(row[5]) for row in full] == [4, 0, 10, 0, 0, 0, 0]
+
+
+def test_upgrade_adds_commission_updated_at_and_trigger(stats_db):
+    _execute(stats_db, """
+        DROP FUNCTION fature_v2.set_updated_at() CASCADE;
+        ALTER TABLE fature_v2.commissions DROP COLUMN updated_at;
+    """)
+
+    assert FatureMigration().upgrade_schema() == ['commissions.updated_at', 'commissions.trg_commissions_updated_at']
+    assert FatureMigration().upgrade_schema() == []
+
+    test_incremental_matches_full_after_paid_commission_is_cancelled(stats_db)
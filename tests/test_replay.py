@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+import pytest
+
+from replay import FatureReplay, anonymize, load_replay_file
+
+
+def test_anonymize_renumbers_by_level_and_keeps_structure(random_tree):
+    ids, parents = random_tree(200, seed=9)
+    parent_of = dict(zip(ids.tolist(), parents.tolist()))
+    level_of = {}
+    for affiliate_id in parent_of:
+        level, current = 1, parent_of[affiliate_id]
+        while current:
+            level, current = level + 1, parent_of[current]
+        level_of[affiliate_id] = level
+
+    tree = np.array([(a, p, level_of[a]) for a, p in parent_of.items()], dtype=np.int64)
+    # Uma transação por afiliado com deslocamento = affiliate_id, mais uma de afiliado desconhecido
+    transactions = np.array(
+        [(a, 1, 1, 1234, a) for a in parent_of] + [(999_999_999, 2, 0, 500, -1)], dtype=np.int64
+    )
+
+    arrays = anonymize(tree, transactions, rounding_cents=100)
+
+    parent = arrays['parent']
+    assert sorted(parent.tolist()).count(-1) == 3
+    assert np.all(parent < np.arange(len(parent)))
+
+    dense_of = dict(zip(arrays['offset_ms'].tolist(), arrays['affiliate'].tolist()))
+    assert len(dense_of) == len(parent_of) == len(arrays['affiliate'])
+    assert sorted(dense_of.values()) == list(range(len(parent_of)))
+    for affiliate_id, parent_id in parent_of.items():
+        expected = dense_of[parent_id] if parent_id else -1
+        assert parent[dense_of[affiliate_id]] == expected
+
+    levels = [level_of[a] for a in sorted(dense_of, key=dense_of.get)]
+    assert levels == sorted(levels)
+
+
+def test_anonymize_rounds_amounts_to_at_least_one_unit():
+    tree = np.array([(7, 0, 1)], dtype=np.int64)
+    transactions = np.array([(7, 1, 1, cents, 0) for cents in (1, 149, 150, 12_345)], dtype=np.int64)
+
+    arrays = anonymize(tree, transactions, rounding_cents=100)
+
+    assert arrays['amount_cents'].tolist() == [100, 100, 200, 12_300]
+    assert arrays['parent'].tolist() == [-1]
+    assert arrays['affiliate'].tolist() == [0, 0, 0, 0]
+
+
+@pytest.mark.db
+def test_replay_runs_commission_path_without_errors(fature_db, tmp_path):
+    url = os.environ['FATURE_TEST_DATABASE_URL']
+    with fature_db.cursor() as cursor:
+        for affiliate_id, parent_id in ((1, None), (2, 1), (3, 2), (4, 3), (5, 1), (6, 5)):
+            cursor.execute("""
+                INSERT INTO fature_v2.affiliates_optimized
+                    (affiliate_id, parent_affiliate_id, external_id, name, registration_date,
+                     hierarchy_path, hierarchy_level)
+                VALUES (%s, %s, %s, %s, NOW(), '0', 1)
+            """, (affiliate_id, parent_id, f"ext-{affiliate_id}", f"Afiliado {affiliate_id}"))
+        for i, affiliate_id in enumerate((4, 6, 3, 2, 4, 1)):
+            cursor.execute("""
+                INSERT INTO fature_v2.transactions (affiliate_id, transaction_type, amount, transaction_date)
+                VALUES (%s, 'deposit', %s, LOCALTIMESTAMP - %s * INTERVAL '1 second')
+            """, (affiliate_id, 100 + i * 37, 10 - i))
+        cursor.execute("SELECT LOCALTIMESTAMP - INTERVAL '1 minute', LOCALTIMESTAMP + INTERVAL '1 minute'")
+        start, end = cursor.fetchone()
+    fature_db.commit()
+
+    replay = FatureReplay()
+    path = str(tmp_path / 'window.npz')
+    meta = replay.export(start, end, path)
+    assert (meta['affiliates'], meta['transactions']) == (6, 6)
+
+    # Banco de replay: a árvore do arquivo, numerada como em prepare (índice + 1)
+    data = load_replay_file(path)
+    with fature_db.cursor() as cursor:
+        cursor.execute("TRUNCATE fature_v2.affiliates_optimized, fature_v2.hierarchy_index, "
+                       "fature_v2.transactions, fature_v2.commissions CASCADE")
+        for index, parent in enumerate(data['parent'].tolist()):
+            cursor.execute("""
+                INSERT INTO fature_v2.affiliates_optimized
+                    (affiliate_id, parent_affiliate_id, external_id, name, registration_date,
+                     hierarchy_path, hierarchy_level)
+                VALUES (%s, %s, %s, %s, NOW(), '0', 1)
+            """, (index + 1, parent + 1 if parent >= 0 else None, f"bench-{index}", f"Bench {index}"))
+    fature_db.commit()
+
+    replay.config.update({'database': {'dsn': url}, 'speeds': [1000], 'concurrency': 2})
+    result = replay.run(path)
+
+    run = result['runs'][0]
+    assert run['transactions'] == 6
+    assert run['errors'] == 0
+    with fature_db.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM fature_v2.commissions")
+        assert cursor.fetchone()[0] > 0
+        cursor.execute("SELECT COUNT(*) FROM fature_v2.transactions WHERE NOT commission_processed")
+        assert cursor.fetchone()[0] == 0
+    fature_db.commit()
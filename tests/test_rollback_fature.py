@@ -0,0 +1,164 @@
+import contextlib
+import json
+import statistics
+
+import pytest
+
+import rollback_fature
+from rollback_fature import MAX_THROUGHPUT_SAMPLES, FatureRollback
+
+MB = 1024 * 1024
+
+
+def _table(relation, heap_mb, index_count=0, rows=1000):
+    return {'relation': relation, 'heap_bytes': heap_mb * MB, 'total_bytes': heap_mb * MB,
+            'estimated_rows': rows, 'index_count': index_count, 'dead_tuples': 0}
+
+
+TABLES = {
+    'fature_v2.affiliates_optimized': _table('fature_v2.affiliates_optimized', 50),
+    'public.affiliates': _table('public.affiliates', 80, index_count=2),
+    'public.affiliates_backup_pre_v2': _table('public.affiliates_backup_pre_v2', 100),
+}
+
+V2_RELATIONS = 40
+
+
+class _FakeConnection:
+    def cursor(self, **kwargs):
+        return contextlib.nullcontext(None)
+
+
+@pytest.fixture
+def rollback(offline_database, tmp_path, monkeypatch):
+    """FatureRollback com histórico em tmp_path e catálogo do banco simulado"""
+    monkeypatch.setattr(rollback_fature, 'THROUGHPUT_FILE', str(tmp_path / 'throughput.json'))
+    catalog = {'tables': dict(TABLES), 'sessions': []}
+
+    monkeypatch.setattr(FatureRollback, 'connection',
+                        lambda self, profile='rollback': contextlib.nullcontext(_FakeConnection()))
+    monkeypatch.setattr(FatureRollback, 'inspect_tables',
+                        lambda self, cursor, relations: {r: t for r, t in catalog['tables'].items()
+                                                         if r in relations})
+    monkeypatch.setattr(FatureRollback, 'find_blocking_sessions',
+                        lambda self, cursor, relations, schemas: catalog['sessions'])
+    monkeypatch.setattr(FatureRollback, '_schema_relation_count', lambda self, cursor, schema: V2_RELATIONS)
+
+    rollback = FatureRollback()
+    rollback.catalog = catalog
+    return rollback
+
+
+def _save_history(rollback, **samples):
+    for metric, values in samples.items():
+        for value in values:
+            rollback._add_throughput_sample(metric, value)
+    rollback.save_throughput_history()
+
+
+def test_history_keeps_last_samples_and_uses_median(rollback):
+    _save_history(rollback, copy_bytes_per_second=[float(i * MB) for i in range(1, 16)])
+    _save_history(rollback, copy_bytes_per_second=[float(i * MB) for i in range(16, 26)])
+
+    with open(rollback_fature.THROUGHPUT_FILE) as f:
+        history = json.load(f)
+    expected = [float(i * MB) for i in range(26 - MAX_THROUGHPUT_SAMPLES, 26)]
+    assert history['copy_bytes_per_second'] == expected
+
+    throughput = rollback.get_throughput()
+    assert throughput['copy_bytes_per_second'] == statistics.median(expected) == 15.5 * MB
+    assert throughput['drop_seconds_per_relation'] == rollback_fature.DEFAULT_THROUGHPUT['drop_seconds_per_relation']
+    assert throughput['measured'] == ['copy_bytes_per_second']
+
+
+def test_unreadable_history_falls_back_to_defaults(rollback):
+    with open(rollback_fature.THROUGHPUT_FILE, 'w') as f:
+        f.write('{corrompido')
+
+    throughput = rollback.get_throughput()
+    assert throughput == dict(rollback_fature.DEFAULT_THROUGHPUT, measured=[])
+
+
+def test_copy_samples_are_normalized_by_target_indexes(rollback):
+    rollback._add_copy_sample(source_bytes=10 * MB, target_indexes=2, elapsed=2.0)
+    rollback._add_copy_sample(source_bytes=0, target_indexes=2, elapsed=2.0)
+
+    assert rollback.throughput_samples == {'copy_bytes_per_second': [10 * MB * 1.6 / 2.0]}
+
+
+def test_plan_estimates_each_strategy_from_measured_throughput(rollback):
+    _save_history(rollback, copy_bytes_per_second=[8 * MB, 10 * MB, 12 * MB],
+                  drop_seconds_per_relation=[0.5])
+
+    plan = rollback.plan_rollback()
+
+    strategies = {s['strategy']: s for s in plan['strategies']}
+    full = strategies['full']
+    assert [(step['step'], round(step['estimated_seconds'], 6)) for step in full['steps']] == [
+        ('backup_current', 5.0),          # 50 MB, sem índices no destino
+        ('restore_main_table', 16.0),     # 100 MB x (1 + 0,3 x 2 índices)
+        ('cleanup_v2', 20.0),             # 40 relações x 0,5 s
+    ]
+    assert full['estimated_seconds'] == pytest.approx(41.0)
+    assert full['safe'] and strategies['schema_only']['safe']
+    assert strategies['schema_only']['estimated_seconds'] == pytest.approx(20.0)
+    assert plan['recommended'] == 'schema_only'
+
+    report = rollback.format_plan(plan)
+    assert "Throughput de cópia: 10.0 MB/s (histórico local)" in report
+    assert "✅ Estratégia full (rollback-full): ~41.0s" in report
+    assert "   - restore_main_table: ~16.0s" in report
+    assert "Recomendado: schema_only" in report
+
+
+def test_plan_without_backup_or_with_locks_has_no_safe_strategy(rollback):
+    del rollback.catalog['tables']['public.affiliates_backup_pre_v2']
+
+    plan = rollback.plan_rollback()
+    assert plan['recommended'] == 'schema_only'
+    full = plan['strategies'][0]
+    assert not full['safe'] and full['problems'] == ["Backup public.affiliates_backup_pre_v2 não encontrado"]
+
+    rollback.catalog['sessions'] = [{
+        'pid': 4242, 'relation': 'fature_v2.affiliates_optimized', 'mode': 'AccessShareLock',
+        'usename': 'fature', 'application_name': 'monitor', 'state': 'idle in transaction',
+        'transaction_age': '0:05:00', 'query': 'SELECT 1'
+    }]
+    plan = rollback.plan_rollback()
+    assert plan['recommended'] is None
+    assert all("fature_v2.affiliates_optimized" in s['problems'][-1] for s in plan['strategies'])
+
+    report = rollback.format_plan(plan)
+    assert "Throughput de cópia: 50.0 MB/s (valores padrão)" in report
+    assert "- pid 4242 (fature, monitor): AccessShareLock em fature_v2.affiliates_optimized" in report
+    assert "Recomendado: nenhuma estratégia segura no momento" in report
+
+
+@pytest.mark.parametrize('sessions, exit_code', [([], 0), (None, 1)])
+def test_plan_command_exit_code(rollback, monkeypatch, capsys, sessions, exit_code):
+    if sessions is None:
+        sessions = [{'pid': 1, 'relation': 'fature_v2.hierarchy_index', 'mode': 'RowExclusiveLock',
+                     'usename': 'fature', 'application_name': 'worker', 'state': 'active',
+                     'transaction_age': '0:00:01', 'query': 'INSERT ...'}]
+    rollback.catalog['sessions'] = sessions
+    monkeypatch.setattr('sys.argv', ['rollback_fature.py', 'plan', '--json'])
+
+    with pytest.raises(SystemExit) as exc:
+        rollback_fature.main()
+
+    assert exc.value.code == exit_code
+    assert json.loads(capsys.readouterr().out)['recommended'] == (None if exit_code else 'schema_only')
+
+
+def test_plan_command_fails_when_database_is_unreachable(rollback, monkeypatch, capsys):
+    def unreachable(self, profile='rollback'):
+        raise OSError('conexão recusada')
+
+    monkeypatch.setattr(FatureRollback, 'connection', unreachable)
+    monkeypatch.setattr('sys.argv', ['rollback_fature.py', 'plan'])
+
+    with pytest.raises(SystemExit) as exc:
+        rollback_fature.main()
+
+    assert exc.value.code == 1
+    assert "Erro ao planejar rollback: conexão recusada" in capsys.readouterr().out
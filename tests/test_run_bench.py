@@ -0,0 +1,29 @@
+import random
+
+import pytest
+
+from run_bench import _ChunkReader
+
+
+@pytest.mark.parametrize('size', [1, 7, 8192, 100000])
+def test_chunk_reader_returns_chunks_in_order(size):
+    rng = random.Random(size)
+    chunks = [''.join(rng.choice('abc\t\n') for _ in range(rng.randint(0, 3000))) for _ in range(50)]
+
+    reader = _ChunkReader(iter(chunks))
+    parts = []
+    while True:
+        data = reader.read(size)
+        if not data:
+            break
+        assert len(data) <= size
+        parts.append(data)
+
+    assert ''.join(parts) == ''.join(chunks)
+
+
+def test_chunk_reader_read_all_after_partial_read():
+    reader = _ChunkReader(iter(['abc', 'def', 'ghi']))
+    assert reader.read(4) == 'abcd'
+    assert reader.read() == 'efghi'
+    assert reader.read(10) == ''